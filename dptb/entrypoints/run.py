@@ -19,6 +19,9 @@ from dptb.nnops.NN2HRK import NN2HRK
 from ase.io import read,write
 from dptb.postprocess.bandstructure.band import bandcalc
 from dptb.postprocess.bandstructure.dos import doscalc, pdoscalc
+from dptb.postprocess.bandstructure.kpm import kpmcalc
+from dptb.postprocess.kubo import kubocalc
+from dptb.postprocess.foe import foecalc
 from dptb.postprocess.bandstructure.fermisurface import fs2dcalc, fs3dcalc
 from dptb.postprocess.bandstructure.ifermi_api import ifermiapi, ifermi_installed, pymatgen_installed
 from dptb.postprocess.write_skparam import WriteNNSKParam
@@ -176,6 +179,23 @@ def run(
         bcal.get_pdos()
         bcal.pdos_plot()
         log.info(msg='pdos calculation successfully completed.')
+
+    if task=='kpm':
+        bcal = kpmcalc(apiHrk, run_opt, task_options)
+        bcal.get_dos()
+        bcal.dos_plot()
+        log.info(msg='kpm calculation successfully completed.')
+
+    if task=='kubo':
+        bcal = kubocalc(apiHrk, run_opt, task_options)
+        bcal.get_conductivity()
+        bcal.kubo_plot()
+        log.info(msg='kubo calculation successfully completed.')
+
+    if task=='foe':
+        bcal = foecalc(apiHrk, run_opt, task_options)
+        bcal.get_density_matrix()
+        log.info(msg='foe calculation successfully completed.')
     
     if task=='FS2D':
         fs2dcal = fs2dcalc(apiHrk, run_opt, task_options)
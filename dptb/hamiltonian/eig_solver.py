@@ -0,0 +1,217 @@
+import torch as th
+import numpy as np
+import scipy.linalg as sla
+import logging
+
+log = logging.getLogger(__name__)
+
+# below this size the batched torch solver is faster than the per k-point LAPACK calls.
+LAPACK_MIN_SIZE = 200
+# with at most this fraction of the bands requested, the bisection driver evx beats evr.
+EVX_MAX_FRACTION = 0.1
+# the bands solved beyond each edge of the band window to find the degenerate levels cut by the edge.
+DEGENERACY_MARGIN = 4
+# the levels closer than this factor times the machine epsilon times the energy scale are degenerate.
+DEGENERACY_EPS_FACTOR = 100
+
+def eigh_torch(Heff, if_eigvec=False, band_window=None, energy_window=None):
+    '''The full spectrum by torch.linalg.eigh/eigvalsh, batched over k and differentiable.'''
+    if if_eigvec:
+        eigks, eigvec = th.linalg.eigh(Heff)
+    else:
+        eigks, eigvec = th.linalg.eigvalsh(Heff), None
+    if band_window is not None:
+        eigks = eigks[:, band_window[0]:band_window[1]]
+        eigvec = eigvec[:, :, band_window[0]:band_window[1]] if if_eigvec else None
+    return eigks, eigvec
+
+def _eigh_scipy(Heff, driver, if_eigvec=False, band_window=None, energy_window=None):
+    '''The spectrum by the LAPACK driver of scipy.linalg.eigh, one k-point at a time.'''
+    subset = {}
+    if band_window is not None:
+        subset["subset_by_index"] = [band_window[0], band_window[1]-1]
+    elif energy_window is not None:
+        subset["subset_by_value"] = [energy_window[0], energy_window[1]]
+
+    eigks, eigvecs = [], []
+    for hk in Heff.detach().cpu().numpy():
+        out = sla.eigh(hk, eigvals_only=not if_eigvec, driver=driver, check_finite=False, **subset)
+        if if_eigvec:
+            eigks.append(out[0])
+            eigvecs.append(out[1])
+        else:
+            eigks.append(out)
+
+    return _pad(eigks, eigvecs, Heff, if_eigvec)
+
+def eigh_evr(Heff, if_eigvec=False, band_window=None, energy_window=None):
+    '''LAPACK ?heevr, MRRR with the subset selection.'''
+    return _eigh_scipy(Heff, 'evr', if_eigvec=if_eigvec, band_window=band_window, energy_window=energy_window)
+
+def eigh_evx(Heff, if_eigvec=False, band_window=None, energy_window=None):
+    '''LAPACK ?heevx, bisection and inverse iteration, efficient for a few bands.'''
+    return _eigh_scipy(Heff, 'evx', if_eigvec=if_eigvec, band_window=band_window, energy_window=energy_window)
+
+def eigh_evd(Heff, if_eigvec=False, band_window=None, energy_window=None):
+    '''LAPACK ?heevd, divide-and-conquer for the full spectrum with eigenvectors.'''
+    eigks, eigvec = _eigh_scipy(Heff, 'evd', if_eigvec=if_eigvec)
+    if band_window is not None:
+        eigks = eigks[:, band_window[0]:band_window[1]]
+        eigvec = eigvec[:, :, band_window[0]:band_window[1]] if if_eigvec else None
+    return eigks, eigvec
+
+class EighBandWindow(th.autograd.Function):
+    '''The eigenvalues of the bands band_min <= n < band_max of a batch of hermitian matrices, with the backward of
+    the Hellmann-Feynman theorem dE_n/dH = v_n v_n^dagger restricted to these bands.
+
+    Only the eigenvectors of the window and of DEGENERACY_MARGIN bands on each side are solved and saved, instead of
+    the full eigendecomposition kept by torch.linalg.eigvalsh. The gradient of a single level of a degenerate multiplet
+    depends on the arbitrary basis of the multiplet, so the incoming gradients are averaged over each multiplet, which
+    gives grad_H = g P with P the projector on the multiplet, the same in any basis.
+    '''
+    @staticmethod
+    def forward(ctx, Heff, band_min, band_max):
+        size = Heff.shape[-1]
+        lo, hi = max(band_min - DEGENERACY_MARGIN, 0), min(band_max + DEGENERACY_MARGIN, size)
+        Hd = Heff.detach()
+        if Hd.device.type == "cpu" and size >= LAPACK_MIN_SIZE:
+            eigks, eigvec = eigh_evr(Hd, if_eigvec=True, band_window=[lo, hi])
+        else:
+            eigks, eigvec = eigh_torch(Hd, if_eigvec=True, band_window=[lo, hi])
+        ctx.save_for_backward(eigks, eigvec)
+        ctx.window = (band_min - lo, band_max - lo)
+        return eigks[:, band_min-lo:band_max-lo].clone()
+
+    @staticmethod
+    def backward(ctx, grad_eigks):
+        eigks, eigvec = ctx.saved_tensors
+        ist, ied = ctx.window
+        nk, nband = eigks.shape
+        grad = th.zeros_like(eigks)
+        grad[:, ist:ied] = grad_eigks
+
+        # the multiplets, a new one starts where the level spacing exceeds the tolerance.
+        tol = DEGENERACY_EPS_FACTOR * th.finfo(eigks.dtype).eps * max(1.0, eigks.abs().max().item())
+        start = th.ones_like(eigks, dtype=th.bool)
+        start[:, 1:] = (eigks[:, 1:] - eigks[:, :-1]) > tol
+        group = th.cumsum(start.reshape(-1).long(), dim=0) - 1
+        ngroup = int(group[-1]) + 1
+        gsum = th.zeros(ngroup, dtype=grad.dtype, device=grad.device).index_add(0, group, grad.reshape(-1))
+        gcount = th.zeros(ngroup, dtype=grad.dtype, device=grad.device).index_add(0, group, th.ones_like(grad.reshape(-1)))
+        grad = (gsum / gcount)[group].reshape(nk, nband)
+
+        grad_H = (eigvec * grad.unsqueeze(1).to(eigvec.dtype)) @ eigvec.transpose(1,2).conj()
+        return grad_H, None, None
+
+
+def eigh_window(Heff, if_eigvec=False, band_window=None, energy_window=None):
+    '''The eigenvalues of a band window by ``EighBandWindow``, differentiable with the band window backward. Without
+    a band window or with the eigenvectors, it is the torch solver.'''
+    if if_eigvec or band_window is None:
+        return eigh_torch(Heff, if_eigvec=if_eigvec, band_window=band_window, energy_window=energy_window)
+    return EighBandWindow.apply(Heff, int(band_window[0]), int(band_window[1])), None
+
+def _pad(eigks, eigvecs, Heff, if_eigvec):
+    # the energy window gives different number of bands at each k-point, the missing ones are NaN.
+    nband = max([len(eigs) for eigs in eigks])
+    eigout = np.full((len(eigks), nband), np.nan)
+    for ik, eigs in enumerate(eigks):
+        eigout[ik,:len(eigs)] = eigs
+    eigout = th.from_numpy(eigout).to(device=Heff.device, dtype=Heff.real.dtype)
+    if not if_eigvec:
+        return eigout, None
+    vecout = np.zeros((len(eigks), Heff.shape[-1], nband), dtype=eigvecs[0].dtype)
+    for ik, eigvec in enumerate(eigvecs):
+        vecout[ik,:,:eigvec.shape[1]] = eigvec
+    return eigout, th.from_numpy(vecout).to(device=Heff.device, dtype=Heff.dtype)
+
+def _cut_energy_window(eigks, eigvec, energy_window):
+    '''Keep the bands in the energy window of the full spectrum, padded with NaN eigenvalues and zero eigenvectors, by
+    the torch indexing which keeps the gradients.'''
+    mask = (eigks >= energy_window[0]) & (eigks <= energy_window[1])
+    count = mask.sum(dim=1)
+    nband = int(count.max()) if len(count) > 0 else 0
+    # the eigenvalues are in ascending order, the ones in the window are contiguous from the first one.
+    start = th.argmax(mask.to(th.int64), dim=1)
+    band = th.arange(nband, device=eigks.device)
+    valid = band.unsqueeze(0) < count.unsqueeze(1)
+    index = th.clamp(start.unsqueeze(1) + band.unsqueeze(0), max=eigks.shape[1]-1)
+    eigout = th.where(valid, eigks.gather(1, index), th.full_like(index, float('nan'), dtype=eigks.dtype))
+    if eigvec is None:
+        return eigout, None
+    vecout = eigvec.gather(2, index.unsqueeze(1).expand(-1, eigvec.shape[1], -1))
+    return eigout, vecout * valid.unsqueeze(1).to(vecout.dtype)
+
+dense_solvers = {
+    "torch": eigh_torch,
+    "evr": eigh_evr,
+    "evx": eigh_evx,
+    "evd": eigh_evd,
+    "window": eigh_window
+}
+
+# the solvers with the gradients.
+differentiable_solvers = ["torch", "window"]
+
+def select_dense_solver(size, if_eigvec=False, requires_grad=False, band_window=None, energy_window=None):
+    '''Choose the dense solver by the matrix size, the need of eigenvectors and of gradients.
+
+    Only the torch and the window solvers are differentiable, the eigenvalues of a band window with gradients go to
+    the window solver. Small matrices and the full spectrum stay with the batched torch solver, which already calls the
+    divide-and-conquer driver for the eigenvectors. For large matrices, a band or energy window goes to evr, or to evx
+    when only a few bands and no eigenvectors are needed.
+    '''
+    if requires_grad:
+        if band_window is not None and energy_window is None and not if_eigvec:
+            return "window"
+        return "torch"
+    if size < LAPACK_MIN_SIZE:
+        return "torch"
+    if band_window is not None or energy_window is not None:
+        if not if_eigvec and band_window is not None and band_window[1] - band_window[0] <= EVX_MAX_FRACTION * size:
+            return "evx"
+        return "evr"
+    return "torch"
+
+def dense_eigh(Heff, driver="auto", if_eigvec=False, band_window=None, energy_window=None):
+    '''Solve the eigenvalues of a batch of hermitian matrices with the dense solver given by driver.
+
+    Parameters
+    ----------
+    Heff
+        [nk, norbs, norbs] hermitian matrices.
+    driver, optional
+        one of ``dense_solvers``, or 'auto' to select by ``select_dense_solver``, defaults to 'auto'. Only 'torch' and
+        'window' are differentiable, one of them replaces the given driver when Heff requires grad. With an energy
+        window it is 'torch' on the full spectrum, the gradients of the eigenvalues in the window are kept and the NaN
+        padding has none.
+    band_window, optional
+        [band_min, band_max], only the bands band_min <= n < band_max are returned.
+    energy_window, optional
+        [emin, emax], only the bands in the window are returned, padded with NaN eigenvalues and zero eigenvectors to
+        the same number at each k. The gradients do not account for the bands crossing the edges of the window.
+
+    Returns
+    -------
+        driver: the name of the used solver.
+        eigks: [nk, nband] eigenvalues.
+        eigvec: [nk, norbs, nband] eigenvectors, or None.
+    '''
+    if driver == "auto":
+        driver = select_dense_solver(Heff.shape[-1], if_eigvec=if_eigvec, requires_grad=Heff.requires_grad,
+                                     band_window=band_window, energy_window=energy_window)
+    if driver not in dense_solvers:
+        log.error(f"The dense eigen solver {driver} is not supported, should be one of 'auto', {list(dense_solvers.keys())}.")
+        raise ValueError
+    if driver not in differentiable_solvers and Heff.requires_grad:
+        # e.g. the driver set for a trainer applies to the validation, the training steps need the gradients.
+        driver = select_dense_solver(Heff.shape[-1], if_eigvec=if_eigvec, requires_grad=True,
+                                     band_window=band_window, energy_window=energy_window)
+        log.debug(f"The dense eigen solver is not differentiable, {driver} is used since the gradients are needed.")
+
+    eigks, eigvec = dense_solvers[driver](Heff, if_eigvec=if_eigvec, band_window=band_window, energy_window=energy_window)
+    if driver in ["torch", "evd", "window"] and energy_window is not None:
+        # the full spectrum solvers, the window is cut afterwards.
+        eigks, eigvec = _cut_energy_window(eigks, eigvec if if_eigvec else None, energy_window)
+
+    return driver, eigks, eigvec
@@ -0,0 +1,90 @@
+import torch as th
+import numpy as np
+import logging
+
+log = logging.getLogger(__name__)
+
+# the tolerance of the k-points on the mesh, in units of the mesh spacing.
+KMESH_TOL = 1e-6
+
+def kmesh_index(kpoints, meshgrid):
+    '''The position of the kpoints on the regular mesh k = (n + shift) / meshgrid.
+
+    The shift of each direction is read from the first k-point, so the Gamma centered, the Monkhorst-Pack and the
+    end point including meshes of ``kmesh_fs`` are all recognized, as well as any subset of them, e.g. the irreducible
+    k-points of ``kmesh_irreducible``.
+
+    Parameters
+    ----------
+    kpoints
+        [nk, 3] k-points in fractional coordinates.
+    meshgrid
+        [N1, N2, N3] the size of the mesh.
+
+    Returns
+    -------
+        shift: [3] tuple of the shifts in [0, 1), or None if some kpoints are not on the mesh.
+        index: [nk, 3] integer array of n modulo meshgrid, or None.
+    '''
+    kpoints = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
+    mesh = np.asarray(meshgrid, dtype=np.int64).reshape(3)
+    if len(kpoints) == 0:
+        return None, None
+    x = kpoints * mesh
+    shift = np.mod(x[0], 1.0)
+    shift[shift > 1 - KMESH_TOL] = 0.0
+    n = np.round(x - shift)
+    if np.abs(x - shift - n).max() > KMESH_TOL:
+        return None, None
+
+    return tuple(np.round(shift, 8)), np.mod(n.astype(np.int64), mesh)
+
+
+class FFTHR(object):
+    """ H(k) or S(k) on all the points of a regular k-mesh, by one 3D FFT of the H(R) folded onto the R-grid.
+
+    On the mesh k = (n + s) / N, exp(-i2\\pi k.R) = exp(-i2\\pi s.R / N) exp(-i2\\pi n.R / N) only depends on R modulo N.
+    The H(R) times the shift phase are summed onto the [N1, N2, N3] grid of R modulo N, and the FFT over the three
+    grid axes gives H(k) of the whole mesh in O(norbs^2 nk log nk), instead of the O(nk nR norbs^2) phase sum.
+
+    Parameters
+    ----------
+    Rlatt
+        the [nR, 3] integer lattice vectors.
+    hR
+        the [nR, norbs, norbs] H(R) or S(R), see ``HamilEig.hs_block_R``.
+    meshgrid
+        [N1, N2, N3] the size of the mesh.
+    shift, optional
+        [3] the shift s of the mesh, defaults to Gamma centered.
+    cdtype, optional
+        the complex dtype of H(k), defaults to complex128.
+    """
+    def __init__(self, Rlatt, hR, meshgrid, shift=(0.0, 0.0, 0.0), cdtype=th.complex128) -> None:
+        self.meshgrid = [int(n) for n in meshgrid]
+        self.shift = tuple(shift)
+        N1, N2, N3 = self.meshgrid
+        norbs = hR.shape[-1]
+        mesh = th.tensor(self.meshgrid, dtype=th.float64, device=hR.device)
+        Rlatt = th.as_tensor(Rlatt, device=hR.device).long().reshape(-1,3)
+
+        phase = th.exp(-1j * 2 * np.pi * ((Rlatt.double() * th.tensor(self.shift, dtype=th.float64, device=hR.device)) / mesh).sum(dim=1))
+        Rfold = th.remainder(Rlatt, mesh.long())
+        flat = (Rfold[:, 0] * N2 + Rfold[:, 1]) * N3 + Rfold[:, 2]
+        # the orbital pairs lead, so that the FFT runs over the contiguous grid axes.
+        grid = th.zeros(norbs * norbs, N1 * N2 * N3, dtype=cdtype, device=hR.device)
+        grid = grid.index_add(1, flat, (hR.to(cdtype) * phase.to(cdtype).reshape(-1, 1, 1)).reshape(-1, norbs * norbs).T)
+        Hk = th.fft.fftn(grid.reshape(-1, N1, N2, N3), dim=(1, 2, 3)).reshape(norbs * norbs, -1)
+        self.Hk = Hk.T.contiguous().reshape(-1, norbs, norbs)
+
+    @staticmethod
+    def nbytes(meshgrid, norbs, cdtype=th.complex128):
+        '''The memory of the H(k) of the whole mesh in bytes.'''
+        itemsize = 16 if cdtype is th.complex128 else 8
+        return int(np.prod(meshgrid)) * norbs * norbs * itemsize
+
+    def Rk(self, index):
+        '''H(k) at the mesh points of index, given by ``kmesh_index``, as a [nk, norbs, norbs] tensor.'''
+        N1, N2, N3 = self.meshgrid
+        index = th.as_tensor(np.asarray(index), dtype=th.long, device=self.Hk.device).reshape(-1,3)
+        return self.Hk.index_select(0, (index[:, 0] * N2 + index[:, 1]) * N3 + index[:, 2])
@@ -0,0 +1,183 @@
+import numpy as np
+import scipy.sparse as sp
+import logging
+from dptb.hamiltonian.kpm import spectral_bounds
+
+log = logging.getLogger(__name__)
+
+# the tolerance of the Chebyshev expansion of the Fermi function, it sets the default number of terms.
+FOE_TOL = 1e-8
+# the tolerance of the Newton-Schulz iteration of the inverse of the overlap, in the max norm of I - S X.
+FOE_INVERSE_TOL = 1e-8
+# the maximum number of the Newton-Schulz iterations.
+FOE_INVERSE_MAXITER = 100
+# the number of the Chebyshev-Gauss nodes of the coefficients, per term of the expansion.
+FOE_QUADRATURE_FACTOR = 4
+
+
+def truncate(matrix, threshold=0.0, pattern=None):
+    '''Drop the elements of the sparse matrix below the threshold in absolute value, and out of the sparsity pattern if
+    given, which keeps the matrices of the expansion sparse, e.g. the density matrix of an insulator decays
+    exponentially with the distance.'''
+    matrix = sp.csr_matrix(matrix)
+    if pattern is not None:
+        matrix = sp.csr_matrix(matrix.multiply(pattern))
+    if threshold > 0:
+        matrix.data[np.abs(matrix.data) < threshold] = 0
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def inverse_overlap(sk, threshold=0.0, pattern=None, tol=FOE_INVERSE_TOL, maxiter=FOE_INVERSE_MAXITER):
+    '''The sparse inverse of the overlap by the Newton-Schulz iteration X <- X(2I - SX), with the truncated products.
+
+    It starts from X = S^dagger / (|S|_1 |S|_inf), which converges for any nonsingular S, and converges quadratically
+    once |I - SX| < 1, until the truncation bounds the residual.
+    '''
+    sk = sp.csr_matrix(sk)
+    identity = sp.identity(sk.shape[0], dtype=sk.dtype, format='csr')
+    norm1, norminf = np.abs(sk).sum(axis=0).max(), np.abs(sk).sum(axis=1).max()
+    X = truncate(sk.conj().T / (norm1 * norminf), threshold, pattern)
+    residual = np.inf
+    for _ in range(maxiter):
+        R = truncate(identity - sk @ X, threshold, pattern)
+        previous, residual = residual, 0.0 if R.nnz == 0 else np.abs(R.data).max()
+        if residual < tol:
+            return X
+        if residual >= previous:
+            # the truncation bounds the accuracy of the inverse.
+            log.warning(f'The inverse of the overlap stalls at the residual {residual} with the truncation.')
+            return X
+        X = truncate(X + X @ R, threshold, pattern)
+    log.error(f'The inverse of the overlap is not converged in {maxiter} Newton-Schulz iterations.')
+    raise ValueError
+
+
+def fermi_coefficients(bounds, mu, kT, num_terms):
+    '''The Chebyshev coefficients c_n of the Fermi function f(E) = 1/(1 + exp((E - mu)/kT)) in [emin, emax], with
+    f(a x + b) = \\sum_n c_n T_n(x), from the Chebyshev-Gauss quadrature.'''
+    a, b = (bounds[1] - bounds[0]) / 2, (bounds[1] + bounds[0]) / 2
+    nodes = FOE_QUADRATURE_FACTOR * num_terms
+    theta = np.pi * (np.arange(nodes) + 0.5) / nodes
+    # 1/(1 + exp(x)) = (1 - tanh(x/2))/2 does not overflow.
+    fermi = 0.5 * (1 - np.tanh((a * np.cos(theta) + b - mu) / (2 * kT)))
+    coeff = 2 / nodes * np.cos(np.outer(np.arange(num_terms), theta)) @ fermi
+    coeff[0] /= 2
+    return coeff
+
+
+class FermiOperatorExpansion(object):
+    """ The density matrix, the band energy and the electron count by the Chebyshev expansion of the Fermi operator.
+
+    With A = (S^{-1}H - b)/a the Fermi operator is F = f(S^{-1}H) = \\sum_n c_n T_n(A), the density matrix P = F S^{-1}
+    and the Mulliken populations the diagonal of PS = F. The matrices T_n(A) are built by the recursion of the sparse
+    matrix products, truncated at the threshold and restricted to the sparsity pattern. The threshold alone does not
+    keep T_n(A) sparse, it spreads over n bonds. With the pattern of the orbitals within a localization radius, the
+    column j of each T_n(A) is the one of the H restricted to the region around the orbital j, which is accurate when
+    the radius exceeds the decay length of the density matrix, and the cost is linear in the size.
+
+    The traces mu_n = Tr[T_n(A)] are computed once by ``moments``, they give the electron count
+    spindeg \\sum_n c_n(mu) mu_n and the band energy spindeg Tr[PH] = spindeg \\sum_n c_n(mu) Tr[T_n(A)(aA + b)], with
+    T_n(A)A = (T_{n+1}(A) + T_{|n-1|}(A))/2, for any chemical potential mu. The chemical potential is found by the
+    bisection of the electron count on the traces, the density matrix needs a second recursion at the final mu only.
+
+    Parameters
+    ----------
+    hk
+        the sparse Hermitian H in eV.
+    sk, optional
+        the sparse S, None for orthogonal basis.
+    kT, optional
+        the electronic temperature in eV, defaults to 0.1.
+    num_terms, optional
+        the number of the terms of the expansion, if None it is set by FOE_TOL, about 6 a/kT.
+    threshold, optional
+        the truncation threshold of the sparse matrices, defaults to 1e-6.
+    pattern, optional
+        the sparse boolean pattern of the orbital pairs kept in the matrices, e.g. within a localization radius, it
+        must be symmetric and contain the diagonal. None keeps all the pairs.
+    bounds, optional
+        [emin, emax] the bounds of the spectrum, if None they are estimated by ``spectral_bounds``.
+    spindeg, optional
+        the spin degeneracy, 2 without SOC and 1 with SOC, defaults to 2.
+    """
+    def __init__(self, hk, sk=None, kT=0.1, num_terms=None, threshold=1e-6, pattern=None, bounds=None, spindeg=2) -> None:
+        self.hk = sp.csr_matrix(hk)
+        self.sk = None if sk is None else sp.csr_matrix(sk)
+        self.kT = kT
+        self.threshold = threshold
+        self.pattern = None if pattern is None else sp.csr_matrix(pattern, dtype=bool)
+        self.spindeg = spindeg
+        self.bounds = spectral_bounds(self.hk, self.sk) if bounds is None else np.asarray(bounds)
+        self.a = (self.bounds[1] - self.bounds[0]) / 2
+        self.b = (self.bounds[1] + self.bounds[0]) / 2
+        if num_terms is None:
+            # the Fermi function is analytic in the strip |Im x| < pi kT/a, the coefficients decay as exp(-n pi kT/a).
+            num_terms = int(np.ceil(-np.log(FOE_TOL) * self.a / (np.pi * kT))) + 1
+        self.num_terms = num_terms
+
+        identity = sp.identity(self.hk.shape[0], dtype=self.hk.dtype, format='csr')
+        self.sinv = None
+        scaled = self.hk
+        if self.sk is not None:
+            self.sinv = inverse_overlap(self.sk, threshold=threshold, pattern=self.pattern)
+            scaled = truncate(self.sinv @ self.hk, threshold, self.pattern)
+        self.A = truncate((scaled - self.b * identity) / self.a, threshold, self.pattern)
+        self.traces = None
+
+    def chebyshev_matrices(self, num):
+        '''Iterate over the truncated T_n(A), n < num.'''
+        t0 = sp.identity(self.A.shape[0], dtype=self.A.dtype, format='csr')
+        t1 = self.A
+        yield t0
+        if num > 1:
+            yield t1
+        for _ in range(2, num):
+            t0, t1 = t1, truncate(2 * (self.A @ t1) - t0, self.threshold, self.pattern)
+            yield t1
+
+    def moments(self):
+        '''The traces mu_n = Tr[T_n(A)] for n <= num_terms, the last one for the band energy.'''
+        if self.traces is None:
+            self.traces = np.array([np.real(tn.diagonal().sum()) for tn in self.chebyshev_matrices(self.num_terms + 1)])
+        return self.traces
+
+    def electron_count(self, mu):
+        coeff = fermi_coefficients(self.bounds, mu, self.kT, self.num_terms)
+        return self.spindeg * coeff @ self.moments()[:self.num_terms]
+
+    def band_energy(self, mu):
+        coeff = fermi_coefficients(self.bounds, mu, self.kT, self.num_terms)
+        traces = self.moments()
+        n = np.arange(self.num_terms)
+        # Tr[T_n(A)A] = (mu_{n+1} + mu_{|n-1|})/2.
+        shifted = (traces[n + 1] + traces[np.abs(n - 1)]) / 2
+        return self.spindeg * coeff @ (self.a * shifted + self.b * traces[:self.num_terms])
+
+    def chemical_potential(self, num_el, tol=1e-8, maxiter=200):
+        '''The chemical potential of num_el electrons, by the bisection of the electron count in the spectral bounds.'''
+        lower, upper = self.bounds
+        if not self.electron_count(lower) < num_el < self.electron_count(upper):
+            log.error(f'The number of electrons {num_el} is out of the states in the spectral bounds {self.bounds}.')
+            raise ValueError
+        for _ in range(maxiter):
+            mu = (lower + upper) / 2
+            count = self.electron_count(mu)
+            if abs(count - num_el) < tol or upper - lower < tol * self.kT:
+                break
+            if count < num_el:
+                lower = mu
+            else:
+                upper = mu
+        return mu
+
+    def density_matrix(self, mu):
+        '''The density matrix P per spin and the Mulliken populations diag(PS) per spin of the orbitals at mu.'''
+        coeff = fermi_coefficients(self.bounds, mu, self.kT, self.num_terms)
+        fermi = None
+        for cn, tn in zip(coeff, self.chebyshev_matrices(self.num_terms)):
+            fermi = cn * tn if fermi is None else fermi + cn * tn
+        fermi = truncate(fermi, self.threshold)
+        populations = np.real(fermi.diagonal())
+        dm = fermi if self.sinv is None else truncate(fermi @ self.sinv, self.threshold, self.pattern)
+        return dm, populations
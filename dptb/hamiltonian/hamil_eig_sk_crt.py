@@ -6,13 +6,21 @@ import re
 from dptb.hamiltonian.transform_sk_speed import RotationSK
 from dptb.nnsktb.formula import SKFormula
 from dptb.utils.constants import anglrMId
-from dptb.hamiltonian.soc import creat_basis_lm, get_soc_matrix_cubic_basis
+from dptb.hamiltonian.soc import creat_basis_lm, get_soc_matrix_cached
+from dptb.hamiltonian.hamil_plan import HamilPlan, get_block_scatter, get_bond_classes, BOND_CLASS_MAX_FRACTION
+from dptb.hamiltonian.hr_blocks import HRBlocks
+from dptb.hamiltonian.fft_hk import FFTHR, kmesh_index
+from dptb.hamiltonian.sparse_eig import SparseHR, sparse_eigh, sparse_eigh_path
+from dptb.hamiltonian.eig_solver import dense_eigh, DEGENERACY_EPS_FACTOR
 
 ''' Over use of different index system cause the symbols and type and index kind of object need to be recalculated in different 
 Class, this makes entanglement of classes difficult. Need to design an consistent index system to resolve.'''
 
 log = logging.getLogger(__name__)
 
+# the tolerance of 2k to a reciprocal lattice vector for the real k-points.
+REAL_KPOINT_TOL = 1e-8
+
 class HamilEig(RotationSK):
     """ This module is to build the Hamiltonian from the SK-type bond integral.
     """
@@ -26,6 +34,27 @@ class HamilEig(RotationSK):
         self.use_orthogonal_basis = False
         self.hamil_blocks = None
         self.overlap_blocks = None
+        self.plan = None
+        # the plans shared between the structures of the same topology, see get_plan.
+        self.plan_cache = []
+        self.plan_cache_size = 8
+        # the plan and the onsite and hopping blocks of the last get_hs_blocks, patched by the next call if only
+        # some bonds changed.
+        self.blocks_plan = None
+        self.onsite_blocks = None
+        self.hopping_blocks = None
+        self.eig_driver = None
+        # the cached Cholesky factors of S(k), see get_overlap_factor.
+        self.overlap_cache = {}
+        self.overlap_cache_size = 16
+        # the SOC blocks of each atom type, see get_soc_atom.
+        self.soc_atom_cache = {}
+        # the H(R) and S(R) triplets received from another process, see from_shared_state.
+        self.shared_values = None
+        # the regular k-mesh whose H(k) and S(k) are given by FFT, see set_fft_mesh.
+        self.fft_mesh = None
+        self.fft_max_memory = None
+        self.fft_cache = {}
         self.device = device
 
     def update_hs_list(self, struct, hoppings, onsiteEs, onsiteVs=None, overlaps=None, onsiteSs=None, soc_lambdas=None, **options):
@@ -66,228 +95,400 @@ class HamilEig(RotationSK):
             norbs = self.__struct__.proj_atomtype_norbs[itype]
             self.num_orbs_per_atom.append(norbs)
 
+    def get_plan(self, bonds_onsite=None, bonds_hoppings=None, onsite_envs=None):
+        '''Get the assembly plan of the current structure. The plan is stored in the structure and rebuilt only
+        when the bond topology changes.
+        '''
+        if bonds_hoppings is None or bonds_onsite is None:
+            bonds, bonds_on = self.__struct__.get_bond()
+            bonds_hoppings = bonds if bonds_hoppings is None else bonds_hoppings
+            bonds_onsite = bonds_on if bonds_onsite is None else bonds_onsite
+
+        plan = getattr(self.__struct__, "hamil_plan", None)
+        if plan is None or not plan.match(bonds_onsite, bonds_hoppings, onsite_envs):
+            # the frames of a trajectory often share the topology, the plans of the recent structures are reused.
+            plan = next((plan for plan in self.plan_cache if plan.match(bonds_onsite, bonds_hoppings, onsite_envs, struct=self.__struct__)), None)
+            if plan is None:
+                plan = HamilPlan(self.__struct__, bonds_onsite=bonds_onsite, bonds_hoppings=bonds_hoppings, onsite_envs=onsite_envs)
+                if len(self.plan_cache) >= self.plan_cache_size:
+                    self.plan_cache.pop(0)
+                self.plan_cache.append(plan)
+            self.__struct__.hamil_plan = plan
+        self.plan = plan
+
+        return plan
+
+    def get_soc_atom(self, iatype):
+        '''The [norb, norb] up-up and up-down SOC blocks of atom type iatype, before the scaling by the lambdas.
+
+        The blocks only depend on the basis, they are built once from the per-shell SOC matrices cached by
+        (orbital, dtype, device) in ``get_soc_matrix_cached``, and kept in ``self.soc_atom_cache``.
+        '''
+        shells = self.plan.shells[iatype]
+        key = (iatype, tuple(shell[0] for shell in shells), self.dtype, str(self.device))
+        if key not in self.soc_atom_cache:
+            norb = sum([norbi for _, _, _, norbi, _ in shells])
+            upup = torch.zeros([norb, norb], dtype=self.cdtype, device=self.device)
+            updown = torch.zeros([norb, norb], dtype=self.cdtype, device=self.device)
+            for _, ishsymbol, _, norbi, ist in shells:
+                soc_orb = get_soc_matrix_cached(orbital=ishsymbol, device=self.device, dtype=self.dtype)
+                if len(soc_orb) != 2*norbi:
+                    log.error(msg='The dimension of the soc_orb is not correct!')
+                    raise ValueError
+                upup[ist:ist+norbi, ist:ist+norbi] = soc_orb[:norbi,:norbi]
+                updown[ist:ist+norbi, ist:ist+norbi] = soc_orb[:norbi, norbi:]
+            self.soc_atom_cache[key] = (upup, updown)
+
+        return self.soc_atom_cache[key]
+
     def get_soc_block(self, bonds_onsite = None):
-        numOrbs = np.array(self.num_orbs_per_atom)
-        totalOrbs = np.sum(numOrbs)
-        if bonds_onsite is None:
-            _, bonds_onsite = self.__struct__.get_bond()
+        '''The [norbs, norbs] up-up and up-down SOC matrices of the structure.
 
-        soc_upup = torch.zeros((totalOrbs, totalOrbs), device=self.device, dtype=self.cdtype)
-        soc_updown = torch.zeros((totalOrbs, totalOrbs), device=self.device, dtype=self.cdtype)
-
-        # compute soc mat for each atom:
-        soc_atom_upup = getattr(self.__struct__, "soc_atom_upup") if hasattr(self.__struct__, "soc_atom_upup") else {}
-        soc_atom_updown = getattr(self.__struct__, "soc_atom_updown") if hasattr(self.__struct__, "soc_atom_updown") else {}
-        if not soc_atom_upup or not soc_atom_updown:
-            for iatype in self.__struct__.proj_atomtype:
-                total_num_orbs_iatom= self.__struct__.proj_atomtype_norbs[iatype]
-                tmp_upup = torch.zeros([total_num_orbs_iatom, total_num_orbs_iatom], dtype=self.cdtype, device=self.device)
-                tmp_updown = torch.zeros([total_num_orbs_iatom, total_num_orbs_iatom], dtype=self.cdtype, device=self.device)
-
-                ist = 0
-                for ish in self.__struct__.proj_atom_anglr_m[iatype]:
-                    ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
-                    shidi = anglrMId[ishsymbol]          # 0,1,2,...
-                    norbi = 2*shidi + 1
-
-                    soc_orb = get_soc_matrix_cubic_basis(orbital=ishsymbol, device=self.device, dtype=self.dtype)
-                    if len(soc_orb) != 2*norbi:
-                        log.error(msg='The dimension of the soc_orb is not correct!')
-                    tmp_upup[ist:ist+norbi, ist:ist+norbi] = soc_orb[:norbi,:norbi]
-                    tmp_updown[ist:ist+norbi, ist:ist+norbi] = soc_orb[:norbi, norbi:]
-                    ist = ist + norbi
-
-                soc_atom_upup.update({iatype:tmp_upup})
-                soc_atom_updown.update({iatype:tmp_updown})
-            self.__struct__.soc_atom_upup = soc_atom_upup
-            self.__struct__.soc_atom_updown = soc_atom_updown
-        
-        for ib in range(len(bonds_onsite)):
-            ibond = bonds_onsite[ib].int()
-            iatom = ibond[1]
-            ist = int(np.sum(numOrbs[0:iatom]))
-            ied = int(np.sum(numOrbs[0:iatom+1]))
-            iatype = self.__struct__.proj_atom_symbols[iatom]
-
-            # get lambdas
-            istin = 0
-            lambdas = torch.zeros((ied-ist,), device=self.device, dtype=self.cdtype)
-            for ish in self.__struct__.proj_atom_anglr_m[iatype]:
-                indx = self.__struct__.onsite_index_map[iatype][ish]
-                ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
-                shidi = anglrMId[ishsymbol]          # 0,1,2,...
-                norbi = 2*shidi + 1
-                lambdas[istin:istin+norbi] = self.soc_lambdas[ib][indx]
-                istin = istin + norbi
-                
-            soc_upup[ist:ied,ist:ied] = soc_atom_upup[iatype] @ torch.diag(lambdas)
-            soc_updown[ist:ied, ist:ied] = soc_atom_updown[iatype] @ torch.diag(lambdas)
-        
-        soc_upup.contiguous()
-        soc_updown.contiguous()
+        The SOC blocks of all the atoms of one type are scaled by their lambdas in one batch and placed by the
+        flatten block index of the plan.
+        '''
+        plan = self.plan
+        totalOrbs = plan.total_orbs
+
+        soc_upup = torch.zeros(totalOrbs * totalOrbs, device=self.device, dtype=self.cdtype)
+        soc_updown = torch.zeros(totalOrbs * totalOrbs, device=self.device, dtype=self.cdtype)
+        for iatype, group in plan.onsite_groups.items():
+            upup, updown = self.get_soc_atom(iatype)
+            # soc_atom @ diag(lambdas) scales the columns of soc_atom.
+            lambdas = th.stack([self.soc_lambdas[ib] for ib in group["bonds"]]).reshape(len(group["bonds"]), -1)[:, group["param_index"]]
+            lambdas = lambdas.to(dtype=self.cdtype, device=self.device).unsqueeze(1)
+            index = group["block_index"].to(self.device)
+            soc_upup = soc_upup.index_add(0, index, (upup.unsqueeze(0) * lambdas).reshape(-1))
+            soc_updown = soc_updown.index_add(0, index, (updown.unsqueeze(0) * lambdas).reshape(-1))
 
-        return soc_upup, soc_updown
+        return soc_upup.reshape(totalOrbs, totalOrbs), soc_updown.reshape(totalOrbs, totalOrbs)
     
-    def get_hs_onsite(self, bonds_onsite = None, onsite_envs=None):
+    def get_hs_onsite(self, bonds_onsite = None, onsite_envs=None, changed=None):
+        '''Build the onsite blocks.
+
+        Parameters
+        ----------
+        changed, optional
+            [N_onsite] bool array, if given only the blocks of the changed onsite bonds are built, with all their
+            onsite envs, and written into the onsite blocks of the last ``get_hs_blocks`` of the same plan.
+
+        Returns
+        -------
+            onsiteH_blocks, onsiteS_blocks: dict of the onsite blocks of each atom type, {itype: [natom, norb, norb]},
+            in the order of ``plan.onsite_groups[itype]["bonds"]``. onsiteS_blocks is None for orthogonal basis.
+        '''
         if bonds_onsite is None:
             _, bonds_onsite = self.__struct__.get_bond()
-        onsiteH_blocks = []
+        plan = self.plan
+        onsiteH_blocks = {}
         if not self.use_orthogonal_basis:
-            onsiteS_blocks = []
+            onsiteS_blocks = {}
         else:
             onsiteS_blocks = None
-        
-        iatom_to_onsite_index = {}
-        for ib in range(len(bonds_onsite)):
-            ibond = bonds_onsite[ib].int()
-            iatom = int(ibond[1])
-            iatom_to_onsite_index.update({iatom:ib})
-            jatom = int(ibond[3])
-            iatype = self.__struct__.proj_atom_symbols[iatom]
-            jatype = self.__struct__.proj_atom_symbols[jatom]
-            assert iatype == jatype, "i type should equal j type."
-
-            sub_hamil_block = th.zeros([self.__struct__.proj_atomtype_norbs[iatype], self.__struct__.proj_atomtype_norbs[jatype]], dtype=self.dtype, device=self.device)
-            if not self.use_orthogonal_basis:
-                sub_over_block = th.zeros([self.__struct__.proj_atomtype_norbs[iatype], self.__struct__.proj_atomtype_norbs[jatype]], dtype=self.dtype, device=self.device)
-            
-            ist = 0
-            for ish in self.__struct__.proj_atom_anglr_m[iatype]:     # ['s','p',..]
-                ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
-                shidi = anglrMId[ishsymbol]          # 0,1,2,...
-                norbi = 2*shidi + 1 
-
-                indx = self.__struct__.onsite_index_map[iatype][ish] # change onsite index map from {N:{s:}} to {N:{ss:, sp:}}
-                sub_hamil_block[ist:ist+norbi, ist:ist+norbi] = th.eye(norbi, dtype=self.dtype, device=self.device) * self.onsiteEs[ib][indx]
-                if not self.use_orthogonal_basis:
-                    sub_over_block[ist:ist+norbi, ist:ist+norbi] = th.eye(norbi, dtype=self.dtype, device=self.device) * self.onsiteSs[ib][indx]
-                ist = ist + norbi
-
-            onsiteH_blocks.append(sub_hamil_block)
+
+        # the position of the built blocks in the onsite blocks of each atom type, and the inverse map.
+        positions, local = {}, {}
+        for iatype, group in plan.onsite_groups.items():
+            if changed is None:
+                positions[iatype] = np.arange(len(group["bonds"]))
+            else:
+                positions[iatype] = np.nonzero(np.asarray(changed)[group["bonds"]])[0]
+            local[iatype] = -np.ones(len(group["bonds"]), dtype=int)
+            local[iatype][positions[iatype]] = np.arange(len(positions[iatype]))
+
+        # the onsite blocks are diagonal, gather the onsite energies of each orbital.
+        for iatype, group in plan.onsite_groups.items():
+            bonds = [group["bonds"][ib] for ib in positions[iatype]]
+            if len(bonds) == 0:
+                continue
+            onsiteE = th.stack([self.onsiteEs[ib] for ib in bonds]).reshape(len(bonds), -1).to(dtype=self.dtype, device=self.device)
+            onsiteH_blocks[iatype] = th.diag_embed(onsiteE[:, group["param_index"]])
             if not self.use_orthogonal_basis:
-                onsiteS_blocks.append(sub_over_block)
+                onsiteS = th.stack([self.onsiteSs[ib] for ib in bonds]).reshape(len(bonds), -1).to(dtype=self.dtype, device=self.device)
+                onsiteS_blocks[iatype] = th.diag_embed(onsiteS[:, group["param_index"]])
 
         # onsite strain
         if onsite_envs is not None:
             assert self.onsiteVs is not None
-            for ib, env in enumerate(onsite_envs):
-                
-                iatype, iatom, jatype, jatom = self.__struct__.proj_atom_symbols[int(env[1])], int(env[1]), self.__struct__.atom_symbols[int(env[3])], int(env[3])
-                direction_vec = env[8:11].float()
-
-                sub_hamil_block = th.zeros([self.__struct__.proj_atomtype_norbs[iatype], self.__struct__.proj_atomtype_norbs[iatype]], dtype=self.dtype, device=self.device)
-                envtype = iatype + '-' + jatype
-
-                ist = 0
-                for ish in self.__struct__.proj_atom_anglr_m[iatype]:
-                    ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
-                    shidi = anglrMId[ishsymbol]
-                    norbi = 2*shidi+1
-                    
-                    jst = 0
-                    for jsh in self.__struct__.proj_atom_anglr_m[iatype]:
-                        jshsymbol = ''.join(re.findall(r'[A-Za-z]',jsh))
-                        shidj = anglrMId[jshsymbol]
-                        norbj = 2 * shidj + 1
-
-                        idx = self.__struct__.onsite_strain_index_map[envtype][ish+'-'+jsh]
-                        
-                        if shidi < shidj:
-                            
-                            tmpH = self.rot_HS(Htype=ishsymbol+jshsymbol, Hvalue=self.onsiteVs[ib][idx], Angvec=direction_vec)
-                            # Hamilblock[ist:ist+norbi, jst:jst+norbj] = th.transpose(tmpH,dim0=0,dim1=1)
-                            sub_hamil_block[ist:ist+norbi, jst:jst+norbj] = th.transpose(tmpH,dim0=0,dim1=1)
-                        else:
-                            tmpH = self.rot_HS(Htype=jshsymbol+ishsymbol, Hvalue=self.onsiteVs[ib][idx], Angvec=direction_vec)
-                            sub_hamil_block[ist:ist+norbi, jst:jst+norbj] = tmpH
-                
-                        jst = jst + norbj 
-                    ist = ist + norbi
-                onsiteH_blocks[iatom_to_onsite_index[iatom]] += sub_hamil_block
+            onsite_envs = th.as_tensor(onsite_envs)
+            for envtype, group in plan.strain_groups.items():
+                # one batched rotation per shell pair for all the envs of the type, then a segment sum into the atoms.
+                iatype = group["onsite_type"]
+                onsite_pos = local[iatype][group["onsite_pos"].numpy()]
+                select = np.nonzero(onsite_pos >= 0)[0]
+                if len(select) == 0:
+                    continue
+                index = group["index"][select]
+                direction_vec = onsite_envs[index,8:11]
+                onsiteV = [self.onsiteVs[group["envs"][ie]] for ie in select]
+                blocks = self.rot_HS_classes(shell_pairs=group["shell_pairs"], nshells=group["nshells"], values=onsiteV, Angvec=direction_vec,
+                                             classes=self.get_block_classes(onsite_envs[index], onsiteV))
+                onsiteH_blocks[iatype] = onsiteH_blocks[iatype].index_add(0, th.from_numpy(onsite_pos[select]).to(blocks.device),
+                                                                          blocks.to(onsiteH_blocks[iatype].dtype))
+
+        if changed is not None:
+            onsiteH_blocks = self.patch_blocks(self.onsite_blocks[0], onsiteH_blocks, positions)
+            if not self.use_orthogonal_basis:
+                onsiteS_blocks = self.patch_blocks(self.onsite_blocks[1], onsiteS_blocks, positions)
 
         return onsiteH_blocks, onsiteS_blocks, bonds_onsite
     
-    def get_hs_hopping(self, bonds_hoppings = None):
+    def get_hs_hopping(self, bonds_hoppings = None, changed=None):
+        '''Build the hopping blocks.
+
+        Parameters
+        ----------
+        changed, optional
+            [N_bond] bool array, if given only the blocks of the changed bonds are built and written into the hopping
+            blocks of the last ``get_hs_blocks`` of the same plan.
+
+        Returns
+        -------
+            hoppingH_blocks, hoppingS_blocks: dict of the hopping blocks of each bond type,
+            {bondtype: [nbond, norb_i, norb_j]}, in the order of ``plan.hopping_groups[bondtype]["bonds"]``.
+            hoppingS_blocks is None for orthogonal basis.
+        '''
         if bonds_hoppings is None:
             bonds_hoppings, _ = self.__struct__.get_bond()
+        plan = self.plan
 
-        hoppingH_blocks = []
+        hoppingH_blocks = {}
         if not self.use_orthogonal_basis:
-            hoppingS_blocks = []
+            hoppingS_blocks = {}
         else:
             hoppingS_blocks = None
         
-        for ib in range(len(bonds_hoppings)):
-            
-            ibond = bonds_hoppings[ib,0:7].int()
-            #direction_vec = (self.__struct__.projected_struct.positions[ibond[3]]
-            #          - self.__struct__.projected_struct.positions[ibond[1]]
-            #          + np.dot(ibond[4:], self.__struct__.projected_struct.cell))
-            #dist = np.linalg.norm(direction_vec)
-            #direction_vec = direction_vec/dist
-            direction_vec = bonds_hoppings[ib,8:11].float()
-            iatype = self.__struct__.proj_atom_symbols[int(ibond[1])]
-            jatype = self.__struct__.proj_atom_symbols[int(ibond[3])]
-
-            sub_hamil_block = th.zeros([self.__struct__.proj_atomtype_norbs[iatype], self.__struct__.proj_atomtype_norbs[jatype]], dtype=self.dtype, device=self.device)
+        bonds_hoppings = th.as_tensor(bonds_hoppings)
+        positions = {}
+        for bondatomtype, group in plan.hopping_groups.items():
+            if changed is None:
+                positions[bondatomtype] = np.arange(len(group["bonds"]))
+                index, bonds = group["index"], group["bonds"]
+            else:
+                positions[bondatomtype] = np.nonzero(np.asarray(changed)[group["bonds"]])[0]
+                index = group["index"][positions[bondatomtype]]
+                bonds = [group["bonds"][ib] for ib in positions[bondatomtype]]
+            if len(bonds) == 0:
+                continue
+            direction_vec = bonds_hoppings[index,8:11]
+            # the bonds of the same direction and SK integrals are rotated once, see get_block_classes.
+            hopping = [self.hoppings[ib] for ib in bonds]
+            hoppingH_blocks[bondatomtype] = self.rot_HS_classes(shell_pairs=group["shell_pairs"], nshells=group["nshells"], values=hopping, Angvec=direction_vec,
+                                                                classes=self.get_block_classes(bonds_hoppings[index], hopping))
             if not self.use_orthogonal_basis:
-                sub_over_block = th.zeros([self.__struct__.proj_atomtype_norbs[iatype], self.__struct__.proj_atomtype_norbs[jatype]], dtype=self.dtype, device=self.device)
-            
-            bondatomtype = iatype + '-' + jatype
-            
-            ist = 0
-            for ish in self.__struct__.proj_atom_anglr_m[iatype]:
-                ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
-                shidi = anglrMId[ishsymbol]
-                norbi = 2*shidi+1
-                
-                jst = 0
-                for jsh in self.__struct__.proj_atom_anglr_m[jatype]:
-                    jshsymbol = ''.join(re.findall(r'[A-Za-z]',jsh))
-                    shidj = anglrMId[jshsymbol]
-                    norbj = 2 * shidj + 1
-
-                    idx = self.__struct__.bond_index_map[bondatomtype][ish+'-'+jsh]
-                    if shidi < shidj:
-                        tmpH = self.rot_HS(Htype=ishsymbol+jshsymbol, Hvalue=self.hoppings[ib][idx], Angvec=direction_vec)
-                        # Hamilblock[ist:ist+norbi, jst:jst+norbj] = th.transpose(tmpH,dim0=0,dim1=1)
-                        sub_hamil_block[ist:ist+norbi, jst:jst+norbj] = (-1.0)**(shidi + shidj) * th.transpose(tmpH,dim0=0,dim1=1)
-                        if not self.use_orthogonal_basis:
-                            tmpS = self.rot_HS(Htype=ishsymbol+jshsymbol, Hvalue=self.overlaps[ib][idx], Angvec=direction_vec)
-                        # Soverblock[ist:ist+norbi, jst:jst+norbj] = th.transpose(tmpS,dim0=0,dim1=1)
-                            sub_over_block[ist:ist+norbi, jst:jst+norbj] = (-1.0)**(shidi + shidj) * th.transpose(tmpS,dim0=0,dim1=1)
-                    else:
-                        tmpH = self.rot_HS(Htype=jshsymbol+ishsymbol, Hvalue=self.hoppings[ib][idx], Angvec=direction_vec)
-                        sub_hamil_block[ist:ist+norbi, jst:jst+norbj] = tmpH
-                        if not self.use_orthogonal_basis:
-                            tmpS = self.rot_HS(Htype=jshsymbol+ishsymbol, Hvalue = self.overlaps[ib][idx], Angvec = direction_vec)
-                            sub_over_block[ist:ist+norbi, jst:jst+norbj] = tmpS
-                
-                    jst = jst + norbj 
-                ist = ist + norbi
-            
-            hoppingH_blocks.append(sub_hamil_block)
+                overlap = [self.overlaps[ib] for ib in bonds]
+                hoppingS_blocks[bondatomtype] = self.rot_HS_classes(shell_pairs=group["shell_pairs"], nshells=group["nshells"], values=overlap, Angvec=direction_vec,
+                                                                    classes=self.get_block_classes(bonds_hoppings[index], overlap))
+
+        if changed is not None:
+            hoppingH_blocks = self.patch_blocks(self.hopping_blocks[0], hoppingH_blocks, positions)
             if not self.use_orthogonal_basis:
-                hoppingS_blocks.append(sub_over_block)
+                hoppingS_blocks = self.patch_blocks(self.hopping_blocks[1], hoppingS_blocks, positions)
 
         return hoppingH_blocks, hoppingS_blocks, bonds_hoppings
+
+    @staticmethod
+    def patch_blocks(previous, blocks, positions):
+        '''Write the blocks built at positions into the previous blocks of each type, out of place so that the
+        gradients of the previous blocks are kept.'''
+        patched = {}
+        for key, block in previous.items():
+            if key in blocks:
+                patched[key] = block.index_copy(0, th.from_numpy(positions[key]).to(block.device), blocks[key].to(block.dtype))
+            else:
+                patched[key] = block
+        return patched
     
-    def get_hs_blocks(self, bonds_onsite = None, bonds_hoppings=None, onsite_envs=None):
-        onsiteH, onsiteS, bonds_onsite = self.get_hs_onsite(bonds_onsite=bonds_onsite, onsite_envs=onsite_envs)
-        hoppingH, hoppingS, bonds_hoppings = self.get_hs_hopping(bonds_hoppings=bonds_hoppings)
-
-        self.all_bonds = torch.cat([bonds_onsite[:,0:7],bonds_hoppings[:,0:7]],dim=0)
-        self.all_bonds = self.all_bonds.int()
-        onsiteH.extend(hoppingH)
-        self.hamil_blocks = onsiteH
+    def get_block_classes(self, bonds, values):
+        '''The classes of the bonds with the same direction cosines and the same tensor of SK integrals, e.g. the bonds
+        of one class of ``get_bond_classes`` share the tensor of ``SKintHops.get_skhops``. The block of each class is
+        rotated once and gathered for all its bonds, the backward of the gather sums the gradients of all the bonds
+        into the shared tensor.
+
+        Parameters
+        ----------
+        bonds
+            the bond list [nbond, 11], see ``get_bond_classes``.
+        values
+            the list of the SK integral tensors of the bonds.
+
+        Returns
+        -------
+            rep: [nclass] index of the first bond of each class.
+            inverse: [nbond] the class of each bond.
+            None if there are more than BOND_CLASS_MAX_FRACTION as many classes as bonds.
+        '''
+        tensor_ids = {}
+        owner = [tensor_ids.setdefault(id(value), len(tensor_ids)) for value in values]
+        if len(tensor_ids) > BOND_CLASS_MAX_FRACTION * len(values):
+            return None
+        rep, inverse = get_bond_classes(bonds, length=False, labels=owner)
+        if len(rep) > BOND_CLASS_MAX_FRACTION * len(values):
+            return None
+        return rep, inverse
+
+    def rot_HS_classes(self, shell_pairs, nshells, values, Angvec, classes=None):
+        '''Build the blocks of a batch of bonds of the same bond type by ``rot_HS_blocks``, once per class of
+        ``get_block_classes`` if given.'''
+        if classes is None:
+            Hvalue = th.stack(values).reshape(len(values), -1)
+            return self.rot_HS_blocks(shell_pairs=shell_pairs, nshells=nshells, Hvalue=Hvalue, Angvec=Angvec)
+        rep, inverse = classes
+        Hvalue = th.stack([values[ib] for ib in rep.tolist()]).reshape(len(rep), -1)
+        blocks = self.rot_HS_blocks(shell_pairs=shell_pairs, nshells=nshells, Hvalue=Hvalue, Angvec=Angvec[rep])
+        return blocks[inverse.to(blocks.device)]
+
+    def rot_HS_blocks(self, shell_pairs, nshells, Hvalue, Angvec):
+        '''Build the blocks of a batch of bonds of the same bond type, with one batched rotation per shell pair.
+
+        Parameters
+        ----------
+        shell_pairs
+            the planned shell pairs of the bond type, see ``HamilPlan.shell_pairs``.
+        nshells
+            number of shells of the j atom, i.e. the number of shell pairs in one row of the block.
+        Hvalue
+            the SK integrals of the bonds, [nbond, nparam].
+        Angvec
+            the direction cosines of the bonds, [nbond, 3].
+
+        Returns
+        -------
+            the blocks, [nbond, norbi, norbj].
+        '''
+        subblocks = []
+        for _, _, _, _, _, _, rot_type, sign, transpose, idx in shell_pairs:
+            tmpH = self.rot_HS_batch(Htype=rot_type, Hvalue=Hvalue[:,idx], Angvec=Angvec)
+            if transpose:
+                tmpH = sign * th.transpose(tmpH,dim0=1,dim1=2)
+            subblocks.append(tmpH)
+        rows = [th.cat(subblocks[ii:ii+nshells], dim=2) for ii in range(0, len(subblocks), nshells)]
+
+        return th.cat(rows, dim=1)
+
+    def get_hs_blocks(self, bonds_onsite = None, bonds_hoppings=None, onsite_envs=None, changed_onsite=None, changed_hoppings=None):
+        '''Build the H(R) and S(R) blocks of the current lists of SK integrals, see update_hs_list.
+
+        Parameters
+        ----------
+        changed_onsite, changed_hoppings, optional
+            [N_onsite] and [N_bond] bool arrays of the onsite and hopping bonds whose SK integrals or geometry changed
+            since the last call, e.g. the bonds around some moved atoms. If given and the bond topology, i.e. the
+            plan, is the one of the last call, only the blocks of the changed bonds are built and the others are
+            kept. Otherwise all the blocks are built.
+        '''
+        previous = self.blocks_plan
+        self.get_plan(bonds_onsite=bonds_onsite, bonds_hoppings=bonds_hoppings, onsite_envs=onsite_envs)
+        if self.plan is not previous or changed_onsite is None or changed_hoppings is None:
+            changed_onsite, changed_hoppings = None, None
+        onsiteH, onsiteS, bonds_onsite = self.get_hs_onsite(bonds_onsite=bonds_onsite, onsite_envs=onsite_envs, changed=changed_onsite)
+        hoppingH, hoppingS, bonds_hoppings = self.get_hs_hopping(bonds_hoppings=bonds_hoppings, changed=changed_hoppings)
+        self.blocks_plan = self.plan
+        self.onsite_blocks, self.hopping_blocks = (onsiteH, onsiteS), (hoppingH, hoppingS)
+
+        self.all_bonds = self.plan.all_bonds.to(self.device)
+        self.hamil_blocks = self.merge_blocks(onsiteH, hoppingH)
         if not self.use_orthogonal_basis:
-            onsiteS.extend(hoppingS)
-            self.overlap_blocks = onsiteS
+            self.overlap_blocks = self.merge_blocks(onsiteS, hoppingS)
         if self.soc:
             self.soc_upup, self.soc_updown = self.get_soc_block(bonds_onsite=bonds_onsite)
 
         return True
 
+    def merge_blocks(self, onsite_blocks, hopping_blocks):
+        '''Merge the onsite and hopping blocks into the HRBlocks grouped by bond type, following plan.block_groups.'''
+        blocks, index = {}, {}
+        for key, group in self.plan.block_groups.items():
+            itype, jtype = key.split('-')
+            tensors = []
+            if itype == jtype and itype in onsite_blocks:
+                tensors.append(onsite_blocks[itype])
+            if key in hopping_blocks:
+                tensors.append(hopping_blocks[key])
+            blocks[key] = th.cat(tensors, dim=0) if len(tensors) > 1 else tensors[0]
+            index[key] = group["bonds"]
+
+        return HRBlocks(blocks=blocks, index=index)
+
+    def hs_block_values(self, HorS='H', time_symm=True):
+        '''The function flattens the bond blocks into the triplets of the H(R) or S(R) stack.
+
+        Parameters
+        ----------
+        HorS
+            string, 'H' or 'S' to indicate for H(R) or S(R).
+        time_symm, optional
+            if True, the bond list only contains half of the bonds, the onsite blocks are scaled by 0.5 so that
+            H(k) = H'(k) + H'(k)^dagger recovers the full matrix, defaults to True (optional)
+
+        Returns
+        -------
+            Rlatt: a [nR, 3] integer tensor of the lattice vectors.
+            indices: the flatten index of each value in the [nR, norbs, norbs] stack.
+            values: the values of the blocks, differentiable w.r.t. the bond blocks.
+        '''
+        if self.shared_values is not None:
+            if time_symm != self.shared_values["time_symm"]:
+                log.error("The shared H(R) is built with time_symm={}.".format(self.shared_values["time_symm"]))
+                raise ValueError
+            return self.shared_values[HorS]
+
+        if HorS == 'H':
+            hijAll = self.hamil_blocks
+        elif HorS == 'S':
+            hijAll = self.overlap_blocks
+        else:
+            log.error("HorS should be 'H' or 'S' !")
+            raise ValueError
+
+        if isinstance(hijAll, HRBlocks) and self.plan is not None and th.equal(self.plan.all_bonds, self.all_bonds.cpu()) \
+            and hijAll.keys() == self.plan.block_groups.keys():
+            Rlatt, block_groups = self.plan.Rlatt, self.plan.block_groups
+        else:
+            # the blocks are not built from the current plan, e.g. read from file.
+            groups = hijAll.index if isinstance(hijAll, HRBlocks) else None
+            Rlatt, block_groups = get_block_scatter(self.all_bonds, self.num_orbs_per_atom, num_onsite=len(self.num_orbs_per_atom), groups=groups)
+
+        values, indices = [], []
+        for key, group in block_groups.items():
+            if isinstance(hijAll, HRBlocks):
+                blocks = hijAll.blocks[key]
+            else:
+                blocks = th.stack([hijAll[ib] for ib in group["bonds"]])
+            if time_symm:
+                # the onsite blocks are doubled by H = H + H^dagger.
+                scale = th.where(group["onsite"], 0.5, 1.0).to(dtype=blocks.dtype, device=blocks.device)
+                blocks = blocks * scale.reshape(-1,1,1)
+            values.append(blocks.reshape(-1))
+            indices.append(group["index"])
+
+        values = th.cat(values)
+        indices = th.cat(indices).to(device=values.device)
+
+        return Rlatt, indices, values
+
+    def hs_block_R(self, HorS='H', time_symm=True):
+        '''The function scatters the bond blocks into a dense H(R) or S(R) stack, one matrix per lattice vector R.
+
+        Parameters
+        ----------
+        HorS
+            string, 'H' or 'S' to indicate for H(R) or S(R).
+        time_symm, optional
+            if True, the onsite blocks are scaled by 0.5, see ``hs_block_values``, defaults to True (optional)
+
+        Returns
+        -------
+            Rlatt: a [nR, 3] integer tensor of the lattice vectors.
+            hR: a [nR, norbs, norbs] tensor of the real space blocks, differentiable w.r.t. the bond blocks.
+        '''
+        Rlatt, indices, values = self.hs_block_values(HorS=HorS, time_symm=time_symm)
+        totalOrbs = int(np.sum(self.num_orbs_per_atom))
+        hR = th.zeros(len(Rlatt) * totalOrbs * totalOrbs, dtype=values.dtype, device=values.device)
+        hR = hR.index_add(0, indices, values).reshape(len(Rlatt), totalOrbs, totalOrbs)
+
+        return Rlatt, hR
+
     def hs_block_R2k(self, kpoints, HorS='H', time_symm=True):
         '''The function takes in a list of Hamiltonian matrices for each bond, and a list of k-points, and
         returns a list of Hamiltonian matrices for each k-point
@@ -300,95 +501,596 @@ class HamilEig(RotationSK):
             the k-points in the path.
         time_symm, optional
             if True, the Hamiltonian is time-reversal symmetric, defaults to True (optional)
-        dtype, optional
-            'tensor' or 'numpy', defaults to tensor (optional)
 
         Returns
         -------
             A list of Hamiltonian or Overlap matrices for each k-point.
         ''' 
+        Hk = self.hs_block_R2k_spinless(kpoints=kpoints, HorS=HorS, time_symm=time_symm)
+        if self.soc:
+            # S(k) is spin independent, only H(k) has the SOC blocks.
+            if HorS == 'H':
+                Hk = self.spinor_block(Hk, soc_upup=self.soc_upup, soc_updown=self.soc_updown)
+            else:
+                Hk = self.spinor_block(Hk)
 
-        numOrbs = np.array(self.num_orbs_per_atom)
-        totalOrbs = np.sum(numOrbs)
-        if HorS == 'H':
-            hijAll = self.hamil_blocks
-        elif HorS == 'S':
-            hijAll = self.overlap_blocks
+        return Hk
+
+    def spinor_block(self, Hk, soc_upup=None, soc_updown=None):
+        '''Assemble the [nk, 2*norbs, 2*norbs] spinor matrices from the spinless ones, in the up up ..., down down ...
+        order, without building kron(I_2, Hk).
+
+        The up-up block is Hk + soc_upup and the down-down block Hk + conj(soc_upup). The down-up block is
+        conj(soc_updown), the up-down block is its conjugate transpose so that the matrix is hermitian. Without the
+        SOC blocks, e.g. for S(k) or its Cholesky factor, the off-diagonal blocks are zero.
+        '''
+        nk, totalOrbs = Hk.shape[0], Hk.shape[-1]
+        Hk2 = th.zeros((nk, 2*totalOrbs, 2*totalOrbs), dtype=Hk.dtype, device=Hk.device)
+        if soc_upup is None:
+            Hk2[:, :totalOrbs, :totalOrbs] = Hk
+            Hk2[:, totalOrbs:, totalOrbs:] = Hk
         else:
-            print("HorS should be 'H' or 'S' !")
+            Hk2[:, :totalOrbs, :totalOrbs] = Hk + soc_upup.unsqueeze(0)
+            Hk2[:, totalOrbs:, totalOrbs:] = Hk + soc_upup.conj().unsqueeze(0)
+            Hk2[:, :totalOrbs, totalOrbs:] = soc_updown.transpose(0,1).unsqueeze(0)
+            Hk2[:, totalOrbs:, :totalOrbs] = soc_updown.conj().unsqueeze(0)
 
-        if self.soc:
-            Hk = th.zeros([len(kpoints), 2*totalOrbs, 2*totalOrbs], dtype = self.cdtype, device=self.device)
+        return Hk2
+
+    def hs_block_R2k_spinless(self, kpoints, HorS='H', time_symm=True, real=False):
+        '''H(k) or S(k) of the spinless orbitals, without the SOC blocks. See ``hs_block_R2k``.
+
+        With real=True the kpoints must be real k-points, see ``get_real_kmask``, and H(k) is returned as a real
+        symmetric tensor of dtype instead of cdtype.
+        '''
+        Rlatt, hR = self.hs_block_R(HorS=HorS, time_symm=time_symm)
+        totalOrbs = hR.shape[-1]
+
+        Hk = self.get_fft_hk(kpoints, Rlatt, hR, HorS=HorS, time_symm=time_symm)
+        if Hk is not None:
+            Hk = Hk.real.to(self.dtype) if real else Hk
+            return Hk + Hk.transpose(1,2).conj() if time_symm else Hk
+
+        # H(k) = \sum_R exp(-i2\pi k.R) H(R), done as one [nk, nR] x [nR, norbs*norbs] contraction.
+        kpoints = th.as_tensor(np.asarray(kpoints), dtype=th.float64, device=hR.device).reshape(-1,3)
+        kR = kpoints @ Rlatt.to(device=hR.device, dtype=th.float64).T
+        if real:
+            # k.R is a multiple of 1/2, the phases are exactly +-1.
+            phase = th.cos(2 * np.pi * kR).round().to(self.dtype)
+            Hk = (phase @ hR.reshape(len(Rlatt), -1).to(self.dtype)).reshape(-1, totalOrbs, totalOrbs)
+        else:
+            phase = th.exp(-1j * 2 * np.pi * kR).to(self.cdtype)
+            Hk = (phase @ hR.reshape(len(Rlatt), -1).to(self.cdtype)).reshape(-1, totalOrbs, totalOrbs)
+
+        if time_symm:
+            Hk = Hk + Hk.transpose(1,2).conj()
+
+        return Hk
+
+    def set_fft_mesh(self, meshgrid=None, max_memory=None):
+        '''Serve H(k) and S(k) of the k-points on the regular mesh of size meshgrid by FFT, see ``FFTHR``.
+
+        The H(k) of the whole mesh is built once per structure by one FFT, and the k-points of the mesh, e.g. the
+        chunks of a DOS or a Fermi surface mesh, are gathered from it. The k-points off the mesh, the H(R) with
+        gradients, the H(R) with fewer lattice vectors than log2 of the mesh size, for which the phase sum is cheaper,
+        and the meshes whose H(k) exceeds max_memory in GB keep the explicit phase sum.
+
+        Parameters
+        ----------
+        meshgrid, optional
+            [N1, N2, N3] the size of the mesh, None to turn the FFT off.
+        max_memory, optional
+            the memory limit in GB of the H(k) of the mesh, defaults to no limit.
+        '''
+        self.fft_mesh = None if meshgrid is None else [int(n) for n in meshgrid]
+        self.fft_max_memory = max_memory
+        self.fft_cache = {}
+
+    def get_fft_hk(self, kpoints, Rlatt, hR, HorS='H', time_symm=True):
+        '''The H(k) before the time symmetrization at kpoints from the FFT of the mesh set by ``set_fft_mesh``, or
+        None if the explicit phase sum is needed.'''
+        if self.fft_mesh is None or hR.requires_grad:
+            return None
+        # the FFT costs log2(nk) per k-point and orbital pair against nR for the phase sum.
+        if len(Rlatt) < np.log2(np.prod(self.fft_mesh)):
+            return None
+        shift, index = kmesh_index(kpoints, self.fft_mesh)
+        if shift is None:
+            return None
+        if self.fft_max_memory is not None and \
+            FFTHR.nbytes(self.fft_mesh, hR.shape[-1], self.cdtype) > self.fft_max_memory * 1024**3:
+            log.debug(f'The H(k) of the mesh {self.fft_mesh} exceeds the memory limit, the phase sum is used.')
+            return None
+
+        key = (HorS, time_symm, shift)
+        cache = self.fft_cache.get(key, None)
+        if cache is None or not (th.equal(cache["Rlatt"], Rlatt) and th.equal(cache["hR"], hR)):
+            cache = {"Rlatt": Rlatt, "hR": hR, "fft": FFTHR(Rlatt, hR, self.fft_mesh, shift=shift, cdtype=self.cdtype)}
+            # one mesh per H or S, the former structure is dropped.
+            self.fft_cache = {k: v for k, v in self.fft_cache.items() if k[0] != HorS}
+            self.fft_cache[key] = cache
+
+        return cache["fft"].Rk(index)
+
+    def hs_block_R2k_deriv(self, kpoints, HorS='H', time_symm=True, cell=None):
+        '''The derivatives dH(k)/dk or dS(k)/dk, by the same Fourier sum as ``hs_block_R2k`` with the weights -iR.
+
+        dH(k)/dk_a = \\sum_R (-i R_a) exp(-i2\\pi k.R) H(R). The SOC blocks do not depend on k, with SOC the spinor
+        derivative is block diagonal.
+
+        Parameters
+        ----------
+        kpoints
+            the k-points in fractional coordinates.
+        HorS
+            string, 'H' or 'S'.
+        time_symm, optional
+            if True, dH(k)/dk = dH'(k)/dk + dH'(k)/dk^dagger, defaults to True (optional)
+        cell, optional
+            the [3, 3] lattice vectors in Angstrom, as rows. With the cell the derivatives are w.r.t. the cartesian k in
+            1/Angstrom, e.g. dH/dk in unit*Angstrom, otherwise w.r.t. the fractional k, with R_a replaced by 2\\pi R_a.
+
+        Returns
+        -------
+            a [3, nk, norbs, norbs] tensor in cdtype, [3, nk, 2*norbs, 2*norbs] with SOC.
+        '''
+        Rlatt, hR = self.hs_block_R(HorS=HorS, time_symm=time_symm)
+        totalOrbs = hR.shape[-1]
+        Rlatt = Rlatt.to(device=hR.device, dtype=th.float64)
+        kpoints = th.as_tensor(np.asarray(kpoints), dtype=th.float64, device=hR.device).reshape(-1,3)
+        if cell is None:
+            Rvec = 2 * np.pi * Rlatt
         else:
-            Hk = th.zeros([len(kpoints), totalOrbs, totalOrbs], dtype = self.cdtype, device=self.device)
+            Rvec = Rlatt @ th.as_tensor(np.asarray(cell), dtype=th.float64, device=hR.device).reshape(3,3)
 
+        phase = th.exp(-1j * 2 * np.pi * (kpoints @ Rlatt.T))
+        # [3, nk, nR] x [nR, norbs*norbs], one contraction for the three directions.
+        phase = (phase.unsqueeze(0) * (-1j * Rvec.T).unsqueeze(1)).to(self.cdtype)
+        dHk = (phase @ hR.reshape(len(Rlatt), -1).to(self.cdtype)).reshape(3, -1, totalOrbs, totalOrbs)
+        if time_symm:
+            dHk = dHk + dHk.transpose(2,3).conj()
+        if self.soc:
+            dHk = th.stack([self.spinor_block(dHk[ia]) for ia in range(3)])
+
+        return dHk
+
+    def Eigenvalues_velocity(self, kpoints, time_symm=True, unit="Hartree", cell=None):
+        '''The eigenvalues and the band velocities dE_n/dk at kpoints, from one diagonalization per k-point.
+
+        By the Hellmann-Feynman theorem dE_n/dk = <n| dH/dk - E_n dS/dk |n> with the S-normalized eigenvectors, and
+        dH/dk, dS/dk from ``hs_block_R2k_deriv``, instead of the finite differences of the eigenvalues at the
+        neighbouring k-points. Within a degenerate multiplet the velocities are the eigenvalues of the same operator
+        projected on the multiplet, independent of the basis of the multiplet.
+
+        Parameters
+        ----------
+        kpoints
+            the k-points in fractional coordinates.
+        time_symm, unit, optional
+            see ``Eigenvalues``.
+        cell, optional
+            the [3, 3] lattice vectors in Angstrom, see ``hs_block_R2k_deriv``.
+
+        Returns
+        -------
+            eigks: [nk, norbs] eigenvalues in eV.
+            velocity: [nk, norbs, 3] dE_n/dk in eV*Angstrom with the cell, i.e. hbar times the group velocity, or in
+                eV per unit of the fractional k without the cell.
+        '''
+        factor = self.get_unit_factor(unit)
+        kpoints = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
+        Heff = self._get_Heff(kpoints, time_symm=time_symm, real=False)
+        eigks, eigvec = th.linalg.eigh(Heff)
+        dHk = self.hs_block_R2k_deriv(kpoints, HorS='H', time_symm=time_symm, cell=cell)
+        if not self.use_orthogonal_basis:
+            # the eigenvectors of H x = E S x are L^-dagger times the ones of Heff.
+            chklowt = self.get_overlap_factor(kpoints=kpoints, time_symm=time_symm, real=False)
+            eigvec = th.linalg.solve_triangular(chklowt.transpose(1,2).conj(), eigvec, upper=True)
+            dSk = self.hs_block_R2k_deriv(kpoints, HorS='S', time_symm=time_symm, cell=cell)
+
+        # [3, nk, nband, nband] matrix elements of dE/dk between the bands, only the multiplets need the off diagonal.
+        dE = eigvec.transpose(1,2).conj().unsqueeze(0) @ dHk @ eigvec.unsqueeze(0)
+        if not self.use_orthogonal_basis:
+            dS = eigvec.transpose(1,2).conj().unsqueeze(0) @ dSk @ eigvec.unsqueeze(0)
+            dE = dE - 0.5 * (eigks.unsqueeze(-1) + eigks.unsqueeze(-2)).unsqueeze(0).to(dS.dtype) * dS
+        velocity = th.diagonal(dE, dim1=-2, dim2=-1).real.clone()
+
+        tol = DEGENERACY_EPS_FACTOR * th.finfo(eigks.dtype).eps * max(1.0, eigks.abs().max().item())
         for ik in range(len(kpoints)):
-            k = kpoints[ik]
-            hk = th.zeros([totalOrbs,totalOrbs],dtype = self.cdtype, device=self.device)
-            for ib in range(len(self.all_bonds)):
-                Rlatt = self.all_bonds[ib,4:7].int()
-                i = self.all_bonds[ib,1].int()
-                j = self.all_bonds[ib,3].int()
-                ist = int(np.sum(numOrbs[0:i]))
-                ied = int(np.sum(numOrbs[0:i+1]))
-                jst = int(np.sum(numOrbs[0:j]))
-                jed = int(np.sum(numOrbs[0:j+1]))
-                if ib < len(numOrbs): 
-                    """
-                    len(numOrbs)= numatoms. the first numatoms are onsite energies.
-                    if turn on timeSymm when generating the bond list <i,j>. only i>= or <= j are included. 
-                    if turn off timeSymm when generating the bond list <i,j>. all the i j are included.
-                    for case 1, H = H+H^\dagger to get the full matrix, the the onsite one is doubled.
-                    for case 2. no need to do H = H+H^dagger. since the matrix is already full.
-                    """
-                    if time_symm:
-                        hk[ist:ied,jst:jed] += 0.5 * hijAll[ib] * np.exp(-1j * 2 * np.pi* np.dot(k,Rlatt))
-                    else:
-                        hk[ist:ied,jst:jed] += hijAll[ib] * np.exp(-1j * 2 * np.pi* np.dot(k,Rlatt)) 
-                else:
-                    hk[ist:ied,jst:jed] += hijAll[ib] * np.exp(-1j * 2 * np.pi* np.dot(k,Rlatt)) 
-            if time_symm:
-                hk = hk + hk.T.conj()
-            if self.soc:
-                hk = torch.kron(input=torch.eye(2, device=self.device, dtype=self.dtype), other=hk)
-            Hk[ik] = hk
-        
+            start = np.concatenate([[0], np.where((eigks[ik, 1:] - eigks[ik, :-1]).cpu().numpy() > tol)[0] + 1, [eigks.shape[1]]])
+            for ist, ied in zip(start[:-1], start[1:]):
+                if ied - ist > 1:
+                    velocity[:, ik, ist:ied] = th.linalg.eigvalsh(dE[:, ik, ist:ied, ist:ied])
+
+        return eigks * factor, velocity.permute(1, 2, 0) * factor
+
+    def get_real_kmask(self, kpoints):
+        '''The k-points where H(k) and S(k) are real: Gamma and the other time reversal invariant momenta, where 2k is
+        a reciprocal lattice vector, so that exp(-i2\\pi k.R) = +-1 for all R. The SOC blocks are complex, there is no
+        real k-point with SOC.
+
+        Returns
+        -------
+            a [nk] bool numpy array.
+        '''
+        kpoints = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
         if self.soc:
-            Hk[:, :totalOrbs, :totalOrbs] += self.soc_upup.unsqueeze(0)
-            Hk[:, totalOrbs:, totalOrbs:] += self.soc_upup.conj().unsqueeze(0)
-            Hk[:, :totalOrbs, totalOrbs:] += self.soc_updown.unsqueeze(0)
-            Hk[:, totalOrbs:, :totalOrbs] += self.soc_updown.conj().unsqueeze(0)
-        
-        Hk.contiguous()
-            
-        return Hk
+            return np.zeros(len(kpoints), dtype=bool)
+        return np.all(np.abs(2 * kpoints - np.round(2 * kpoints)) < REAL_KPOINT_TOL, axis=1)
+
+    def get_overlap_factor(self, kpoints, time_symm=True, real=False):
+        '''The Cholesky factor L of S(k) = L L^dagger at kpoints, real at the real k-points with real=True.
+
+        The factor is cached by the k-points and the S(R) values. When the overlaps are fixed, e.g. read from the
+        SK files by ``SKIntegrals``, the repeated calls on the same structure and k-points skip the assembly and the
+        factorization of S(k). The overlaps with gradients are always recomputed.
+
+        Returns
+        -------
+            a [nk, norbs, norbs] lower triangular tensor, [nk, 2*norbs, 2*norbs] with SOC.
+        '''
+        Rlatt, indices, values = self.hs_block_values(HorS='S', time_symm=time_symm)
+        kpts = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
+        key = (kpts.tobytes(), time_symm, self.soc, real, tuple(self.num_orbs_per_atom))
+        use_cache = not values.requires_grad
+        if use_cache and key in self.overlap_cache:
+            cache = self.overlap_cache[key]
+            if th.equal(cache["Rlatt"], Rlatt) and th.equal(cache["indices"], indices) and th.equal(cache["values"], values):
+                return cache["factor"]
+
+        chklowt = th.linalg.cholesky(self.hs_block_R2k_spinless(kpoints=kpts, HorS='S', time_symm=time_symm, real=real))
+        if self.soc:
+            # the spinor S(k) is block diagonal, so is its factor.
+            chklowt = self.spinor_block(chklowt)
 
-    def Eigenvalues(self, kpoints, time_symm=True, unit="Hartree",if_eigvec=False):
+        if use_cache:
+            if key not in self.overlap_cache and len(self.overlap_cache) >= self.overlap_cache_size:
+                self.overlap_cache.pop(next(iter(self.overlap_cache)))
+            self.overlap_cache[key] = {"Rlatt": Rlatt, "indices": indices, "values": values, "factor": chklowt}
+
+        return chklowt
+
+    def Eigenvalues(self, kpoints, time_symm=True, unit="Hartree",if_eigvec=False, driver="auto", band_window=None, energy_window=None):
         """ using the tight-binding H and S matrix calculate eigenvalues at kpoints.
         
         Args:
             kpoints: the k-kpoints used to calculate the eigenvalues.
+            driver: the dense eigen solver in ``dense_solvers``, or 'auto' to select by the size and the need of
+                eigenvectors and gradients.
+            band_window: [band_min, band_max], only solve the bands band_min <= n < band_max.
+            energy_window: [emin, emax] in eV, only solve the bands in the window, padded with NaN.
         Note: must have the BondHBlock and BondSBlock 
+
+        At Gamma and the other real k-points, see ``get_real_kmask``, H(k) and S(k) are assembled as real symmetric
+        matrices and solved by the real solver, the eigenvectors are returned in cdtype as the others.
         """
-        hkmat = self.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=time_symm)
-        if not self.use_orthogonal_basis:
-            skmat =  self.hs_block_R2k(kpoints=kpoints, HorS='S', time_symm=time_symm)
+        real_mask, Heff = self.get_Heff(kpoints, time_symm=time_symm)
+        eigks, eigvec = self.solve_Heff(real_mask, [Heff], unit=unit, if_eigvec=if_eigvec, driver=driver,
+                                        band_window=band_window, energy_window=energy_window)
+        
+        if if_eigvec:
+            return eigks[0], eigvec[0]
         else:
-            skmat = torch.eye(hkmat.shape[1], dtype=self.cdtype).unsqueeze(0).repeat(hkmat.shape[0], 1, 1)
+            return eigks[0], None
 
-        if self.use_orthogonal_basis:
-            Heff = hkmat
+    def get_Heff(self, kpoints, time_symm=True):
+        '''Heff = L^-1 H(k) L^-dagger with S(k) = L L^dagger, or H(k) for the orthogonal basis, of the current structure.
+
+        Returns
+        -------
+            real_mask: [nk] bool numpy array of the real k-points, see ``get_real_kmask``.
+            Heff: dict {real: Heff}, the real tensor of the real k-points under True and the complex one of the other
+                k-points under False, the empty groups are absent.
+        '''
+        kpoints = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
+        real_mask = self.get_real_kmask(kpoints)
+        Heff = {}
+        for real in [False, True]:
+            if (real_mask == real).any():
+                Heff[real] = self._get_Heff(kpoints[real_mask == real], time_symm=time_symm, real=real)
+
+        return real_mask, Heff
+
+    def _get_Heff(self, kpoints, time_symm=True, real=False):
+        if real:
+            hkmat = self.hs_block_R2k_spinless(kpoints=kpoints, HorS='H', time_symm=time_symm, real=True)
         else:
-            chklowt = th.linalg.cholesky(skmat)
-            chklowtinv = th.linalg.inv(chklowt)
-            Heff = (chklowtinv @ hkmat @ th.transpose(chklowtinv,dim0=1,dim1=2).conj())
+            hkmat = self.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=time_symm)
+
+        if self.use_orthogonal_basis:
+            return hkmat
+        # Heff = L^-1 H L^-dagger with S = L L^dagger, by two triangular solves.
+        chklowt = self.get_overlap_factor(kpoints=kpoints, time_symm=time_symm, real=real)
+        Heff = th.linalg.solve_triangular(chklowt, hkmat, upper=False)
+        Heff = th.linalg.solve_triangular(chklowt, Heff.transpose(1,2).conj(), upper=False)
+
+        return Heff
+
+    def solve_Heff(self, real_mask, Heffs, unit="Hartree", if_eigvec=False, driver="auto", band_window=None, energy_window=None):
+        '''Solve the Heff of a batch of structures on the same k-points, given by ``get_Heff``, with one call of the
+        dense solver for the real k-points of all the structures and one for the other k-points.
+
+        The structures of a batch, e.g. the frames of a trajectory, usually have the same number of orbitals. If not,
+        the smaller Heff are padded by a diagonal above their spectrum, and the bands beyond the size of each
+        structure are NaN.
+
+        Parameters
+        ----------
+        real_mask
+            [nk] bool array of the real k-points, the same for all the structures.
+        Heffs
+            list of the Heff dicts of ``get_Heff``, one per structure.
+        unit, if_eigvec, driver, band_window, energy_window
+            see ``Eigenvalues``.
+
+        Returns
+        -------
+            eigks: [nstruct, nk, nband] eigenvalues in eV.
+            eigvec: [nstruct, nk, norbs, nband] eigenvectors in cdtype, or None.
+        '''
         # the factor 13.605662285137 * 2 from Hartree to eV.
-        # eigks = th.linalg.eigvalsh(Heff) * 13.605662285137 * 2
+        factor = self.get_unit_factor(unit)
+        if energy_window is not None:
+            energy_window = [energy_window[0] / factor, energy_window[1] / factor]
+
+        nstruct = len(Heffs)
+        sizes = [next(iter(Heff.values())).shape[-1] for Heff in Heffs]
+        size = max(sizes)
+        groups = []
+        for real in [False, True]:
+            if real not in Heffs[0]:
+                continue
+            batch = [Heff[real] for Heff in Heffs]
+            if min(sizes) < size:
+                # the padded levels are above the spectrum, the Frobenius norm bounds the eigenvalues.
+                shift = max([float(th.linalg.matrix_norm(hk.detach()).max()) for hk in batch]) + 1.0
+                batch = [self._pad_matrix(hk, size, shift) for hk in batch]
+            nkg = batch[0].shape[0]
+            Heff = th.cat(batch) if nstruct > 1 else batch[0]
+            used, eigks, eigvec = dense_eigh(Heff, driver=driver, if_eigvec=if_eigvec, band_window=band_window, energy_window=energy_window)
+            if used != self.eig_driver:
+                log.info(f"The dense eigen solver {used} is used for the matrix size {Heff.shape[-1]}.")
+                self.eig_driver = used
+            eigks = eigks.reshape(nstruct, nkg, -1)
+            if if_eigvec:
+                eigvec = eigvec.to(self.cdtype).reshape(nstruct, nkg, size, -1)
+            groups.append((real_mask == real, eigks, eigvec))
+
+        if min(sizes) < size:
+            band_min = 0 if band_window is None else band_window[0]
+            nband = groups[0][1].shape[-1]
+            for _, eigks, _ in groups:
+                for ii, norbs in enumerate(sizes):
+                    if norbs - band_min < nband:
+                        eigks[ii, :, max(norbs - band_min, 0):] = np.nan
+
+        if len(groups) == 1:
+            _, eigks, eigvec = groups[0]
+        else:
+            # put the two sets back in the order of kpoints, the energy window may give different numbers of bands.
+            nband = max([eigks.shape[-1] for _, eigks, _ in groups])
+            order = th.as_tensor(np.argsort(np.concatenate([np.where(mask)[0] for mask, _, _ in groups]), kind='stable'),
+                                 device=groups[0][1].device)
+            eigks = th.cat([self._pad_bands(eigks, nband, np.nan) for _, eigks, _ in groups], dim=1)[:, order]
+            if if_eigvec:
+                eigvec = th.cat([self._pad_bands(eigvec, nband, 0.0) for _, _, eigvec in groups], dim=1)[:, order]
+
+        eigks = eigks * factor
+
         if if_eigvec:
-            eigks, eigvec = th.linalg.eigh(Heff)
+            return eigks, eigvec
         else:
-            eigks = th.linalg.eigvalsh(Heff)
-        
+            return eigks, None
+
+    @staticmethod
+    def _pad_matrix(Heff, size, shift):
+        '''Pad the [nk, n, n] Heff to [nk, size, size] with shift on the padded diagonal.'''
+        n = Heff.shape[-1]
+        Heff = th.nn.functional.pad(Heff, (0, size - n, 0, size - n))
+        diag = th.zeros(size, dtype=Heff.real.dtype, device=Heff.device)
+        diag[n:] = shift
+        return Heff + th.diag_embed(diag).to(Heff.dtype).unsqueeze(0)
+
+    @staticmethod
+    def _pad_bands(tensor, nband, value):
+        '''Pad the last dimension of the eigenvalues or eigenvectors to nband.'''
+        if tensor.shape[-1] == nband:
+            return tensor
+        return th.nn.functional.pad(tensor, (0, nband - tensor.shape[-1]), value=value)
+
+    def Eigenvalues_sparse(self, kpoints, time_symm=True, unit="Hartree", if_eigvec=False, **solver_options):
+        """ calculate a window of the eigenvalues at kpoints with the sparse H(k) and S(k) and an iterative solver.
+
+        Parameters
+        ----------
+        kpoints
+            the k-points.
+        solver_options
+            the options of ``sparse_eigh``: method, band_window, energy_window, sigma, num_bands, tol, maxiter.
+            The energy window and sigma are in eV. With warm_start, the kpoints are taken as a path and each k-point
+            is seeded by the eigenvectors of the previous one, see ``sparse_eigh_path``, only with the band_window.
+
+        Returns
+        -------
+            eigks: [nk, nband] numpy array of the eigenvalues in the window. With the energy window the number of bands
+                differs between k-points, the missing ones are padded with NaN.
+            eigvec: [nk, norbs, nband] numpy array of the S-orthonormal eigenvectors, or None.
+        """
+        factor = self.get_unit_factor(unit)
+        solver_options = dict(solver_options)
+        for key in ['energy_window', 'sigma']:
+            if solver_options.get(key, None) is not None:
+                solver_options[key] = np.asarray(solver_options[key], dtype=np.float64) / factor
+
+        warm_start = solver_options.pop('warm_start', False)
+        sparse_hr = self.get_sparse_hr(HorS='H', time_symm=time_symm)
+        if not self.use_orthogonal_basis:
+            sparse_sr = self.get_sparse_hr(HorS='S', time_symm=time_symm)
+
+        kpoints = np.asarray(kpoints).reshape(-1,3)
+        if warm_start:
+            if solver_options.get('band_window', None) is None:
+                log.error("The warm started sparse eigen solver needs the band_window.")
+                raise ValueError
+            hks = (sparse_hr.Rk(kp) for kp in kpoints)
+            sks = None if self.use_orthogonal_basis else (sparse_sr.Rk(kp) for kp in kpoints)
+            eigks, eigvecs = sparse_eigh_path(hks, sks, kpoints=kpoints, band_window=solver_options['band_window'],
+                                              method=solver_options.get('method', 'shift-invert'), tol=solver_options.get('tol', 0),
+                                              maxiter=solver_options.get('maxiter', None), if_eigvec=if_eigvec)
+            eigks = [eigs * factor for eigs in eigks]
+        else:
+            eigks, eigvecs = [], []
+            for kp in kpoints:
+                hk = sparse_hr.Rk(kp)
+                sk = None if self.use_orthogonal_basis else sparse_sr.Rk(kp)
+                eigs, eigvec = sparse_eigh(hk, sk, if_eigvec=if_eigvec, **solver_options)
+                eigks.append(eigs * factor)
+                eigvecs.append(eigvec)
+
+        nband = max([len(eigs) for eigs in eigks])
+        eigout = np.full((len(eigks), nband), np.nan)
+        for ik, eigs in enumerate(eigks):
+            eigout[ik,:len(eigs)] = eigs
+        if if_eigvec:
+            vecout = np.zeros((len(eigks), sparse_hr.size, nband), dtype=np.complex128)
+            for ik, eigvec in enumerate(eigvecs):
+                vecout[ik,:,:eigvec.shape[1]] = eigvec
+            return eigout, vecout
+        else:
+            return eigout, None
+
+    def get_sparse_hr(self, HorS='H', time_symm=True):
+        '''The H(R) or S(R) as ``SparseHR``, for the assembly of the sparse H(k) or S(k).'''
+        Rlatt, indices, values = self.hs_block_values(HorS=HorS, time_symm=time_symm)
+        soc_upup, soc_updown = None, None
+        if self.soc and HorS == 'H':
+            soc_upup, soc_updown = self.soc_upup.detach().cpu().numpy(), self.soc_updown.detach().cpu().numpy()
+        elif self.soc:
+            # S(k) is spin independent, the spinor S(k) is kron(I_2, S(k)).
+            soc_upup = soc_updown = np.zeros((1,1))
+
+        return SparseHR(Rlatt=Rlatt.cpu().numpy(), index=indices.cpu().numpy(), values=values.detach().cpu().numpy(),
+                        norbs=int(np.sum(self.num_orbs_per_atom)), time_symm=time_symm, soc_upup=soc_upup, soc_updown=soc_updown)
+
+    def get_sparse_velocity(self, positions, cell, time_symm=True):
+        '''The velocity operators hbar*V_a = i[H, X_a] of the real space H(R) as ``SparseHR``, for the Kubo conductivity.
+
+        The matrix element of i[H, X_a] between the orbital i of the home cell and the orbital j of the cell R is
+        i d_a H(R)_ij, with d = r_j + R.cell - r_i the bond vector. Unlike ``hs_block_R2k_deriv`` the bond vector contains
+        the positions of the atoms, the operator is the velocity of the electrons in the supercell and not only the
+        derivative of the Bloch sum. The SOC blocks are onsite and commute with X, with SOC the operators are kron(I_2, V).
+
+        Parameters
+        ----------
+        positions
+            [natom, 3] the positions of the atoms in Angstrom.
+        cell
+            [3, 3] the lattice vectors in Angstrom, as rows.
+        time_symm, optional
+            see ``get_sparse_hr``.
+
+        Returns
+        -------
+            the list of the 3 ``SparseHR`` of hbar*V_x, hbar*V_y, hbar*V_z in unit*Angstrom.
+        '''
+        Rlatt, indices, values = self.hs_block_values(HorS='H', time_symm=time_symm)
+        Rlatt, indices, values = Rlatt.cpu().numpy(), indices.cpu().numpy(), values.detach().cpu().numpy()
+        norbs = int(np.sum(self.num_orbs_per_atom))
+        orbital_positions = np.repeat(np.asarray(positions, dtype=np.float64), self.num_orbs_per_atom, axis=0)
+        row, col = indices % (norbs * norbs) // norbs, indices % norbs
+        bond_vectors = orbital_positions[col] + np.asarray(Rlatt, dtype=np.float64)[indices // (norbs * norbs)] @ np.asarray(cell) \
+            - orbital_positions[row]
+        soc_blocks = np.zeros((1,1)) if self.soc else None
+
+        return [SparseHR(Rlatt=Rlatt, index=indices, values=1j * bond_vectors[:, idir] * values, norbs=norbs, time_symm=time_symm,
+                         soc_upup=soc_blocks, soc_updown=soc_blocks) for idir in range(3)]
+
+    def get_state(self, time_symm=True, share_memory=False):
+        '''The H(R) and S(R) triplets and the SOC blocks of the current structure, from which ``load_state`` builds the
+        same H(k), S(k) and eigenvalues without the bond blocks.
+
+        Without share_memory the tensors keep their device and their graph, e.g. to recompute H(k) from the H(R) of
+        a structure in the backward of the k-chunks of the training. With share_memory they are detached and moved to
+        shared memory, for the worker processes, see ``get_shared_state``.
+
+        Returns
+        -------
+            a dict of the tensors and the flags of the Hamiltonian.
+        '''
+        def keep(tensor):
+            return tensor.detach().cpu().contiguous().share_memory_() if share_memory else tensor
+
+        state = {"time_symm": time_symm, "dtype": self.dtype, "soc": self.soc, "use_orthogonal_basis": self.use_orthogonal_basis,
+                 "num_orbs_per_atom": list(self.num_orbs_per_atom)}
+        HorS_list = ['H'] if self.use_orthogonal_basis else ['H', 'S']
+        for HorS in HorS_list:
+            Rlatt, indices, values = self.hs_block_values(HorS=HorS, time_symm=time_symm)
+            state[HorS] = tuple(keep(tensor) for tensor in [Rlatt, indices, values])
+        if self.soc:
+            state["soc_upup"] = keep(self.soc_upup)
+            state["soc_updown"] = keep(self.soc_updown)
+
+        return state
+
+    def get_shared_state(self, time_symm=True):
+        '''The H(R) and S(R) triplets and the SOC blocks moved to shared memory, to build the same H(k) and S(k) in
+        the worker processes by ``from_shared_state`` without copying the H(R).
+
+        Returns
+        -------
+            a dict of the tensors and the flags of the Hamiltonian, picklable by torch.multiprocessing.
+        '''
+        return self.get_state(time_symm=time_symm, share_memory=True)
+
+    def load_state(self, state):
+        '''Serve H(k), S(k) and the eigenvalues from the state of ``get_state``, instead of the bond blocks.'''
+        self.soc = state["soc"]
+        self.use_orthogonal_basis = state["use_orthogonal_basis"]
+        self.num_orbs_per_atom = state["num_orbs_per_atom"]
+        self.shared_values = {key: state[key] for key in ["time_symm", "H", "S"] if key in state}
+        if self.soc:
+            self.soc_upup, self.soc_updown = state["soc_upup"], state["soc_updown"]
+
+    @classmethod
+    def from_shared_state(cls, state):
+        '''Build a HamilEig from the state of ``get_shared_state``, which only serves H(k), S(k) and the eigenvalues.'''
+        hamileig = cls(dtype=state["dtype"], device='cpu')
+        hamileig.load_state(state)
+
+        return hamileig
+
+    def solve_eigenvalues(self, kpoints, time_symm=True, unit="Hartree", if_eigvec=False, eig_solver=None):
+        '''The eigenvalues at kpoints without gradients, by the solver given by the ``eig_solver`` options of a task.
+
+        ``{"type": "dense", "driver": ...}`` selects the dense solver backend, see ``Eigenvalues``. With
+        ``{"type": "sparse", ...}`` the sparse H(k) and an iterative solver are used, see ``Eigenvalues_sparse``.
+        Both accept a band_window or an energy_window to solve only a part of the bands.
+
+        Returns
+        -------
+            eigks: [nk, nband] numpy array of the eigenvalues in eV.
+            eigvec: [nk, norbs, nband] numpy array of the eigenvectors, or None.
+        '''
+        solver_options = dict(eig_solver) if eig_solver is not None else {}
+        solver_type = solver_options.pop("type", "dense")
+        if solver_type == "sparse":
+            return self.Eigenvalues_sparse(kpoints, time_symm=time_symm, unit=unit, if_eigvec=if_eigvec, **solver_options)
+
+        # no gradient is needed here, which allows the LAPACK subset drivers.
+        with th.no_grad():
+            eigks, eigvec = self.Eigenvalues(kpoints, time_symm=time_symm, unit=unit, if_eigvec=if_eigvec,
+                                             driver=solver_options.get("driver", "auto"),
+                                             band_window=solver_options.get("band_window", None),
+                                             energy_window=solver_options.get("energy_window", None))
+        eigks = eigks.detach().numpy()
+        if if_eigvec:
+            return eigks, eigvec.detach().numpy()
+        else:
+            return eigks, None
+
+    @staticmethod
+    def get_unit_factor(unit):
+        '''The factor from the unit of the model to eV.'''
         if unit == "Hartree":
             factor = 13.605662285137 * 2
         elif unit == "eV":
@@ -398,17 +1100,4 @@ class HamilEig(RotationSK):
         else:
             log.error("The unit name is not correct !")
             raise ValueError
-        eigks = eigks * factor
-        # Qres = Q.detach()
-        # else:
-        #     chklowt = np.linalg.cholesky(skmat)
-        #     chklowtinv = np.linalg.inv(chklowt)
-        #     Heff = (chklowtinv @ hkmat @ np.transpose(chklowtinv,(0,2,1)).conj())
-        #     eigks = np.linalg.eigvalsh(Heff) * 13.605662285137 * 2
-        #     Qres = 0
-        
-        if if_eigvec:
-            return eigks, eigvec
-        else:
-            return eigks, None
-
+        return factor
@@ -0,0 +1,314 @@
+import torch as th
+import numpy as np
+import logging
+import re
+from dptb.utils.constants import anglrMId
+
+log = logging.getLogger(__name__)
+
+# the tolerance of the bond lengths, in Angstrom, and of the direction cosines of the bonds of one class.
+BOND_CLASS_TOL = 1e-6
+# the bonds are only evaluated per class if there are at most this fraction as many classes as bonds.
+BOND_CLASS_MAX_FRACTION = 0.5
+
+class HamilPlan(object):
+    """ The assembly plan of the SK Hamiltonian blocks for a fixed structure topology.
+
+    Everything in the plan only depends on the bond list and the basis: the shell parsing, the index map lookups,
+    the shell offsets inside the blocks, the sign factors of the SK rotation and the orbital offsets of each atom.
+    It is built once per ``BaseStruct`` and stored as ``struct.hamil_plan``, so that ``HamilEig`` only runs tensor
+    index operations at each step.
+
+    Parameters
+    ----------
+    struct
+        the ``BaseStruct`` object.
+    bonds_onsite
+        the onsite bond list, [N_onsite, >=7], with columns [itype, i, itype, i, 0, 0, 0, ...].
+    bonds_hoppings
+        the hopping bond list, [N_bond, >=7], with columns [itype, i, jtype, j, Rx, Ry, Rz, ...].
+    onsite_envs, optional
+        the onsite environment list used in strain mode, [N_env, >=7].
+    """
+    def __init__(self, struct, bonds_onsite, bonds_hoppings, onsite_envs=None) -> None:
+        self.key = self.get_key(bonds_onsite, bonds_hoppings, onsite_envs)
+        self.num_onsite = len(self.key[0])
+        self.num_hopping = len(self.key[1])
+
+        self.num_orbs_per_atom = np.array([struct.proj_atomtype_norbs[itype] for itype in struct.proj_atom_symbols], dtype=int)
+        self.orb_offsets = np.concatenate([[0], np.cumsum(self.num_orbs_per_atom)]).astype(int)
+        self.total_orbs = int(self.orb_offsets[-1])
+
+        self.basis = self.get_basis(struct)
+        # shells of each atom type: (shell name, shell symbol, l, number of orbitals, offset in the atom block).
+        self.shells = {}
+        for itype in struct.proj_atomtype:
+            ist = 0
+            self.shells[itype] = []
+            for ish in struct.proj_atom_anglr_m[itype]:
+                ishsymbol = ''.join(re.findall(r'[A-Za-z]',ish))
+                shidi = anglrMId[ishsymbol]
+                norbi = 2*shidi + 1
+                self.shells[itype].append((ish, ishsymbol, shidi, norbi, ist))
+                ist = ist + norbi
+
+        self._build_onsite(struct)
+        self._build_hopping(struct)
+        if onsite_envs is not None:
+            self._build_strain(struct)
+        else:
+            self.strain_groups = None
+        self._build_scatter(struct)
+
+    @staticmethod
+    def get_key(bonds_onsite, bonds_hoppings, onsite_envs=None):
+        '''The integer part of the bond lists, which determines the plan.'''
+        key = [th.as_tensor(bonds_onsite)[:,0:7].int().cpu(), th.as_tensor(bonds_hoppings)[:,0:7].int().cpu()]
+        if onsite_envs is not None:
+            key.append(th.as_tensor(onsite_envs)[:,0:7].int().cpu())
+        else:
+            key.append(None)
+        return tuple(key)
+
+    @staticmethod
+    def get_basis(struct):
+        '''The orbitals of each atom type of the structure.'''
+        return {itype: list(struct.proj_atom_anglr_m[itype]) for itype in struct.proj_atomtype}
+
+    def match(self, bonds_onsite, bonds_hoppings, onsite_envs=None, struct=None):
+        '''Check whether the plan is built from the same topology as the given bond lists, and from the same basis as
+        struct if given, e.g. to share the plan between the frames of a trajectory.'''
+        if struct is not None and self.get_basis(struct) != self.basis:
+            return False
+        key = self.get_key(bonds_onsite, bonds_hoppings, onsite_envs)
+        for a, b in zip(self.key, key):
+            if a is None or b is None:
+                if a is not b:
+                    return False
+            elif a.shape != b.shape or not th.equal(a, b):
+                return False
+        return True
+
+    def shell_pairs(self, itype, jtype, sign=True):
+        '''The shell pairs of the block between atom type itype and jtype.
+
+        Returns
+        -------
+            a list of tuple (ish, jsh, ist, norbi, jst, norbj, rot_type, sign, transpose). If l_i < l_j, the
+            rotated block of type ``rot_type`` has to be transposed and multiplied by (-1)^(l_i+l_j).
+        '''
+        pairs = []
+        for ish, ishsymbol, shidi, norbi, ist in self.shells[itype]:
+            for jsh, jshsymbol, shidj, norbj, jst in self.shells[jtype]:
+                if shidi < shidj:
+                    factor = (-1.0)**(shidi + shidj) if sign else 1.0
+                    pairs.append((ish, jsh, ist, norbi, jst, norbj, ishsymbol+jshsymbol, factor, True))
+                else:
+                    pairs.append((ish, jsh, ist, norbi, jst, norbj, jshsymbol+ishsymbol, 1.0, False))
+        return pairs
+
+    def _build_onsite(self, struct):
+        bonds_onsite = self.key[0].numpy()
+        self.onsite_atoms = bonds_onsite[:,1].astype(int)
+        self.atom_to_onsite = -np.ones(len(self.num_orbs_per_atom), dtype=int)
+        self.atom_to_onsite[self.onsite_atoms] = np.arange(len(bonds_onsite))
+
+        # the onsite blocks are diagonal, param_index maps each orbital to the index in onsiteEs.
+        self.onsite_groups = {}
+        for ib, iatom in enumerate(self.onsite_atoms):
+            iatype = struct.proj_atom_symbols[iatom]
+            jatype = struct.proj_atom_symbols[bonds_onsite[ib,3]]
+            assert iatype == jatype, "i type should equal j type."
+            if iatype not in self.onsite_groups:
+                param_index = []
+                for ish, _, _, norbi, _ in self.shells[iatype]:
+                    # one value per shell, or one value per orbital in the orbital split mode.
+                    indx = list(struct.onsite_index_map[iatype][ish])
+                    param_index += indx if len(indx) == norbi else indx * norbi
+                self.onsite_groups[iatype] = {"bonds": [], "param_index": th.tensor(param_index, dtype=th.long)}
+            self.onsite_groups[iatype]["bonds"].append(ib)
+        # the flatten index of the onsite blocks in the [norbs, norbs] matrix, used to place the SOC blocks.
+        for iatype, group in self.onsite_groups.items():
+            norb = struct.proj_atomtype_norbs[iatype]
+            offsets = self.orb_offsets[self.onsite_atoms[group["bonds"]]]
+            rows = offsets.reshape(-1,1,1) + np.arange(norb).reshape(1,-1,1)
+            cols = offsets.reshape(-1,1,1) + np.arange(norb).reshape(1,1,-1)
+            group["block_index"] = th.from_numpy((rows * self.total_orbs + cols).reshape(-1))
+
+    def _build_hopping(self, struct):
+        bonds_hoppings = self.key[1].numpy()
+        self.hopping_groups = {}
+        for ib in range(len(bonds_hoppings)):
+            iatype = struct.proj_atom_symbols[bonds_hoppings[ib,1]]
+            jatype = struct.proj_atom_symbols[bonds_hoppings[ib,3]]
+            bondatomtype = iatype + '-' + jatype
+            if bondatomtype not in self.hopping_groups:
+                pairs = [pair + (struct.bond_index_map[bondatomtype][pair[0]+'-'+pair[1]],) for pair in self.shell_pairs(iatype, jatype)]
+                self.hopping_groups[bondatomtype] = {"bonds": [], "shape": (struct.proj_atomtype_norbs[iatype], struct.proj_atomtype_norbs[jatype]),
+                                                     "shell_pairs": pairs, "nshells": len(self.shells[jatype])}
+            self.hopping_groups[bondatomtype]["bonds"].append(ib)
+        for group in self.hopping_groups.values():
+            group["index"] = th.tensor(group["bonds"], dtype=th.long)
+
+    def _build_strain(self, struct):
+        onsite_envs = self.key[2].numpy()
+        self.strain_groups = {}
+        for ie in range(len(onsite_envs)):
+            iatom, jatom = int(onsite_envs[ie,1]), int(onsite_envs[ie,3])
+            iatype, jatype = struct.proj_atom_symbols[iatom], struct.atom_symbols[jatom]
+            envtype = iatype + '-' + jatype
+            if envtype not in self.strain_groups:
+                # the strain blocks are rotated without the (-1)^(l_i+l_j) factor.
+                pairs = [pair + (struct.onsite_strain_index_map[envtype][pair[0]+'-'+pair[1]],) for pair in self.shell_pairs(iatype, iatype, sign=False)]
+                self.strain_groups[envtype] = {"envs": [], "onsite": [], "shape": (struct.proj_atomtype_norbs[iatype], struct.proj_atomtype_norbs[iatype]),
+                                               "shell_pairs": pairs, "nshells": len(self.shells[iatype])}
+            self.strain_groups[envtype]["envs"].append(ie)
+            self.strain_groups[envtype]["onsite"].append(int(self.atom_to_onsite[iatom]))
+        # position of the onsite block of each env in the onsite blocks of its atom type, the strain blocks are summed
+        # into the onsite blocks by a segment sum on this index.
+        onsite_pos = np.zeros(self.num_onsite, dtype=int)
+        for group in self.onsite_groups.values():
+            onsite_pos[group["bonds"]] = np.arange(len(group["bonds"]))
+        for envtype, group in self.strain_groups.items():
+            group["index"] = th.tensor(group["envs"], dtype=th.long)
+            group["onsite_type"] = envtype.split('-')[0]
+            group["onsite_pos"] = th.from_numpy(onsite_pos[group["onsite"]])
+
+    def _build_scatter(self, struct):
+        all_bonds = th.cat([self.key[0], self.key[1]], dim=0)
+        self.all_bonds = all_bonds
+
+        # the blocks are grouped by bond type, the onsite blocks of type itype come first in the group 'itype-itype'.
+        groups = {}
+        for iatype, group in self.onsite_groups.items():
+            groups[iatype + '-' + iatype] = list(group["bonds"])
+        for bondatomtype, group in self.hopping_groups.items():
+            groups.setdefault(bondatomtype, [])
+            groups[bondatomtype] += [self.num_onsite + ib for ib in group["bonds"]]
+        self.Rlatt, self.block_groups = get_block_scatter(all_bonds, self.num_orbs_per_atom, num_onsite=self.num_onsite, groups=groups)
+
+
+def get_block_scatter(all_bonds, num_orbs_per_atom, num_onsite, groups=None):
+    '''The scatter indices that place the bond blocks into a dense [nR, norbs, norbs] stack.
+
+    Parameters
+    ----------
+    all_bonds
+        the bond list [N, >=7], with the first ``num_onsite`` entries being the onsite bonds.
+    num_orbs_per_atom
+        number of orbitals of each atom.
+    num_onsite
+        number of onsite bonds.
+    groups, optional
+        dict of the bond index of each block group, e.g. ``HRBlocks.index``. If None, the bonds are grouped by the
+        shape of the blocks.
+
+    Returns
+    -------
+        Rlatt: a [nR, 3] integer tensor of the lattice vectors.
+        block_groups: a dict of the block groups, with the bond index, the flatten index in the
+        [nR, norbs, norbs] stack and the mask of the onsite bonds of each group.
+    '''
+    all_bonds = th.as_tensor(all_bonds).int().cpu().numpy()
+    numOrbs = np.asarray(num_orbs_per_atom, dtype=int)
+    totalOrbs = int(np.sum(numOrbs))
+    orb_offsets = np.concatenate([[0], np.cumsum(numOrbs)])
+
+    Rlatt, Rindex = np.unique(all_bonds[:,4:7], axis=0, return_inverse=True)
+    Rindex = Rindex.reshape(-1)
+    ist = orb_offsets[all_bonds[:,1]]
+    jst = orb_offsets[all_bonds[:,3]]
+    norbi = numOrbs[all_bonds[:,1]]
+    norbj = numOrbs[all_bonds[:,3]]
+
+    if groups is None:
+        groups = {}
+        for ni, nj in sorted(set(zip(norbi.tolist(), norbj.tolist()))):
+            groups[(ni, nj)] = np.where((norbi == ni) & (norbj == nj))[0]
+
+    block_groups = {}
+    for key, ibonds in groups.items():
+        ibonds = th.as_tensor(ibonds, dtype=th.long).cpu().numpy()
+        ni, nj = norbi[ibonds[0]], norbj[ibonds[0]]
+        rows = ist[ibonds].reshape(-1,1,1) + np.arange(ni).reshape(1,-1,1)
+        cols = jst[ibonds].reshape(-1,1,1) + np.arange(nj).reshape(1,1,-1)
+        flat = (Rindex[ibonds].reshape(-1,1,1) * totalOrbs + rows) * totalOrbs + cols
+        block_groups[key] = {"bonds": th.from_numpy(ibonds), "index": th.from_numpy(flat.reshape(-1)),
+                             "onsite": th.from_numpy(ibonds < num_onsite)}
+
+    return th.from_numpy(Rlatt).int(), block_groups
+
+
+def get_bond_classes(bonds, tol=BOND_CLASS_TOL, length=True, direction=True, labels=None):
+    '''The classes of the geometrically equivalent bonds, with the same atom types, bond length and direction cosines
+    within tol. In a perfect crystal the bonds of a large supercell fall into the few classes of the primitive cell.
+
+    Parameters
+    ----------
+    bonds
+        the bond list [N, 11], with columns [itype, i, jtype, j, Rx, Ry, Rz, rij, cos_x, cos_y, cos_z].
+    tol, optional
+        the tolerance of the bond length and of the direction cosines, defaults to BOND_CLASS_TOL.
+    length, optional
+        whether the bond length distinguishes the classes, defaults to True.
+    direction, optional
+        whether the direction cosines distinguish the classes, defaults to True.
+    labels, optional
+        [N] integer labels of the bonds, the bonds of different labels are in different classes.
+
+    Returns
+    -------
+        rep: [nclass] index of the first bond of each class.
+        inverse: [N] the class of each bond.
+    '''
+    bonds = th.as_tensor(bonds).detach().cpu().double().numpy()
+    columns = [np.round(bonds[:,0]), np.round(bonds[:,2])]
+    if length:
+        columns.append(np.round(bonds[:,7] / tol))
+    if direction:
+        columns += [np.round(bonds[:,ic] / tol) for ic in [8, 9, 10]]
+    if labels is not None:
+        columns.append(np.asarray(labels))
+
+    # the rows are numbered column by column, which is much faster than np.unique over the rows.
+    inverse = np.zeros(len(bonds), dtype=np.int64)
+    for column in columns:
+        values, index = np.unique(column, return_inverse=True)
+        _, inverse = np.unique(inverse * len(values) + index.reshape(-1), return_inverse=True)
+    _, rep = np.unique(inverse, return_index=True)
+
+    return th.from_numpy(rep), th.from_numpy(inverse.reshape(-1))
+
+
+def match_bonds(bonds, query, time_symm=True):
+    '''The position of each bond of query in bonds, matched by the atoms i, j and the lattice vector R.
+
+    Parameters
+    ----------
+    bonds, query
+        the bond lists [N, >=7], with columns [itype, i, jtype, j, Rx, Ry, Rz, ...].
+    time_symm, optional
+        if True, the bond lists are the half bond lists of ``BaseStruct.get_bond``, in which the bonds (i, i, R) and
+        (i, i, -R) are the same bond. Defaults to True.
+
+    Returns
+    -------
+        [N_query] integer array of the position in bonds of each bond of query, -1 for the bonds not in bonds.
+    '''
+    keys = np.concatenate([th.as_tensor(bonds)[:,[1,3,4,5,6]].detach().cpu().double().numpy(),
+                           th.as_tensor(query)[:,[1,3,4,5,6]].detach().cpu().double().numpy()], axis=0)
+    keys = np.round(keys).astype(np.int64)
+    if time_symm:
+        # the bond of an atom with its own image is kept with either R or -R, the key takes the larger one.
+        flip = (keys[:,0] == keys[:,1]) & (np.sign(keys[:,2:5])[np.arange(len(keys)), np.argmax(keys[:,2:5] != 0, axis=1)] < 0)
+        keys[flip, 2:5] = -keys[flip, 2:5]
+
+    inverse = np.zeros(len(keys), dtype=np.int64)
+    for column in keys.T:
+        values, index = np.unique(column, return_inverse=True)
+        _, inverse = np.unique(inverse * len(values) + index.reshape(-1), return_inverse=True)
+    nbond = len(bonds)
+    table = -np.ones(inverse.max() + 1 if len(inverse) else 0, dtype=np.int64)
+    table[inverse[:nbond]] = np.arange(nbond)
+
+    return table[inverse[nbond:]]
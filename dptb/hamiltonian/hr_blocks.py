@@ -0,0 +1,94 @@
+import torch as th
+import numpy as np
+import logging
+from dptb.utils.constants import atomic_num_dict_r
+
+log = logging.getLogger(__name__)
+
+class HRBlocks(object):
+    """ The H(R) or S(R) blocks of all the bonds, stored as contiguous tensors grouped by the bond type.
+
+    The blocks of the bonds between atom type itype and jtype share the same shape [norb_i, norb_j], they are stored
+    in one tensor ``blocks['itype-jtype']`` of shape [nbond, norb_i, norb_j] and ``index['itype-jtype']`` gives
+    the positions of these bonds in ``all_bonds``. The onsite blocks of type itype are stored in the group
+    'itype-itype', together with the hoppings between the same type.
+
+    The object also behaves as the former list of blocks: ``len``, iteration and ``blocks[ib]`` follow the order of
+    ``all_bonds``, so that the block-wise consumers do not need to know the grouping.
+
+    Parameters
+    ----------
+    blocks
+        dict of the block tensors, {bond type: [nbond, norb_i, norb_j]}.
+    index
+        dict of the bond index in all_bonds, {bond type: LongTensor [nbond]}.
+    """
+    def __init__(self, blocks, index) -> None:
+        assert blocks.keys() == index.keys(), "The keys of blocks and index should be the same."
+        self.blocks = blocks
+        self.index = index
+        self.num_bonds = sum([len(idx) for idx in index.values()])
+        self._lookup = None
+
+    def _get_lookup(self):
+        if self._lookup is None:
+            keys = list(self.blocks.keys())
+            group = np.zeros(self.num_bonds, dtype=int)
+            pos = np.zeros(self.num_bonds, dtype=int)
+            for ik, key in enumerate(keys):
+                idx = self.index[key].cpu().numpy()
+                group[idx] = ik
+                pos[idx] = np.arange(len(idx))
+            self._lookup = (keys, group, pos)
+        return self._lookup
+
+    def __len__(self):
+        return self.num_bonds
+
+    def __getitem__(self, ib):
+        keys, group, pos = self._get_lookup()
+        return self.blocks[keys[group[ib]]][pos[ib]]
+
+    def __iter__(self):
+        for ib in range(self.num_bonds):
+            yield self[ib]
+
+    def keys(self):
+        return self.blocks.keys()
+
+    def items(self):
+        '''Iterate over (bond type, block tensor, bond index).'''
+        for key in self.blocks.keys():
+            yield key, self.blocks[key], self.index[key]
+
+    def apply(self, func):
+        '''Return a new HRBlocks with func applied to each block tensor, e.g. a unit conversion.'''
+        return HRBlocks(blocks={key: func(block) for key, block in self.blocks.items()}, index=self.index)
+
+    def detach(self):
+        return self.apply(lambda block: block.detach())
+
+    def tolist(self):
+        return [self[ib] for ib in range(self.num_bonds)]
+
+    @classmethod
+    def from_list(cls, blocks, all_bonds):
+        '''Build the HRBlocks from a list of blocks in the order of all_bonds, e.g. the H(R) saved by former versions.
+
+        Parameters
+        ----------
+        blocks
+            list of the block tensors.
+        all_bonds
+            the bond list [nbond, 7], with columns [itype, i, jtype, j, Rx, Ry, Rz], itype and jtype are the atomic numbers.
+        '''
+        all_bonds = th.as_tensor(all_bonds).int()
+        assert len(blocks) == len(all_bonds), "The number of blocks should equal the number of bonds."
+        index = {}
+        for ib, bond in enumerate(all_bonds):
+            key = atomic_num_dict_r[int(bond[0])] + '-' + atomic_num_dict_r[int(bond[2])]
+            index.setdefault(key, []).append(ib)
+        index = {key: th.tensor(idx, dtype=th.long) for key, idx in index.items()}
+        tensors = {key: th.stack([blocks[ib] for ib in idx.tolist()]) for key, idx in index.items()}
+
+        return cls(blocks=tensors, index=index)
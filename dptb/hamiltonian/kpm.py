@@ -0,0 +1,242 @@
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+import scipy.sparse.linalg as spla
+import scipy.optimize as opt
+import logging
+
+log = logging.getLogger(__name__)
+
+# the spectral bounds are widened by this fraction of the spectral width, the Chebyshev expansion diverges outside [-1, 1].
+KPM_PADDING = 0.05
+# the relative tolerance of the Lanczos estimate of the extreme eigenvalues, the padding covers its error.
+KPM_BOUNDS_TOL = 1e-3
+# below this size the extreme eigenvalues are given by the dense solver.
+KPM_DENSE_SIZE = 200
+# the Fermi level is the middle of the energies where the electron count is num_el -/+ this fraction of num_el, i.e. the
+# middle of the gap of an insulator, where the integrated DOS is flat.
+KPM_FERMI_WINDOW = 1e-3
+
+
+def jackson_kernel(num_moments):
+    '''The Jackson damping factors g_n of the Chebyshev moments, which remove the Gibbs oscillations of the truncated
+    expansion and keep the reconstructed DOS positive.'''
+    M = num_moments + 1
+    n = np.arange(num_moments)
+    return ((M - n) * np.cos(np.pi * n / M) + np.sin(np.pi * n / M) / np.tan(np.pi / M)) / M
+
+
+class ChebyshevOperator(object):
+    """ The operator A = (S^{-1}H - b) / a, whose spectrum is in [-1, 1] for the spectral bounds [b - a, b + a].
+
+    For the non-orthogonal basis the generalized eigenvalues of H x = e S x are the ones of S^{-1}H. S(k) is factorized
+    once, each product costs one sparse product of H and one sparse solve with S.
+
+    Parameters
+    ----------
+    hk
+        the sparse Hermitian H(k).
+    sk, optional
+        the sparse S(k), None for orthogonal basis.
+    bounds
+        [emin, emax] the bounds of the spectrum.
+    """
+    def __init__(self, hk, sk=None, bounds=None) -> None:
+        self.hk = sp.csr_matrix(hk)
+        self.sk = None if sk is None else sp.csr_matrix(sk)
+        self.solve = None if sk is None else spla.splu(sp.csc_matrix(sk, dtype=np.complex128)).solve
+        emin, emax = bounds
+        self.a = (emax - emin) / 2
+        self.b = (emax + emin) / 2
+
+    @property
+    def shape(self):
+        return self.hk.shape
+
+    def matvec(self, X):
+        if self.solve is None:
+            return (self.hk @ X - self.b * X) / self.a
+        return (self.solve(self.hk @ X) - self.b * X) / self.a
+
+
+def spectral_bounds(hk, sk=None, padding=KPM_PADDING):
+    '''The bounds [emin, emax] of the spectrum of H x = e S x, from the extreme eigenvalues given by Lanczos and widened
+    by padding times the spectral width.'''
+    size = hk.shape[0]
+    if size <= KPM_DENSE_SIZE:
+        eigs = sla.eigh(hk.toarray(), None if sk is None else sk.toarray(), eigvals_only=True)
+        emin, emax = eigs[0], eigs[-1]
+    else:
+        emin = spla.eigsh(hk, k=1, M=sk, which='SA', tol=KPM_BOUNDS_TOL, return_eigenvectors=False)[0]
+        emax = spla.eigsh(hk, k=1, M=sk, which='LA', tol=KPM_BOUNDS_TOL, return_eigenvectors=False)[0]
+    width = max(emax - emin, 1e-8)
+    return np.array([emin - padding * width, emax + padding * width])
+
+
+def kpm_moments(hk, sk=None, bounds=None, num_moments=512, num_random=16, orbitals=None, rng=None):
+    '''The Chebyshev moments mu_n = Tr[T_n(A)] of the DOS of H(k), with the scaled operator A of ``ChebyshevOperator``.
+
+    The trace is estimated with num_random random phase vectors r, Tr[T_n(A)] ~ 1/R \\sum_r r^dagger T_n(A) r, from the
+    recursion T_{n+1}(A)r = 2A T_n(A)r - T_{n-1}(A)r, i.e. one sparse product per moment on the block of the random
+    vectors. The local moments of the orbitals a are the diagonal elements T_n(A)_aa ~ 1/R \\sum_r conj(r_a) (T_n(A)r)_a,
+    for the non-orthogonal basis it is the Mulliken projection of the DOS on the orbital.
+
+    Parameters
+    ----------
+    hk
+        the sparse H(k).
+    sk, optional
+        the sparse S(k), None for orthogonal basis.
+    bounds, optional
+        [emin, emax] the bounds of the spectrum, if None they are estimated by ``spectral_bounds``.
+    num_moments, optional
+        the number of moments, the energy resolution is about pi (emax - emin) / (2 num_moments).
+    num_random, optional
+        the number of random vectors, the relative error of the moments decreases as 1/sqrt(num_random * size). If it
+        is not smaller than the size, the trace is exact.
+    orbitals, optional
+        the indices of the orbitals of the local moments.
+    rng, optional
+        the numpy random generator of the random phases.
+
+    Returns
+    -------
+        moments: [num_moments] the moments.
+        local_moments: [len(orbitals), num_moments] the local moments, None without orbitals.
+    '''
+    if bounds is None:
+        bounds = spectral_bounds(hk, sk)
+    if rng is None:
+        rng = np.random.default_rng()
+    A = ChebyshevOperator(hk, sk, bounds=bounds)
+    size = A.shape[0]
+
+    if num_random >= size:
+        # the trace is exact on the basis vectors.
+        r = np.eye(size, dtype=np.complex128)
+        scale = 1.0
+    else:
+        # the random phase vectors, E[r r^dagger] = I and |r_a| = 1, so mu_0 = size exactly.
+        r = np.exp(2j * np.pi * rng.random((size, num_random)))
+        scale = 1.0 / num_random
+    moments, local = state_moments(A, r, num_moments, orbitals=orbitals)
+    return moments * scale, None if local is None else local * scale
+
+
+def state_moments(A, vectors, num_moments, orbitals=None):
+    '''The Chebyshev moments \\sum_v <v|T_n(A)|v> of the columns v of vectors, and the local moments
+    \\sum_v conj(v_a) (T_n(A)v)_a of the orbitals a, see ``kpm_moments``.
+
+    Parameters
+    ----------
+    A
+        the ``ChebyshevOperator``.
+    vectors
+        [size, nvec] the states.
+    num_moments
+        the number of moments.
+    orbitals, optional
+        the indices of the orbitals of the local moments.
+
+    Returns
+    -------
+        moments: [num_moments] the moments.
+        local_moments: [len(orbitals), num_moments] the local moments, None without orbitals.
+    '''
+    moments = np.zeros(num_moments)
+    if orbitals is None and A.solve is None and num_moments > 2:
+        # A is Hermitian, T_{2n} = 2T_n^2 - T_0 and T_{2n+1} = 2T_{n+1}T_n - T_1 give two moments per product.
+        t0, t1 = vectors, A.matvec(vectors)
+        moments[0], moments[1] = np.real(np.vdot(vectors, t0)), np.real(np.vdot(vectors, t1))
+        for n in range(1, (num_moments + 1) // 2):
+            moments[2*n] = 2 * np.real(np.vdot(t1, t1)) - moments[0]
+            t0, t1 = t1, 2 * A.matvec(t1) - t0
+            if 2*n + 1 < num_moments:
+                moments[2*n+1] = 2 * np.real(np.vdot(t1, t0)) - moments[1]
+        return moments, None
+
+    local = None
+    if orbitals is not None:
+        orbitals = np.asarray(orbitals, dtype=np.int64).reshape(-1)
+        local = np.zeros((len(orbitals), num_moments))
+        v_orb = vectors[orbitals].conj()
+
+    def project(n, tn):
+        moments[n] = np.real(np.vdot(vectors, tn))
+        if local is not None:
+            local[:, n] = np.real(np.sum(v_orb * tn[orbitals], axis=1))
+
+    t0, t1 = vectors, A.matvec(vectors)
+    project(0, t0)
+    if num_moments > 1:
+        project(1, t1)
+    for n in range(2, num_moments):
+        t0, t1 = t1, 2 * A.matvec(t1) - t0
+        project(n, t1)
+
+    return moments, local
+
+
+def kpm_dos(moments, bounds, energies, kernel=True):
+    '''The DOS reconstructed from the moments,
+    rho(E) = [g_0 mu_0 + 2 \\sum_n g_n mu_n T_n(x)] / (pi a sqrt(1 - x^2)), with x = (E - b) / a.
+
+    Parameters
+    ----------
+    moments
+        [..., num_moments] the moments, e.g. the local moments of several orbitals.
+    bounds
+        [emin, emax] the bounds of the moments.
+    energies
+        the energies of the DOS.
+    kernel, optional
+        if True the moments are damped by the Jackson kernel, defaults to True.
+
+    Returns
+    -------
+        [..., len(energies)] the DOS, zero out of the bounds.
+    '''
+    moments = np.asarray(moments)
+    gn = jackson_kernel(moments.shape[-1]) if kernel else np.ones(moments.shape[-1])
+    a, b = (bounds[1] - bounds[0]) / 2, (bounds[1] + bounds[0]) / 2
+    x = (np.asarray(energies) - b) / a
+    inside = np.abs(x) < 1
+    theta = np.arccos(np.clip(x, -1, 1))
+    coeff = gn * moments
+    coeff[..., 1:] *= 2
+    tn = np.cos(np.outer(np.arange(moments.shape[-1]), theta))
+    dos = coeff @ tn / (np.pi * a * np.sqrt(np.where(inside, 1 - x**2, 1)))
+    return np.where(inside, dos, 0.0)
+
+
+def kpm_integrated_dos(moments, bounds, energies, kernel=True):
+    '''The number of states below the energies, N(E) = [g_0 mu_0 (pi - t) - 2 \\sum_n g_n mu_n sin(n t) / n] / pi with
+    x = cos(t), the integral of ``kpm_dos`` in closed form.'''
+    moments = np.asarray(moments)
+    gn = jackson_kernel(moments.shape[-1]) if kernel else np.ones(moments.shape[-1])
+    a, b = (bounds[1] - bounds[0]) / 2, (bounds[1] + bounds[0]) / 2
+    theta = np.arccos(np.clip((np.asarray(energies, dtype=np.float64) - b) / a, -1, 1))
+    n = np.arange(1, moments.shape[-1])
+    coeff = gn[1:] * moments[..., 1:] / n
+    return (gn[0] * moments[..., :1] * (np.pi - theta) - 2 * coeff @ np.sin(np.outer(n, theta))) / np.pi
+
+
+def kpm_fermi_level(moments, bounds, num_el, spindeg=2, kernel=True):
+    '''The Fermi level where the integrated DOS holds num_el electrons, spindeg * N(E_fermi) = num_el.
+
+    Within the gap of an insulator the integrated DOS is flat, the Fermi level is the middle of the energies where it
+    reaches num_el -/+ KPM_FERMI_WINDOW * num_el.
+    '''
+    moments = np.asarray(moments)
+    total = spindeg * moments[0]
+    if not 0 < num_el < total:
+        log.error(f'The number of electrons {num_el} is out of the number of states {total} of the moments.')
+        raise ValueError
+
+    def count(energy, target):
+        return spindeg * kpm_integrated_dos(moments, bounds, [energy], kernel=kernel)[0] - target
+
+    delta = min(KPM_FERMI_WINDOW * num_el, (total - num_el) / 2, num_el / 2)
+    lower = opt.brentq(count, bounds[0], bounds[1], args=(num_el - delta,))
+    upper = opt.brentq(count, bounds[0], bounds[1], args=(num_el + delta,))
+    return (lower + upper) / 2
@@ -0,0 +1,163 @@
+import numpy as np
+import scipy.special as special
+import logging
+from dptb.hamiltonian.kpm import ChebyshevOperator, spectral_bounds, state_moments, kpm_dos
+
+log = logging.getLogger(__name__)
+
+# the reduced Planck constant in eV*fs.
+HBAR = 0.6582119569
+# the Chebyshev expansion of the propagator is cut after the last coefficient above this tolerance.
+KUBO_CHEBYSHEV_TOL = 1e-12
+# the mean square displacement is not resolved where the DOS is below this fraction of its maximum, e.g. in a gap.
+KUBO_DOS_CUTOFF = 1e-3
+
+
+def propagator_coefficients(a, time_step):
+    '''The Chebyshev coefficients c_n of exp(-i a A t/hbar) = \\sum_n c_n T_n(A), c_n = (2 - delta_n0) (-i)^n J_n(a t/hbar).
+
+    The Bessel functions decay fast beyond n ~ a t/hbar, the expansion is cut after the last coefficient above
+    KUBO_CHEBYSHEV_TOL.
+    '''
+    tau = a * time_step / HBAR
+    n = np.arange(int(1.5 * tau) + 30)
+    jn = special.jv(n, tau)
+    num = int(np.nonzero(np.abs(jn) > KUBO_CHEBYSHEV_TOL)[0][-1]) + 1
+    coeff = (-1j)**n[:num] * jn[:num]
+    coeff[1:] *= 2
+    return coeff
+
+
+def evolve(A, velocity, psi, chi, coeff, phase):
+    '''One time step of the states psi(t) = U(t)phi and chi(t) = [X, U(t)]phi, with U(t) = exp(-iHt/hbar),
+
+        psi(t + dt) = U(dt)psi(t),  chi(t + dt) = U(dt)chi(t) + [X, U(dt)]psi(t).
+
+    The commutators of the Chebyshev polynomials follow the recursion of the polynomials,
+    [X, T_{n+1}(A)] = 2[X, A]T_n(A) + 2A[X, T_n(A)] - [X, T_{n-1}(A)], with [X, A] = [X, H]/a = i hbar V/a. The three
+    recursions share the sparse products of H on one block of vectors.
+
+    Parameters
+    ----------
+    A
+        the ``ChebyshevOperator`` of H.
+    velocity
+        the sparse hbar*V along X, see ``HamilEig.get_sparse_velocity``.
+    psi, chi
+        [size, nvec] the states at t.
+    coeff
+        the coefficients of ``propagator_coefficients``.
+    phase
+        exp(-i b dt/hbar), with b the center of the spectral bounds.
+
+    Returns
+    -------
+        psi, chi at t + dt.
+    '''
+    nvec = psi.shape[1]
+    comm = 1j / A.a * (velocity @ psi)
+    y0 = np.concatenate([psi, chi, np.zeros_like(psi)], axis=1)
+    y1 = A.matvec(y0)
+    y1[:, 2*nvec:] += comm
+    out = coeff[0] * y0 + coeff[1] * y1
+    for cn in coeff[2:]:
+        y2 = 2 * A.matvec(y1) - y0
+        y2[:, 2*nvec:] += 2j / A.a * (velocity @ y1[:, :nvec])
+        y0, y1 = y1, y2
+        out += cn * y2
+    out *= phase
+    return out[:, :nvec], out[:, nvec:2*nvec] + out[:, 2*nvec:]
+
+
+def kubo_moments(hk, velocities, time_step, num_steps, num_moments=512, num_random=1, bounds=None, rng=None):
+    '''The Chebyshev moments of the DOS and of the mean square displacements along the velocities, by the time evolution
+    of random phase states.
+
+    The mean square displacement of the states of energy E along X is
+    DX^2(E, t) = Tr[[X, U(t)]^dagger d(E - H) [X, U(t)]] / Tr[d(E - H)], both traces are estimated on the random phase
+    states phi with the KPM moments of phi and of chi(t) = [X, U(t)]phi, see ``evolve``. Only sparse products of H
+    and V are used, the cost is linear in the size of H.
+
+    Parameters
+    ----------
+    hk
+        the sparse Hermitian H in eV, orthogonal basis.
+    velocities
+        the list of the sparse hbar*V in eV*Angstrom along the directions of the displacements.
+    time_step
+        the time step in fs.
+    num_steps
+        the number of time steps.
+    num_moments, optional
+        the number of KPM moments of the energy projection.
+    num_random, optional
+        the number of random phase states.
+    bounds, optional
+        [emin, emax] the bounds of the spectrum, if None they are estimated by ``spectral_bounds``.
+    rng, optional
+        the numpy random generator of the random phases.
+
+    Returns
+    -------
+        bounds: [emin, emax] the spectral bounds.
+        times: [num_steps] the times in fs.
+        dos_moments: [num_moments] the moments of the DOS.
+        msd_moments: [len(velocities), num_steps, num_moments] the moments of the mean square displacements in Angstrom^2.
+    '''
+    if bounds is None:
+        bounds = spectral_bounds(hk)
+    if rng is None:
+        rng = np.random.default_rng()
+    A = ChebyshevOperator(hk, bounds=bounds)
+    coeff = propagator_coefficients(A.a, time_step)
+    phase = np.exp(-1j * A.b * time_step / HBAR)
+
+    phi = np.exp(2j * np.pi * rng.random((A.shape[0], num_random)))
+    dos_moments = state_moments(A, phi, num_moments)[0] / num_random
+    msd_moments = np.zeros((len(velocities), num_steps, num_moments))
+    for idir, velocity in enumerate(velocities):
+        psi, chi = phi, np.zeros_like(phi)
+        for istep in range(num_steps):
+            psi, chi = evolve(A, velocity, psi, chi, coeff, phase)
+            msd_moments[idir, istep] = state_moments(A, chi, num_moments)[0] / num_random
+
+    times = time_step * np.arange(1, num_steps + 1)
+    return bounds, times, dos_moments, msd_moments
+
+
+def kubo_conductivity(dos_moments, msd_moments, bounds, energies, times, measure=1.0, spindeg=2):
+    '''The mean square displacements and the conductivity from the moments of ``kubo_moments``.
+
+    The conductivity at the time t is given by the Einstein relation with the diffusion coefficient D(E, t) = DX^2(E, t)/2t,
+    sigma(E, t) = e^2 spindeg rho(E) D(E, t) / measure. In the diffusive regime D(E, t) reaches a plateau, the
+    conductivity sigma(E) is the maximum over the times. In the ballistic regime it is the value at the last time.
+
+    Parameters
+    ----------
+    dos_moments, msd_moments
+        the moments of ``kubo_moments``.
+    bounds
+        [emin, emax] the bounds of the moments.
+    energies
+        the energies in eV.
+    times
+        the times in fs.
+    measure, optional
+        the volume in Angstrom^3, area or length of the structure along its periodic directions.
+    spindeg, optional
+        the spin degeneracy, 2 without SOC and 1 with SOC, defaults to 2.
+
+    Returns
+    -------
+        dos: [len(energies)] the DOS of the structure in 1/eV, per spin.
+        msd: [ndir, ntime, len(energies)] the mean square displacements in Angstrom^2.
+        sigma_t: [ndir, ntime, len(energies)] sigma(E, t) in e^2/h * Angstrom^(2-d), d the number of periodic directions.
+        sigma: [ndir, len(energies)] the conductivity sigma(E).
+    '''
+    dos = kpm_dos(dos_moments, bounds, energies)
+    resolved = dos > KUBO_DOS_CUTOFF * dos.max()
+    msd = kpm_dos(msd_moments, bounds, energies)
+    msd = np.where(resolved, msd / np.where(resolved, dos, 1.0), 0.0)
+    # e^2 rho D in units of e^2/h is h rho D, with h = 2 pi hbar in eV*fs.
+    sigma_t = 2 * np.pi * HBAR * spindeg * dos / measure * msd / (2 * np.asarray(times).reshape(1,-1,1))
+    return dos, msd, sigma_t, sigma_t.max(axis=1)
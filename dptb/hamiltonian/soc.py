@@ -225,3 +225,15 @@ def get_soc_matrix_cubic_basis(orbital: str,cubic_mag_num=None, lm_mag_num=None,
 
     return Msoc_updn_block
 
+
+
+_soc_matrix_cache = {}
+
+def get_soc_matrix_cached(orbital: str, device='cpu', dtype=torch.float32):
+    '''The SOC matrix of ``get_soc_matrix_cubic_basis`` with the default magnetic quantum numbers, computed once per
+    process for each (orbital, dtype, device). The returned tensor is shared, it should not be modified in place.
+    '''
+    key = (orbital, dtype, str(device))
+    if key not in _soc_matrix_cache:
+        _soc_matrix_cache[key] = get_soc_matrix_cubic_basis(orbital=orbital, device=device, dtype=dtype)
+    return _soc_matrix_cache[key]
@@ -0,0 +1,365 @@
+import itertools
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+import scipy.sparse.linalg as spla
+import logging
+
+log = logging.getLogger(__name__)
+
+# with more than this fraction of the bands requested, the dense solver is faster than the iterative ones.
+DENSE_FRACTION = 0.2
+# a step along a k-path longer than this factor times the median step is a discontinuity of the path.
+PATH_JUMP_FACTOR = 4.0
+# the guard bands solved above the band window along a path, at least PATH_GUARD_BANDS and PATH_GUARD_FRACTION of the
+# bands, the subspace iteration converges slowly on its top vectors.
+PATH_GUARD_BANDS = 8
+PATH_GUARD_FRACTION = 0.5
+# the margin of the upper bound of the spectrum along a path segment, as a fraction of the spectral width.
+PATH_UPPER_MARGIN = 0.1
+# the degree of the Chebyshev filter of the subspace iteration.
+CHEBYSHEV_DEGREE = 8
+# the default tolerance of the residual norms of the subspace iteration, relative to the spectral radius. The error of
+# the eigenvalues is of the order of its square.
+CHEBYSHEV_TOL = 1e-5
+# the weight of the random vectors mixed into the start block of the subspace iteration.
+CHEBYSHEV_RANDOM_MIX = 1e-2
+# a solved eigenvalue within this fraction of max(1, |e|) of the lowest or highest eigenvalue of the spectrum reaches
+# that edge of the spectrum.
+SPECTRUM_EDGE_TOL = 1e-6
+
+class SparseHR(object):
+    """ The H(R) or S(R) of a structure stored as sparse triplets, used to assemble H(k) or S(k) in CSR format.
+
+    The nonzero pattern of H(k) does not depend on k, so it is built once: every triplet of H(R) (and its
+    conjugate transpose partner in the time symmetric case, and its copy in the spin down block with SOC) is mapped
+    to one entry of the CSR data array. Assembling H(k) at a new k only computes the Bloch phases and sums the
+    triplets into the data array.
+
+    Parameters
+    ----------
+    Rlatt
+        the [nR, 3] integer lattice vectors.
+    index
+        the flatten index of the triplets in the [nR, norbs, norbs] stack, as given by ``HamilEig.hs_block_values``.
+    values
+        the values of the triplets.
+    norbs
+        the number of orbitals.
+    time_symm, optional
+        if True, H(k) = H'(k) + H'(k)^dagger, defaults to True.
+    soc_upup, soc_updown, optional
+        the [norbs, norbs] SOC blocks, the spinor H(k) is built as in ``HamilEig.hs_block_R2k``, with the down-up
+        block conj(soc_updown) and the up-down block its conjugate transpose.
+    """
+    def __init__(self, Rlatt, index, values, norbs, time_symm=True, soc_upup=None, soc_updown=None) -> None:
+        self.Rlatt = np.asarray(Rlatt, dtype=np.float64)
+        index = np.asarray(index, dtype=np.int64)
+        self.values = np.asarray(values).astype(np.complex128)
+        self.norbs = norbs
+        self.time_symm = time_symm
+        self.soc = soc_upup is not None
+
+        self.Rindex = index // (norbs * norbs)
+        row = index % (norbs * norbs) // norbs
+        col = index % norbs
+
+        rows, cols = [row], [col]
+        if time_symm:
+            rows.append(col)
+            cols.append(row)
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+
+        const_rows, const_cols, const_values = [], [], []
+        if self.soc:
+            rows, cols = np.concatenate([rows, rows + norbs]), np.concatenate([cols, cols + norbs])
+            for block, ist, jst in [(soc_upup, 0, 0), (np.conj(soc_upup), norbs, norbs),
+                                    (np.transpose(soc_updown), 0, norbs), (np.conj(soc_updown), norbs, 0)]:
+                block = np.asarray(block)
+                irow, icol = np.nonzero(block)
+                const_rows.append(irow + ist)
+                const_cols.append(icol + jst)
+                const_values.append(block[irow, icol])
+            rows, cols = np.concatenate([rows] + const_rows), np.concatenate([cols] + const_cols)
+            self.const_values = np.concatenate(const_values).astype(np.complex128)
+        else:
+            self.const_values = np.zeros(0, dtype=np.complex128)
+
+        self.size = 2 * norbs if self.soc else norbs
+        keys, self.inverse = np.unique(rows * self.size + cols, return_inverse=True)
+        self.inverse = self.inverse.reshape(-1)
+        self.nnz = len(keys)
+        self.indices = (keys % self.size).astype(np.int32)
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(keys // self.size, minlength=self.size))]).astype(np.int32)
+
+    def Rk(self, kpoint):
+        '''H(k) = \\sum_R exp(-i2\\pi k.R) H(R) as a scipy CSR matrix of shape [size, size].'''
+        phase = np.exp(-1j * 2 * np.pi * (self.Rlatt @ np.asarray(kpoint, dtype=np.float64).reshape(3)))
+        vals = self.values * phase[self.Rindex]
+        vals = [vals, vals.conj()] if self.time_symm else [vals]
+        if self.soc:
+            vals = vals + vals
+        vals = np.concatenate(vals + [self.const_values])
+
+        data = np.bincount(self.inverse, weights=vals.real, minlength=self.nnz) \
+            + 1j * np.bincount(self.inverse, weights=vals.imag, minlength=self.nnz)
+
+        return sp.csr_matrix((data, self.indices, self.indptr), shape=(self.size, self.size))
+
+
+def sparse_eigh(hk, sk=None, method='shift-invert', band_window=None, energy_window=None, sigma=None, num_bands=None,
+                tol=0, maxiter=None, if_eigvec=False, X0=None):
+    '''Solve a window of the generalized eigenvalue problem H x = e S x with a sparse iterative solver.
+
+    Parameters
+    ----------
+    hk, sk
+        the sparse H(k) and S(k), sk is None for the orthogonal basis.
+    method, optional
+        'shift-invert', 'lanczos' or 'lobpcg', defaults to 'shift-invert'.
+    band_window, optional
+        [band_min, band_max], the index window of the bands, counted from the lowest band.
+    energy_window, optional
+        [emin, emax], the energy window, in the unit of hk.
+    sigma, optional
+        the shift of the shift-invert mode for the energy window, defaults to the center of the window.
+    num_bands, optional
+        the number of bands solved in the first attempt for the energy window, it is doubled until the window is
+        covered. Defaults to 20.
+    tol, maxiter, optional
+        passed to the scipy solver.
+    if_eigvec, optional
+        if True, also returns the S-orthonormal eigenvectors.
+    X0, optional
+        the initial guess of the eigenvectors for 'lobpcg'.
+
+    Returns
+    -------
+        eigs: the eigenvalues in the window, in ascending order.
+        eigvec: [size, nband] eigenvectors, or None.
+    '''
+    size = hk.shape[0]
+    if band_window is not None:
+        band_min, band_max = band_window
+        assert 0 <= band_min < band_max <= size, "band_window should be in [0, number of bands]."
+        eigs, eigvec = _solve_lowest(hk, sk, band_max, method, tol, maxiter, X0)
+        eigs, eigvec = eigs[band_min:band_max], eigvec[:, band_min:band_max]
+    elif energy_window is not None:
+        emin, emax = energy_window
+        assert emin < emax, "energy_window should be [emin, emax] with emin < emax."
+        if sigma is None:
+            sigma = 0.5 * (emin + emax)
+        nev = num_bands or 20
+        # the lowest and highest eigenvalues of the spectrum, solved once when a window edge is not passed.
+        edges = {}
+        def reaches(eig, which):
+            if which not in edges:
+                edges[which] = _spectrum_edge(hk, sk, which, maxiter)
+            return abs(eig - edges[which]) <= SPECTRUM_EDGE_TOL * max(1.0, abs(edges[which]))
+
+        while True:
+            nev = min(nev, size)
+            if method == 'shift-invert':
+                eigs, eigvec = _solve_sigma(hk, sk, nev, sigma, tol, maxiter)
+                # the solved eigenvalues are all the ones nearest to sigma, an edge of the window is covered if it is
+                # passed, or if the solved ones reach that edge of the spectrum, e.g. for a window past the band edge.
+                covered = (eigs.min() < emin or reaches(eigs.min(), 'SA')) and (eigs.max() > emax or reaches(eigs.max(), 'LA'))
+            else:
+                eigs, eigvec = _solve_lowest(hk, sk, nev, method, tol, maxiter, X0)
+                covered = eigs.max() > emax or reaches(eigs.max(), 'LA')
+            if covered or len(eigs) == size or nev >= size:
+                break
+            nev = 2 * nev
+        mask = (eigs >= emin) & (eigs <= emax)
+        eigs, eigvec = eigs[mask], eigvec[:, mask]
+    else:
+        log.error("Either band_window or energy_window should be set for the sparse eigen solver.")
+        raise ValueError
+
+    if if_eigvec:
+        return eigs, eigvec
+    else:
+        return eigs, None
+
+def _dense_eigh(hk, sk, nev=None):
+    '''Fall back to the dense solver when the window is not much smaller than the matrix.'''
+    eigs, eigvec = sla.eigh(hk.toarray(), None if sk is None else sk.toarray())
+    if nev is not None:
+        eigs, eigvec = eigs[:nev], eigvec[:, :nev]
+    return eigs, eigvec
+
+def _spectrum_edge(hk, sk, which, maxiter):
+    '''The lowest ('SA') or the highest ('LA') eigenvalue of the spectrum by Lanczos, to the machine precision to
+    compare with the solved ones.'''
+    if hk.shape[0] <= 2:
+        eigs = sla.eigh(hk.toarray(), None if sk is None else sk.toarray(), eigvals_only=True)
+        return eigs[0] if which == 'SA' else eigs[-1]
+    return spla.eigsh(hk, k=1, M=sk, which=which, tol=0, maxiter=maxiter, return_eigenvectors=False)[0]
+
+def _solve_sigma(hk, sk, nev, sigma, tol, maxiter):
+    size = hk.shape[0]
+    if nev > DENSE_FRACTION * size:
+        eigs, eigvec = _dense_eigh(hk, sk)
+        return eigs, eigvec
+    eigs, eigvec = spla.eigsh(hk, k=nev, M=sk, sigma=sigma, which='LM', tol=tol, maxiter=maxiter)
+    order = np.argsort(eigs)
+    return eigs[order], eigvec[:, order]
+
+def _solve_lowest(hk, sk, nev, method, tol, maxiter, X0=None):
+    size = hk.shape[0]
+    if method == 'lobpcg':
+        if nev > DENSE_FRACTION * size:
+            return _dense_eigh(hk, sk, nev)
+        if X0 is None or X0.shape != (size, nev):
+            X0 = np.random.default_rng(0).standard_normal((size, nev)) + 0j
+        eigs, eigvec = spla.lobpcg(hk, X0, B=sk, largest=False, tol=tol or None, maxiter=maxiter or 200)
+    elif method in ['lanczos', 'shift-invert']:
+        if nev > DENSE_FRACTION * size:
+            return _dense_eigh(hk, sk, nev)
+        if method == 'lanczos':
+            eigs, eigvec = spla.eigsh(hk, k=nev, M=sk, which='SA', tol=tol, maxiter=maxiter)
+        else:
+            # the lowest bands are the ones nearest to a shift just below the bottom of the spectrum.
+            e0 = spla.eigsh(hk, k=1, M=sk, which='SA', tol=1e-6, return_eigenvectors=False, maxiter=maxiter)[0]
+            eigs, eigvec = spla.eigsh(hk, k=nev, M=sk, sigma=e0 - 1e-3 * max(1.0, abs(e0)), which='LM', tol=tol, maxiter=maxiter)
+    else:
+        log.error("The sparse eigen solver method should be 'shift-invert', 'lanczos' or 'lobpcg'.")
+        raise ValueError
+    order = np.argsort(eigs)
+    return eigs[order], eigvec[:, order]
+
+
+def path_breaks(kpoints):
+    '''The indices of the k-points that start a new segment of a k-path, where the step from the previous k-point is
+    longer than PATH_JUMP_FACTOR times the median step, e.g. between the segments of "GXL|KG". The first k-point is
+    always a start.'''
+    kpoints = np.asarray(kpoints, dtype=np.float64).reshape(-1,3)
+    if len(kpoints) < 2:
+        return np.array([0])
+    steps = np.linalg.norm(np.diff(kpoints, axis=0), axis=1)
+    median = np.median(steps[steps > 0]) if (steps > 0).any() else 0.0
+    return np.concatenate([[0], np.where(steps > PATH_JUMP_FACTOR * median)[0] + 1])
+
+def chebyshev_filter(apply, X, degree, cut, upper, lower):
+    '''The Chebyshev polynomial of degree in the operator apply, applied to the block X, which damps the spectrum in
+    [cut, upper] and amplifies the part below cut, scaled to keep the eigenvalue lower near one.'''
+    e, c = 0.5 * (upper - cut), 0.5 * (upper + cut)
+    sigma = e / (lower - c)
+    tau = 2.0 / sigma
+    Y = (apply(X) - c * X) * (sigma / e)
+    for _ in range(1, degree):
+        sigma_new = 1.0 / (tau - sigma)
+        Y, X = (apply(Y) - c * Y) * (2.0 * sigma_new / e) - (sigma * sigma_new) * X, Y
+        sigma = sigma_new
+    return Y
+
+def chebyshev_subspace_eigh(hk, sk, X0, nwant, upper, degree=CHEBYSHEV_DEGREE, tol=0, maxiter=None):
+    '''The lowest eigenpairs of H x = e S x by the Chebyshev filtered subspace iteration, starting from the block X0.
+
+    Each iteration filters the block by a Chebyshev polynomial in S^-1 H that damps the spectrum above the top Ritz
+    value of the block, then S-orthonormalizes it and solves the Rayleigh-Ritz problem. From a block close to the
+    wanted subspace, e.g. the eigenvectors of the neighbouring k-point, a few iterations converge.
+
+    Parameters
+    ----------
+    hk, sk
+        the sparse H(k) and S(k), sk is None for the orthogonal basis.
+    X0
+        the [size, nblock] start block, nblock > nwant, the extra columns are the guard vectors.
+    nwant
+        the number of the lowest eigenpairs that have to converge.
+    upper
+        an upper bound of the spectrum.
+    degree, tol, maxiter, optional
+        the degree of the filter, the tolerance of the residual norms, 0 for CHEBYSHEV_TOL times the spectral
+        radius, and the maximum number of iterations, defaults to 20.
+
+    Returns
+    -------
+        eigs: [nblock] Ritz values and eigvec: [size, nblock] S-orthonormal Ritz vectors, or None, None if not converged.
+    '''
+    solve_s = None if sk is None else spla.splu(sk.tocsc().astype(np.complex128)).solve
+    def apply(X):
+        return hk @ X if solve_s is None else solve_s(hk @ X)
+
+    def rayleigh_ritz(Y):
+        SY = Y if sk is None else sk @ Y
+        # Cholesky QR in the S inner product.
+        chol = sla.cholesky(Y.conj().T @ SY, lower=True)
+        Q = sla.solve_triangular(chol, Y.conj().T, lower=True).conj().T
+        eigs, vec = sla.eigh(Q.conj().T @ (hk @ Q))
+        return eigs, Q @ vec
+
+    # along the lines of high symmetry, the bands of another irreducible representation are orthogonal to the block of
+    # the previous k-point and the filter can not bring them in. A random part in the guard vectors keeps all of them
+    # in the block, the wanted vectors stay converged.
+    X0 = np.array(X0, dtype=np.complex128)
+    rng = np.random.default_rng(0)
+    nguard = X0.shape[1] - nwant
+    X0[:, nwant:] += CHEBYSHEV_RANDOM_MIX * (rng.standard_normal((X0.shape[0], nguard)) + 1j * rng.standard_normal((X0.shape[0], nguard))) / np.sqrt(2 * X0.shape[0])
+    eigs, eigvec = rayleigh_ritz(X0)
+    scale = max(1.0, abs(upper))
+    tol = tol or CHEBYSHEV_TOL * scale
+    for _ in range(maxiter or 20):
+        SX = eigvec[:, :nwant] if sk is None else sk @ eigvec[:, :nwant]
+        residual = np.linalg.norm(hk @ eigvec[:, :nwant] - SX * eigs[:nwant], axis=0)
+        if residual.max() < tol:
+            return eigs, eigvec
+        try:
+            eigs, eigvec = rayleigh_ritz(chebyshev_filter(apply, eigvec, degree, eigs[-1], upper, eigs[0]))
+        except np.linalg.LinAlgError:
+            break
+
+    return None, None
+
+def sparse_eigh_path(hks, sks=None, kpoints=None, band_window=None, method='shift-invert', tol=0, maxiter=None, if_eigvec=False):
+    '''Solve the band window along a k-path, each k-point starting from the eigenvectors of the previous one.
+
+    Along a dense path the eigenvectors change little between the neighbouring k-points. The first k-point of each
+    segment of the path, see ``path_breaks``, is solved from scratch by ``sparse_eigh`` with the given method, the
+    next ones by ``chebyshev_subspace_eigh`` from the eigenvectors of the previous k-point, which converges in a few
+    filtered iterations. All the bands below band_max and the guard bands above are kept as the seed of the next
+    k-point. A k-point where the seeded iteration does not converge is solved from scratch.
+
+    Parameters
+    ----------
+    hks, sks
+        the sequences of the sparse H(k) and S(k) along the path, e.g. generators, sks is None for the orthogonal basis.
+    kpoints, optional
+        the [nk, 3] k-points of the path, to find the discontinuities. Defaults to a continuous path.
+    band_window
+        [band_min, band_max], the index window of the bands.
+    method, tol, maxiter, if_eigvec, optional
+        see ``sparse_eigh``, the method solves the starts of the segments, defaults to 'shift-invert'.
+
+    Returns
+    -------
+        eigks: list of the eigenvalues in the window at each k-point.
+        eigvecs: list of the eigenvectors, or of None.
+    '''
+    if band_window is None:
+        log.error("The band_window should be set for the warm started sparse eigen solver.")
+        raise ValueError
+    band_min, band_max = band_window
+    starts = set(path_breaks(kpoints).tolist()) if kpoints is not None else {0}
+    sks = itertools.repeat(None) if sks is None else sks
+
+    X0, upper = None, None
+    eigks, eigvecs = [], []
+    for ik, (hk, sk) in enumerate(zip(hks, sks)):
+        eigs = None
+        if ik not in starts and X0 is not None:
+            eigs, eigvec = chebyshev_subspace_eigh(hk, sk, X0, band_max, upper, tol=tol, maxiter=None)
+            if eigs is None:
+                log.debug(f"The seeded solve at the k-point {ik} does not converge, it is solved from scratch.")
+        if eigs is None:
+            nsolve = min(band_max + max(PATH_GUARD_BANDS, int(PATH_GUARD_FRACTION * band_max)), hk.shape[0])
+            eigs, eigvec = sparse_eigh(hk, sk, method=method, band_window=[0, nsolve], tol=tol, maxiter=maxiter, if_eigvec=True)
+            # the top of the spectrum only moves a little along the segment, the margin keeps it a bound.
+            top = spla.eigsh(hk, k=1, M=sk, which='LA', tol=1e-3, return_eigenvectors=False)[0]
+            upper = top + PATH_UPPER_MARGIN * (top - eigs[0])
+        X0 = eigvec
+        eigks.append(eigs[band_min:band_max])
+        eigvecs.append(eigvec[:, band_min:band_max] if if_eigvec else None)
+
+    return eigks, eigvecs
@@ -0,0 +1,150 @@
+import numpy as np
+import logging
+from ase import Atoms
+
+log = logging.getLogger(__name__)
+
+class SupercellHR(object):
+    """ The H(R) or S(R) triplets of a supercell, tiled from the triplets of the primitive cell by index arithmetic.
+
+    For a model without environment dependence, the H(R) of a supercell is the H(R) of the primitive cell: the block of
+    the orbitals i in the primitive cell t_a and j in t_b at the supercell lattice vector S is the primitive block of
+    R = t_b + S M - t_a, with the supercell lattice vectors given by the rows of M A. No bond list, SK integral or
+    rotation of the supercell is evaluated.
+
+    The atoms of the supercell are ordered cell by cell, the cells in the lexicographic order of their primitive
+    lattice coordinates t. For a diagonal M this is the order of ``ase.Atoms.repeat``.
+
+    Parameters
+    ----------
+    repeat
+        [3] the repetitions along the primitive lattice vectors, or a [3, 3] integer matrix M.
+    num_orbs_per_atom
+        the number of orbitals of each atom of the primitive cell.
+    vacancies, optional
+        the indices of the supercell atoms to remove, with their orbitals.
+    """
+    def __init__(self, repeat, num_orbs_per_atom, vacancies=None) -> None:
+        repeat = np.asarray(repeat, dtype=np.int64)
+        self.matrix = np.diag(repeat) if repeat.ndim == 1 else repeat.reshape(3,3)
+        self.det = int(round(np.linalg.det(self.matrix)))
+        if self.det <= 0:
+            log.error("The supercell matrix should have a positive determinant, got {}.".format(self.det))
+            raise ValueError
+        # the integer adjugate, frac = L adj / det are the supercell fractional coordinates of the primitive L.
+        self.adjugate = np.round(np.linalg.inv(self.matrix) * self.det).astype(np.int64)
+
+        # the primitive cells in the supercell are the lattice points with the fractional coordinates in [0, 1).
+        corners = np.array([[i, j, k] for i in (0, 1) for j in (0, 1) for k in (0, 1)]) @ self.matrix
+        axes = [np.arange(corners[:, ix].min(), corners[:, ix].max() + 1) for ix in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+        frac = points @ self.adjugate
+        self.cells = points[((frac >= 0) & (frac < self.det)).all(axis=1)]
+        assert len(self.cells) == self.det, "The cells of the supercell are not found."
+        self.ncell = len(self.cells)
+        self.cell_min = self.cells.min(axis=0)
+        self.lookup = -np.ones(self.cells.max(axis=0) - self.cell_min + 1, dtype=np.int64)
+        self.lookup[tuple((self.cells - self.cell_min).T)] = np.arange(self.ncell)
+
+        self.num_orbs_per_atom = np.asarray(num_orbs_per_atom, dtype=np.int64)
+        self.norbs = int(self.num_orbs_per_atom.sum())
+        self.natom = len(self.num_orbs_per_atom) * self.ncell
+        self.keep = np.ones(self.natom, dtype=bool)
+        if vacancies is not None:
+            self.keep[np.asarray(vacancies, dtype=np.int64)] = False
+        # the new index of each orbital of the supercell, -1 for the orbitals of the vacancies.
+        orbital_keep = np.repeat(self.keep, np.tile(self.num_orbs_per_atom, self.ncell))
+        self.orbital_map = np.where(orbital_keep, np.cumsum(orbital_keep) - 1, -1)
+        self.size = int(orbital_keep.sum())
+
+    def reduce(self, L):
+        '''Split the primitive lattice vectors L [..., 3] into L = t + S M, returns the cell index of t and S.'''
+        S = np.floor_divide(L @ self.adjugate, self.det)
+        t = L - S @ self.matrix
+
+        return self.lookup[tuple(np.moveaxis(t - self.cell_min, -1, 0))], S
+
+    def tile(self, Rlatt, index, values, substitutions=None, time_symm=True):
+        '''Tile the primitive triplets into the supercell.
+
+        Parameters
+        ----------
+        Rlatt, index, values
+            the primitive H(R) or S(R) triplets, as given by ``HamilEig.hs_block_values``.
+        substitutions, optional
+            dict of {supercell atom index: [norb, norb] onsite block}, the onsite blocks of these atoms are replaced,
+            e.g. by the onsite energies of a substitutional impurity of the same orbitals or an onsite disorder. The
+            hoppings of these atoms stay the ones of the primitive cell.
+        time_symm, optional
+            if True, the triplets are the half of the time symmetric H(R) with the onsite blocks scaled by 0.5, see
+            ``HamilEig.hs_block_values``, and so is the result. Defaults to True.
+
+        Returns
+        -------
+            Rlatt: the [nR, 3] integer lattice vectors of the supercell.
+            index: the flatten index of the triplets in the [nR, size, size] stack of the supercell.
+            values: the values of the triplets.
+        '''
+        Rlatt = np.asarray(Rlatt, dtype=np.int64).reshape(-1, 3)
+        index = np.asarray(index, dtype=np.int64)
+        values = np.asarray(values)
+        n = self.norbs
+        Rindex, row, col = index // (n * n), index % (n * n) // n, index % n
+
+        # the triplets of every primitive cell t_a: the column orbital is in the cell of t_a + R.
+        cell_b, S = self.reduce(self.cells.reshape(-1, 1, 3) + Rlatt[Rindex].reshape(1, -1, 3))
+        rows = (np.arange(self.ncell).reshape(-1, 1) * n + row.reshape(1, -1)).reshape(-1)
+        cols = (cell_b * n + col.reshape(1, -1)).reshape(-1)
+        S = S.reshape(-1, 3)
+        values = np.tile(values, self.ncell)
+
+        if substitutions:
+            natom = len(self.num_orbs_per_atom)
+            orb_offsets = np.concatenate([[0], np.cumsum(np.tile(self.num_orbs_per_atom, self.ncell))])
+            prim_atom = np.repeat(np.arange(natom), self.num_orbs_per_atom)
+            # the onsite triplets of the substituted atoms are replaced by their new blocks.
+            onsite = (Rlatt[Rindex] == 0).all(axis=1) & (prim_atom[row] == prim_atom[col])
+            row_atom = (np.arange(self.ncell).reshape(-1, 1) * natom + prim_atom[row].reshape(1, -1)).reshape(-1)
+            drop = np.tile(onsite, self.ncell) & np.isin(row_atom, list(substitutions.keys()))
+            rows, cols, values, S = [rows[~drop]], [cols[~drop]], [values[~drop]], [S[~drop]]
+            for iatom, block in substitutions.items():
+                if not self.keep[iatom]:
+                    log.error("The substituted atom {} is a vacancy.".format(iatom))
+                    raise ValueError
+                block = np.asarray(block)
+                norb = orb_offsets[iatom+1] - orb_offsets[iatom]
+                if block.shape != (norb, norb):
+                    log.error("The onsite block of atom {} should be of shape {}.".format(iatom, (norb, norb)))
+                    raise ValueError
+                irow, icol = np.nonzero(block)
+                rows.append(orb_offsets[iatom] + irow)
+                cols.append(orb_offsets[iatom] + icol)
+                # the onsite blocks are doubled by H = H' + H'^dagger.
+                values.append(block[irow, icol] * (0.5 if time_symm else 1.0))
+                S.append(np.zeros((len(irow), 3), dtype=np.int64))
+            rows, cols, values, S = np.concatenate(rows), np.concatenate(cols), np.concatenate(values), np.concatenate(S)
+
+        # the triplets of the vacancies are dropped.
+        rows, cols = self.orbital_map[rows], self.orbital_map[cols]
+        mask = (rows >= 0) & (cols >= 0)
+        # the few supercell lattice vectors are numbered through a table over their bounding box, not by a sort.
+        S = S[mask]
+        Smin = S.min(axis=0)
+        span = S.max(axis=0) - Smin + 1
+        key = ((S[:, 0] - Smin[0]) * span[1] + S[:, 1] - Smin[1]) * span[2] + S[:, 2] - Smin[2]
+        present = np.nonzero(np.bincount(key, minlength=int(np.prod(span))))[0]
+        table = np.zeros(int(np.prod(span)), dtype=np.int64)
+        table[present] = np.arange(len(present))
+        Rsc = np.stack(np.unravel_index(present, span), axis=1) + Smin
+        index = (table[key] * self.size + rows[mask]) * self.size + cols[mask]
+
+        return Rsc, index, values[mask]
+
+    def atoms(self, atoms):
+        '''The supercell of the primitive ase.Atoms, with the atoms in the order of the tiled triplets.'''
+        cell = np.asarray(atoms.cell)
+        positions = (self.cells @ cell).reshape(-1, 1, 3) + atoms.positions.reshape(1, -1, 3)
+        supercell = Atoms(symbols=list(atoms.get_chemical_symbols()) * self.ncell, positions=positions.reshape(-1, 3),
+                          cell=self.matrix @ cell, pbc=atoms.pbc)
+
+        return supercell[np.nonzero(self.keep)[0]]
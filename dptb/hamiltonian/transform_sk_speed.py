@@ -2,7 +2,8 @@ import torch as th
 from dptb.utils.constants import h_all_types
 
 '''
-The rotation matrix can be constructed as a batch form according to each orbital binding
+The rotation matrix is constructed in a batch form according to each orbital binding,
+the kernels take [N,3] direction cosines and [N,nparam] SK integrals.
 '''
 
 
@@ -18,32 +19,49 @@ class RotationSK(object):
                                          $pp^ sigma$, $pp^ pi$, $pd^ sigma$, $pd^ pi$,
                                          $dd^ sigma$,$dd^ pi$,$dd^ delta$
                      into tight binding hoppings, according to the direction vector  rij/|rij|.
+            function: rot_HS_batch
+                     the batched version of rot_HS, rotate the SK paras of a batch of bonds in one call.
             function: ss sp sd pp pd dd :
                      define rotation functions.
     '''
 
     def __init__(self , rot_type, device) -> None:
-        print('# initial rotate H or S func.')
         self.rot_type = rot_type
         self.device = device
-        epAngvec = th.tensor([0.3, 0.4, 0.5]) * (2**0.5)
-        ep1 = th.tensor(-2.7)
-        ep2 = th.tensor([-2.7, -3.1])
-        ep3 = th.tensor([-2.7, -3.1, -3.5])
-        self.ss = th.jit.trace(ss, [epAngvec, ep1])
-        self.sp = th.jit.trace(sp, [epAngvec, ep1])
-        self.sd = th.jit.trace(sd, [epAngvec, ep1])
-        self.pp = th.jit.trace(pp, [epAngvec, ep2])
-        self.pd = th.jit.trace(pd, [epAngvec, ep2])
-        self.dd = th.jit.trace(dd, [epAngvec, ep3])
-
-        # self.sd = sd
-        # self.pd = pd
-        # self.dd = dd
+        # the traced kernels are shared by all the instances in the process.
+        kernels = get_rot_kernels()
+        self.ss = kernels['ss']
+        self.sp = kernels['sp']
+        self.sd = kernels['sd']
+        self.pp = kernels['pp']
+        self.pd = kernels['pd']
+        self.dd = kernels['dd']
 
     def rot_HS(self, Htype, Hvalue, Angvec):
         assert Htype in h_all_types, "Wrong hktypes"
 
+        hs = self.rot_HS_batch(Htype=Htype, Hvalue=Hvalue.reshape(1,-1), Angvec=Angvec.reshape(1,3))
+
+        return hs[0]
+
+    def rot_HS_batch(self, Htype, Hvalue, Angvec):
+        '''rotate the SK integrals of a batch of bonds.
+
+        Parameters
+        ----------
+        Htype
+            the type of the SK integrals, one of 'ss', 'sp', 'sd', 'pp', 'pd', 'dd'.
+        Hvalue
+            the SK integrals, [nbond, nparam].
+        Angvec
+            the direction cosines of the bonds, [nbond, 3].
+
+        Returns
+        -------
+            the rotated blocks, [nbond, 2l'+1, 2l+1] for Htype = ll'.
+        '''
+        assert Htype in h_all_types, "Wrong hktypes"
+
         switch = {'ss': self.ss,
                   'sp': self.sp,
                   'sd': self.sd,
@@ -51,67 +69,87 @@ class RotationSK(object):
                   'pd': self.pd,
                   'dd': self.dd}
 
-        hs = switch.get(Htype)(Angvec, Hvalue).type(self.rot_type)
-        hs.to(self.device)
+        Angvec = Angvec.to(dtype=self.rot_type, device=self.device)
+        Hvalue = Hvalue.to(dtype=self.rot_type, device=self.device)
+        hs = switch.get(Htype)(Angvec, Hvalue)
 
         return hs
 
 
+_rot_kernels = {}
+
+def get_rot_kernels():
+    '''The batched rotation kernels, traced once per process.'''
+    if not _rot_kernels:
+        print('# initial rotate H or S func.')
+        epAngvec = th.tensor([[0.3, 0.4, 0.5],[0.5, 0.3, 0.4]]) * (2**0.5)
+        ep1 = th.tensor([[-2.7],[-2.5]])
+        ep2 = th.tensor([[-2.7, -3.1],[-2.5, -2.9]])
+        ep3 = th.tensor([[-2.7, -3.1, -3.5],[-2.5, -2.9, -3.3]])
+        _rot_kernels['ss'] = th.jit.trace(ss, [epAngvec, ep1])
+        _rot_kernels['sp'] = th.jit.trace(sp, [epAngvec, ep1])
+        _rot_kernels['sd'] = th.jit.trace(sd, [epAngvec, ep1])
+        _rot_kernels['pp'] = th.jit.trace(pp, [epAngvec, ep2])
+        _rot_kernels['pd'] = th.jit.trace(pd, [epAngvec, ep2])
+        _rot_kernels['dd'] = th.jit.trace(dd, [epAngvec, ep3])
+
+    return _rot_kernels
+
+
 def ss(Angvec: th.Tensor, SKss: th.Tensor):
     ## ss orbital no angular dependent.
-    return SKss.reshape(1,1)
+    return SKss.reshape(-1,1,1)
 
 def sp(Angvec: th.Tensor, SKsp: th.Tensor):
     #rot_mat = Angvec[[1,2,0]].reshape([3 ,1])
-    hs = Angvec.view(-1) * SKsp.view(-1)
-    return hs[[1,2,0]].reshape(3,1)
+    hs = Angvec[:,[1,2,0]] * SKsp.reshape(-1,1)
+    return hs.reshape(-1,3,1)
 
 def sd(Angvec: th.Tensor, SKsd: th.Tensor):
-    x = Angvec[0]
-    y = Angvec[1]
-    z = Angvec[2]
+    x = Angvec[:,0]
+    y = Angvec[:,1]
+    z = Angvec[:,2]
 
     s3 = 3**0.5
 
     rot_mat = th.stack([s3 * x * y, s3 * y *z, 1.5 * z**2 -0.5, \
-                        s3 * x * z, s3 * (2.0 * x ** 2 - 1.0 + z ** 2) / 2.0])
-    # [5,1]*[1,1] => [5,1]
-    hs = rot_mat * SKsd.view(-1)
+                        s3 * x * z, s3 * (2.0 * x ** 2 - 1.0 + z ** 2) / 2.0], dim=-1)
+    # [N,5]*[N,1] => [N,5]
+    hs = rot_mat * SKsd.reshape(-1,1)
 
-    return hs.reshape(5,1)
+    return hs.reshape(-1,5,1)
 
 def pp(Angvec: th.Tensor, SKpp: th.Tensor):
 
-    Angvec = Angvec[[1,2,0]].reshape(3,1)
-    mat = th.matmul(Angvec, Angvec.T)
-    rot_mat = th.stack([mat, th.eye(3)-mat], dim=-1)
+    Angvec = Angvec[:,[1,2,0]]
+    mat = Angvec.unsqueeze(2) * Angvec.unsqueeze(1)
+    # the identity is built from the input to keep the traced kernel generic in dtype and device.
+    eye = th.diag_embed(th.ones_like(Angvec))
 
-    hs = th.matmul(rot_mat, SKpp.view(2,1))
+    hs = mat * SKpp[:,0].reshape(-1,1,1) + (eye - mat) * SKpp[:,1].reshape(-1,1,1)
 
-    return hs.squeeze(-1)
+    return hs
 
 def pd(Angvec: th.Tensor, SKpd: th.Tensor):
-    p = Angvec[[1,2,0]].reshape(1,3)
-    x,y,z = Angvec[0], Angvec[1], Angvec[2]
+    p = Angvec[:,[1,2,0]]
+    x,y,z = Angvec[:,0], Angvec[:,1], Angvec[:,2]
     s3 = 3**0.5
-    d = th.stack([s3*x*y, s3*y*z, 0.5*(3*z*z-1), s3*x*z, 0.5*s3*(x*x-y*y)]).reshape(5,1)
-    pd = th.matmul(d,p)
-    fm = th.stack([x,0*x,y,z,y,0*x,-s3/3*y,2*s3/3*z,-s3/3*x,0*x,x,z,-y,0*x,x]).reshape(5,3)
-    rot_mat = th.stack([pd, fm-2*s3/3*pd], dim=-1)
+    d = th.stack([s3*x*y, s3*y*z, 0.5*(3*z*z-1), s3*x*z, 0.5*s3*(x*x-y*y)], dim=-1)
+    pd = d.unsqueeze(2) * p.unsqueeze(1)
+    fm = th.stack([x,0*x,y,z,y,0*x,-s3/3*y,2*s3/3*z,-s3/3*x,0*x,x,z,-y,0*x,x], dim=-1).reshape(-1,5,3)
 
-    hs = th.matmul(rot_mat, SKpd)
-    hs = th.reshape(hs, [5, 3])
+    hs = pd * SKpd[:,0].reshape(-1,1,1) + (fm - 2*s3/3*pd) * SKpd[:,1].reshape(-1,1,1)
 
     return hs
 
 def dd(Angvec, SKdd):
 
-    x,y,z = Angvec[0], Angvec[1], Angvec[2]
+    x,y,z = Angvec[:,0], Angvec[:,1], Angvec[:,2]
     x2, y2, z2 = x**2, y**2, z**2
     xy, yz, zx = x*y, y*z, z*x
     s3 = 3**0.5
-    d = th.stack([s3*xy, s3*yz, 0.5*(3*z2-1), s3*zx, 0.5*s3*(x2-y2)]).reshape(5,1)
-    dd0 = d @ d.T
+    d = th.stack([s3*xy, s3*yz, 0.5*(3*z2-1), s3*zx, 0.5*s3*(x2-y2)], dim=-1)
+    dd0 = d.unsqueeze(2) * d.unsqueeze(1)
     dd2 = 1/3 * dd0
     dd2 = dd2 + th.stack([
         z2,-zx,2/s3*xy,-yz,0*x, \
@@ -119,9 +157,9 @@ def dd(Angvec, SKdd):
         2/s3*xy,-s3/3*yz,2/3-z2,-s3/3*zx,s3/3*(x2-y2), \
         -yz,-xy,-s3/3*zx,y2,-zx, \
         0*x,yz,s3/3*(x2-y2),-zx,z2
-    ]).reshape(5,5)
-    rot_mat = th.stack([dd0, th.eye(5)-dd0-dd2, dd2], dim=-1)
+    ], dim=-1).reshape(-1,5,5)
+    eye = th.diag_embed(th.ones_like(d))
 
-    hs = th.matmul(rot_mat, SKdd.view(-1))
+    hs = dd0 * SKdd[:,0].reshape(-1,1,1) + (eye-dd0-dd2) * SKdd[:,1].reshape(-1,1,1) + dd2 * SKdd[:,2].reshape(-1,1,1)
 
     return hs
@@ -106,7 +106,8 @@ class NNTB(object):
             emb = torch.matmul(emb, emb.T[:,:self.axis_neuron]).reshape(-1)
             batched_dcp[flag] = torch.cat([batched_dcp[flag][0][0:3],emb])
 
-        self.env_out_dim = batched_dcp['0-0'].shape[0] - 3
+        # the descriptors of any subset of the atoms can be computed, e.g. the atoms around some moved atoms.
+        self.env_out_dim = next(iter(batched_dcp.values())).shape[0] - 3
 
         return batched_dcp # {f-i:[f,itype,i,emb_fi]}
 
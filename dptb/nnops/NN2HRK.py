@@ -1,10 +1,17 @@
 import torch
+import logging
 import numpy as np
 from dptb.structure.structure import BaseStruct
 from dptb.dataprocess.processor import Processor
 from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
+from dptb.hamiltonian.sparse_eig import SparseHR
+from dptb.hamiltonian.supercell import SupercellHR
+from dptb.hamiltonian.hamil_plan import match_bonds
 from ase import Atoms
 from dptb.utils.tools import  nnsk_correction
+from dptb.postprocess.kchunk import FermiCounter
+
+log = logging.getLogger(__name__)
 
 class NN2HRK(object):
     def __init__(self, apihost, mode):
@@ -41,6 +48,16 @@ class NN2HRK(object):
         self.if_nn_HR_ready = False
 
     def get_HR(self):
+        '''Get the real space Hamiltonian.
+
+        Returns
+        -------
+            allbonds: the bond list [nbond, 7], with columns [itype, i, jtype, j, Rx, Ry, Rz].
+            hamil_blocks: HRBlocks, the H(R) blocks grouped by bond type, ``hamil_blocks.blocks[bondtype]`` is a
+                [nbond_type, norb_i, norb_j] tensor and ``hamil_blocks.index[bondtype]`` is its index in allbonds.
+                ``hamil_blocks[ib]`` gives the block of the ib-th bond.
+            overlap_blocks: HRBlocks of the S(R) blocks, None for orthogonal basis.
+        '''
         if self.mode == 'nnsk' and not self.if_nn_HR_ready:
             self._get_nnsk_HR()
             
@@ -51,36 +68,102 @@ class NN2HRK(object):
     
     
     def get_HK(self, kpoints):
+        '''Get H(k) and S(k) at kpoints, S(k) is None for orthogonal basis.'''
         assert self.if_nn_HR_ready or self.if_dp_HR_ready, "The HR shoule be calcualted before call for HK." 
 
+        hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
         if not self.use_orthogonal_basis:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
             skmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='S', time_symm=self.time_symm)
         else:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
-            skmat = torch.eye(hkmat.shape[1], dtype=torch.complex64).unsqueeze(0).repeat(hkmat.shape[0], 1, 1)
+            skmat = None
         return hkmat, skmat
     
-    def get_eigenvalues(self,kpoints,spindeg=2, if_eigvec=False):
-        assert self.if_nn_HR_ready or self.if_dp_HR_ready, "The HR shoule be calcualted before call for HK." 
-        eigenvalues,eigenvectors = self.hamileig.Eigenvalues(kpoints, time_symm=self.time_symm, unit =self.unit, if_eigvec=if_eigvec)
-        eigks = eigenvalues.detach().numpy()
+    def get_eigenvalues(self,kpoints,spindeg=2, if_eigvec=False, eig_solver=None):
+        '''Get the eigenvalues at kpoints and the estimated Fermi level.
 
-        if if_eigvec:
-            eigvecks = eigenvectors.detach().numpy()
-        
+        Parameters
+        ----------
+        eig_solver, optional
+            the ``eig_solver`` options of the task. ``{"type": "dense", "driver": ...}`` selects the dense solver
+            backend, see ``dense_solvers``. With ``{"type": "sparse", ...}`` the sparse H(k) and an iterative solver
+            are used, see ``HamilEig.Eigenvalues_sparse``. Both accept a band_window or an energy_window to solve
+            only a part of the bands. Defaults to the dense solver with the backend selected automatically.
+        '''
+        assert self.if_nn_HR_ready or self.if_dp_HR_ready, "The HR shoule be calcualted before call for HK." 
         num_el = np.sum(self.structure.proj_atom_neles_per)
         nk = len(kpoints)
         if self.if_soc:
             spindeg = 1
-        numek = num_el * nk // spindeg
-        sorteigs =  np.sort(np.reshape(eigks,[-1]))
-        EF=(sorteigs[numek] + sorteigs[numek-1])/2
+
+        eigks, eigvecks = self.hamileig.solve_eigenvalues(kpoints, time_symm=self.time_symm, unit=self.unit, if_eigvec=if_eigvec, eig_solver=eig_solver)
+
+        # None if the occupied bands are not all solved.
+        counter = FermiCounter(num_el=num_el, nk=nk, spindeg=spindeg, eig_solver=eig_solver)
+        counter.update(kpoints, eigks)
+        EF = counter.result()
+
         if if_eigvec:
             return eigks, EF, eigvecks
         else:
             return eigks, EF
 
+    def get_velocities(self, kpoints):
+        '''Get the eigenvalues and the band velocities at kpoints in one diagonalization, see ``HamilEig.Eigenvalues_velocity``.
+
+        Returns
+        -------
+            eigks: [nk, nband] numpy array of the eigenvalues in eV.
+            velocity: [nk, nband, 3] numpy array of dE/dk in eV*Angstrom with k cartesian, i.e. hbar times the group velocity.
+        '''
+        assert self.if_nn_HR_ready or self.if_dp_HR_ready, "The HR shoule be calcualted before call for HK." 
+        with torch.no_grad():
+            eigks, velocity = self.hamileig.Eigenvalues_velocity(kpoints, time_symm=self.time_symm, unit=self.unit,
+                                                                  cell=np.asarray(self.structure.projected_struct.cell))
+
+        return eigks.numpy(), velocity.numpy()
+
+    def get_supercell_HR(self, repeat, vacancies=None, substitutions=None):
+        '''Get the sparse H(R) and S(R) of a supercell of the structure, tiled from the H(R) of the structure by
+        ``SupercellHR``, without the bonds and the SK integrals of the supercell.
+
+        Only for the nnsk models without environment dependence, i.e. the onsitemode 'none', 'uniform' or 'split',
+        and without SOC, for which the H(R) of the supercell is the one of the primitive cell.
+
+        Parameters
+        ----------
+        repeat
+            [3] the repetitions along the lattice vectors, or a [3, 3] integer matrix M, see ``SupercellHR``.
+        vacancies, optional
+            the indices of the supercell atoms to remove.
+        substitutions, optional
+            dict of {supercell atom index: [norb, norb] onsite block in eV}, the new onsite blocks of these atoms.
+
+        Returns
+        -------
+            atoms: the ase.Atoms of the supercell.
+            sparse_hr: ``SparseHR`` of the H(R) of the supercell in eV.
+            sparse_sr: ``SparseHR`` of the S(R) of the supercell, None for orthogonal basis.
+        '''
+        if self.mode != 'nnsk' or self.apihost.model_config['onsitemode'] not in ['none', 'uniform', 'split'] or self.if_soc:
+            log.error("The supercell H(R) is only tiled for the nnsk models of onsitemode 'none', 'uniform' or 'split' without SOC.")
+            raise ValueError
+        if not self.if_nn_HR_ready:
+            self._get_nnsk_HR()
+
+        supercell = SupercellHR(repeat, num_orbs_per_atom=self.hamileig.num_orbs_per_atom, vacancies=vacancies)
+        factor = self.hamileig.get_unit_factor(self.unit)
+        sparse = []
+        for HorS in (['H'] if self.use_orthogonal_basis else ['H', 'S']):
+            Rlatt, index, values = self.hamileig.hs_block_values(HorS=HorS, time_symm=self.time_symm)
+            values = values.detach().cpu().numpy() * (factor if HorS == 'H' else 1.0)
+            Rlatt, index, values = supercell.tile(Rlatt.cpu().numpy(), index.cpu().numpy(), values, time_symm=self.time_symm,
+                                                  substitutions=substitutions if HorS == 'H' else None)
+            sparse.append(SparseHR(Rlatt=Rlatt, index=index, values=values, norbs=supercell.size, time_symm=self.time_symm))
+        if self.use_orthogonal_basis:
+            sparse.append(None)
+
+        return supercell.atoms(self.structure.projected_struct), sparse[0], sparse[1]
+
     def _get_nnsk_HR(self):
         assert isinstance(self.structure, BaseStruct)
         assert self.structure.onsitemode == self.apihost.model_config['onsitemode']
@@ -112,20 +195,12 @@ class NN2HRK(object):
         else:
             soc_lambdas = None
 
+        # the bond lists are kept for the incremental update, see update_positions.
+        self.bonds_onsite, self.bonds_hoppings, self.onsite_envs = batch_bond_onsites[0][:,1:], batch_bonds[0][:,1:], onsitenvs
         self.hamileig.update_hs_list(struct=self.structure, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs, soc_lambdas=soc_lambdas)
-        self.hamileig.get_hs_blocks(bonds_onsite=batch_bond_onsites[0][:,1:], bonds_hoppings=batch_bonds[0][:,1:], 
+        self.hamileig.get_hs_blocks(bonds_onsite=self.bonds_onsite, bonds_hoppings=self.bonds_hoppings, 
                                     onsite_envs=onsitenvs)
-        
-        # 同一个类实例, 只能计算一种TB hamiltonian. 
-        self.if_nn_HR_ready = True
-        self.if_dp_HR_ready = False
-        self.use_orthogonal_basis = self.hamileig.use_orthogonal_basis
-        self.allbonds, self.hamil_blocks = self.hamileig.all_bonds, self.hamileig.hamil_blocks
-        
-        if not self.hamileig.use_orthogonal_basis:
-            self.overlap_blocks = None
-        else:
-            self.overlap_blocks = self.hamileig.overlap_blocks
+        self._store_HR()
     
     def _get_dptb_HR(self):
         predict_process = Processor(structure_list=self.structure, batchsize=1, kpoint=None, eigen_list=None, device=self.device, dtype=self.dtype, 
@@ -133,19 +208,14 @@ class NN2HRK(object):
         
         batch_bonds, batch_bond_onsites = predict_process.get_bond(sorted=self.sorted_bond)
         batch_env = predict_process.get_env(cutoff=self.apihost.model_config['env_cutoff'], sorted=self.sorted_env)
+        self.env_pairs = self._get_env_pairs(batch_env)
         batch_bond_hoppings, batch_hoppings, batch_bond_onsites, batch_onsiteEs, batch_soc_lambdas = self.apihost.nntb.calc(batch_bonds, batch_env)
 
         if  self.apihost.model_config['use_correction']:
-            coeffdict = self.apihost.sknet(mode='hopping')
-            batch_nnsk_hoppings = self.apihost.hops_fun.get_skhops( batch_bond_hoppings, coeffdict, 
-                            rcut=self.apihost.model_config["skfunction"]["sk_cutoff"], w=self.apihost.model_config["skfunction"]["sk_decay_w"])
-            nnsk_onsiteE, onsite_coeffdict = self.apihost.sknet(mode='onsite')
-            batch_nnsk_onsiteEs = self.apihost.onsite_fun(batch_bonds_onsite=batch_bond_onsites, onsite_db=self.apihost.onsite_db, nn_onsiteE=nnsk_onsiteE)
-            if self.apihost.model_config["soc"]:
-                nnsk_soc_lambdas, _ = self.apihost.sknet(mode="soc")
-                batch_nnsk_soc_lambdas = self.apihost.soc_fun(batch_bonds_onsite=batch_bond_onsites, soc_db=self.apihost.soc_db, nn_soc=nnsk_soc_lambdas)
+            onsiteEs, hoppings, soc_lambdas = self._nnsk_correction(batch_bond_hoppings, batch_hoppings, batch_bond_onsites, batch_onsiteEs, batch_soc_lambdas)
 
             if self.apihost.model_config['onsitemode'] == "strain":
+                _, onsite_coeffdict = self.apihost.sknet(mode='onsite')
                 batch_onsite_envs = predict_process.get_onsitenv(cutoff=self.apihost.model_config['onsite_cutoff'], sorted=self.sorted_onsite)
                 batch_nnsk_onsiteVs = self.apihost.onsitestrain_fun.get_skhops(batch_bonds=batch_onsite_envs, coeff_paras=onsite_coeffdict)
                 onsiteVs = batch_nnsk_onsiteVs[0]
@@ -153,36 +223,256 @@ class NN2HRK(object):
             else:
                 onsiteVs = None
                 onsitenvs = None
-
-            if self.apihost.model_config["soc"] and self.apihost.model_config["dptb"]["soc_env"]:
-                nn_soc_lambdas = batch_soc_lambdas[0]
-                sk_soc_lambdas = batch_nnsk_soc_lambdas[0]
-            else:
-                nn_soc_lambdas = None
-                if self.apihost.model_config["soc"]:
-                    sk_soc_lambdas = batch_nnsk_soc_lambdas[0]
-                else:
-                    sk_soc_lambdas = None
-                
-
-            onsiteEs, hoppings, _, _, soc_lambdas = nnsk_correction(nn_onsiteEs=batch_onsiteEs[0], nn_hoppings=batch_hoppings[0],
-                                    sk_onsiteEs=batch_nnsk_onsiteEs[0], sk_hoppings=batch_nnsk_hoppings[0],
-                                    sk_onsiteSs=None, sk_overlaps=None, nn_soc_lambdas=nn_soc_lambdas, sk_soc_lambdas=sk_soc_lambdas)
         else:
             onsiteEs, hoppings, soc_lambdas, onsiteVs, onsitenvs = batch_onsiteEs[0], batch_hoppings[0], None, None, None
 
-        
+        # the bond lists are kept for the incremental update, see update_positions.
+        self.bonds_onsite, self.bonds_hoppings, self.onsite_envs = batch_bond_onsites[0][:,1:], batch_bond_hoppings[0][:,1:], onsitenvs
         self.hamileig.update_hs_list(struct=self.structure, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs, soc_lambdas=soc_lambdas)
-        self.hamileig.get_hs_blocks(bonds_onsite=batch_bond_onsites[0][:,1:], bonds_hoppings=batch_bond_hoppings[0][:,1:],
+        self.hamileig.get_hs_blocks(bonds_onsite=self.bonds_onsite, bonds_hoppings=self.bonds_hoppings,
                                     onsite_envs=onsitenvs)
+        self._store_HR()
+
+    def _nnsk_correction(self, batch_bond_hoppings, batch_hoppings, batch_bond_onsites, batch_onsiteEs, batch_soc_lambdas):
+        '''The SK integrals of the nnsk model corrected by the outputs of the dptb model, see ``nnsk_correction``.
 
+        Returns
+        -------
+            onsiteEs, hoppings, soc_lambdas: the lists of the corrected values of the bonds of frame 0.
+        '''
+        if len(batch_bond_hoppings[0]) > 0:
+            coeffdict = self.apihost.sknet(mode='hopping')
+            nnsk_hoppings = self.apihost.hops_fun.get_skhops( batch_bond_hoppings, coeffdict, 
+                            rcut=self.apihost.model_config["skfunction"]["sk_cutoff"], w=self.apihost.model_config["skfunction"]["sk_decay_w"])[0]
+        else:
+            nnsk_hoppings = []
+        nnsk_onsiteE, _ = self.apihost.sknet(mode='onsite')
+        batch_nnsk_onsiteEs = self.apihost.onsite_fun(batch_bonds_onsite=batch_bond_onsites, onsite_db=self.apihost.onsite_db, nn_onsiteE=nnsk_onsiteE)
+        if self.apihost.model_config["soc"]:
+            nnsk_soc_lambdas, _ = self.apihost.sknet(mode="soc")
+            batch_nnsk_soc_lambdas = self.apihost.soc_fun(batch_bonds_onsite=batch_bond_onsites, soc_db=self.apihost.soc_db, nn_soc=nnsk_soc_lambdas)
+
+        if self.apihost.model_config["soc"] and self.apihost.model_config["dptb"]["soc_env"]:
+            nn_soc_lambdas = batch_soc_lambdas[0]
+            sk_soc_lambdas = batch_nnsk_soc_lambdas[0]
+        else:
+            nn_soc_lambdas = None
+            if self.apihost.model_config["soc"]:
+                sk_soc_lambdas = batch_nnsk_soc_lambdas[0]
+            else:
+                sk_soc_lambdas = None
+
+        onsiteEs, hoppings, _, _, soc_lambdas = nnsk_correction(nn_onsiteEs=batch_onsiteEs[0], nn_hoppings=batch_hoppings[0],
+                                sk_onsiteEs=batch_nnsk_onsiteEs[0], sk_hoppings=nnsk_hoppings,
+                                sk_onsiteSs=None, sk_overlaps=None, nn_soc_lambdas=nn_soc_lambdas, sk_soc_lambdas=sk_soc_lambdas)
+
+        return onsiteEs, hoppings, soc_lambdas
+
+    def _store_HR(self):
         # 同一个类实例, 只能计算一种TB hamiltonian. 
-        self.if_nn_HR_ready = False
-        self.if_dp_HR_ready = True
+        self.if_nn_HR_ready = self.mode == 'nnsk'
+        self.if_dp_HR_ready = self.mode == 'dptb'
         self.use_orthogonal_basis = self.hamileig.use_orthogonal_basis
         self.allbonds, self.hamil_blocks = self.hamileig.all_bonds, self.hamileig.hamil_blocks
 
-        if not self.hamileig.use_orthogonal_basis:
+        if self.hamileig.use_orthogonal_basis:
             self.overlap_blocks = None
         else:
             self.overlap_blocks = self.hamileig.overlap_blocks
+
+    def update_positions(self, indices, positions):
+        '''Move some atoms of the structure and update the H(R) incrementally, e.g. for the configurations of a defect
+        scan or the steps of a MD.
+
+        Only the SK integrals of the new bonds and of the bonds of the moved atoms are evaluated again, and for the dptb
+        models the descriptors, the hoppings and the onsite energies of the atoms with a moved atom in their old or new
+        environment. If the bond topology is unchanged, only the blocks of these bonds are built and written into the
+        stored H(R), see ``HamilEig.get_hs_blocks``. The result is the H(R) of ``update_struct`` with the moved
+        structure.
+
+        Parameters
+        ----------
+        indices
+            the indices of the moved atoms in the structure.
+        positions
+            [n, 3] the new cartesian positions of the moved atoms in Angstrom.
+        '''
+        if not (self.if_nn_HR_ready if self.mode == 'nnsk' else self.if_dp_HR_ready):
+            log.error("The HR should be calculated before it is updated for the moved atoms.")
+            raise ValueError
+        indices = np.asarray(indices, dtype=int).reshape(-1)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        if len(indices) != len(positions):
+            log.error("The number of the moved atoms {} and of their positions {} differ.".format(len(indices), len(positions)))
+            raise ValueError
+
+        structure = self.structure
+        atoms = structure.struct.copy()
+        atoms.positions[indices] = positions
+        self.update_struct(BaseStruct(atom=atoms, format='ase', cutoff=structure.cutoff, proj_atom_anglr_m=structure.proj_atom_anglr_m,
+                                      proj_atom_neles=structure.proj_atom_neles, onsitemode=structure.onsitemode, time_symm=structure.time_symm))
+        moved = np.zeros(len(atoms), dtype=bool)
+        moved[indices] = True
+        if self.mode == 'nnsk':
+            self._update_nnsk_HR(moved)
+        else:
+            self._update_dptb_HR(moved)
+
+    def _update_nnsk_HR(self, moved):
+        predict_process = Processor(structure_list=self.structure, batchsize=1, kpoint=None, eigen_list=None, device=self.device, dtype=self.dtype, 
+                                        env_cutoff=self.apihost.model_config['env_cutoff'], onsitemode=self.apihost.model_config['onsitemode'], onsite_cutoff=self.apihost.model_config['onsite_cutoff'], sorted_onsite="st", sorted_bond="st", sorted_env="st")
+
+        batch_bonds, _ = predict_process.get_bond(sorted=self.sorted_bond)
+        order, source = self._merge_bonds(self.bonds_hoppings, batch_bonds[0][:,1:], time_symm=self.time_symm)
+        batch_bonds = {0: batch_bonds[0][torch.from_numpy(order)]}
+        bonds = batch_bonds[0][:,1:]
+        # the SK integrals only depend on the bond, they are evaluated for the new bonds and the bonds of the moved atoms.
+        moved_proj = moved[self.structure.projatoms]
+        ij = bonds[:,[1,3]].long().cpu().numpy()
+        changed_hoppings = (source < 0) | moved_proj[ij[:,0]] | moved_proj[ij[:,1]]
+        coeffdict = self.apihost.model(mode='hopping')
+        hoppings = self._update_list(self.hamileig.hoppings, source, changed_hoppings, lambda select: self.apihost.hops_fun.get_skhops(
+            batch_bonds={0: batch_bonds[0][torch.from_numpy(select)]}, coeff_paras=coeffdict,
+            rcut=self.apihost.model_config['skfunction']['sk_cutoff'], w=self.apihost.model_config['skfunction']['sk_decay_w'])[0])
+
+        # the onsite energies and the SOC lambdas only depend on the atom types.
+        if self.apihost.model_config['onsitemode'] == 'strain':
+            _, onsite_coeffdict = self.apihost.model(mode='onsite')
+            onsitenvs, onsiteVs, changed_onsite = self._update_onsite_envs(predict_process, moved, onsite_coeffdict)
+        else:
+            onsitenvs, onsiteVs, changed_onsite = None, None, np.zeros(len(self.bonds_onsite), dtype=bool)
+
+        self.bonds_hoppings, self.onsite_envs = bonds, onsitenvs
+        self.hamileig.update_hs_list(struct=self.structure, hoppings=hoppings, onsiteEs=self.hamileig.onsiteEs, onsiteVs=onsiteVs, soc_lambdas=self.hamileig.soc_lambdas)
+        self.hamileig.get_hs_blocks(bonds_onsite=self.bonds_onsite, bonds_hoppings=bonds, onsite_envs=onsitenvs,
+                                    changed_onsite=changed_onsite, changed_hoppings=changed_hoppings)
+        self._store_HR()
+
+    def _update_dptb_HR(self, moved):
+        predict_process = Processor(structure_list=self.structure, batchsize=1, kpoint=None, eigen_list=None, device=self.device, dtype=self.dtype, 
+                                        env_cutoff=self.apihost.model_config['env_cutoff'], onsitemode=self.apihost.model_config['onsitemode'], onsite_cutoff=self.apihost.model_config['onsite_cutoff'], sorted_onsite="st", sorted_bond="st", sorted_env="st")
+
+        batch_bonds, _ = predict_process.get_bond(sorted=self.sorted_bond)
+        batch_env = predict_process.get_env(cutoff=self.apihost.model_config['env_cutoff'], sorted=self.sorted_env)
+        env_pairs = self._get_env_pairs(batch_env)
+
+        # the descriptor of an atom changes if it moved or a moved atom is in its old or new environment.
+        affected = np.zeros(len(self.structure.proj_atom_symbols), dtype=bool)
+        affected[self.structure.atom_to_proj_atom_id[np.nonzero(moved & self.structure.projatoms)[0]]] = True
+        for pairs in [self.env_pairs, env_pairs]:
+            affected[pairs[moved[pairs[:,1]], 0]] = True
+
+        order, source = self._merge_bonds(self.bonds_hoppings, batch_bonds[0][:,1:], time_symm=self.time_symm)
+        batch_bonds = {0: batch_bonds[0][torch.from_numpy(order)]}
+        bonds = batch_bonds[0][:,1:]
+        ij = bonds[:,[1,3]].long().cpu().numpy()
+        changed_hoppings = (source < 0) | affected[ij[:,0]] | affected[ij[:,1]]
+        # the hoppings need the descriptors of both atoms of the changed bonds, each from its whole environment.
+        centers = affected.copy()
+        centers[ij[changed_hoppings].reshape(-1)] = True
+
+        onsiteEs = list(self.hamileig.onsiteEs)
+        soc_lambdas = None if self.hamileig.soc_lambdas is None else list(self.hamileig.soc_lambdas)
+        changed_onsite = np.zeros(len(self.bonds_onsite), dtype=bool)
+        onsite_row = -np.ones(len(self.structure.proj_atom_symbols), dtype=int)
+        onsite_row[self.bonds_onsite[:,1].long().cpu().numpy()] = np.arange(len(self.bonds_onsite))
+        new_hoppings, position = [], None
+        if centers.any():
+            sub_env = {}
+            for envtype, env in batch_env.items():
+                env = env[torch.from_numpy(centers[env[:,2].long().cpu().numpy()]).to(env.device)]
+                if len(env) > 0:
+                    sub_env[envtype] = env
+            batched_dcp = self.apihost.nntb.get_desciptor(sub_env)
+            if changed_hoppings.any():
+                batch_bond_hoppings, batch_hoppings = self.apihost.nntb.hopping(batched_dcp=batched_dcp,
+                                                                               batch_bond={0: batch_bonds[0][torch.from_numpy(np.nonzero(changed_hoppings)[0])]})
+            else:
+                batch_bond_hoppings, batch_hoppings = {0: batch_bonds[0][:0]}, {0: []}
+            batch_bond_onsites, batch_onsiteEs, batch_soc_lambdas = self.apihost.nntb.onsite(batched_dcp=batched_dcp)
+
+            if self.apihost.model_config['use_correction']:
+                new_onsiteEs, new_hoppings, new_soc_lambdas = self._nnsk_correction(batch_bond_hoppings, batch_hoppings, batch_bond_onsites, batch_onsiteEs, batch_soc_lambdas)
+            else:
+                new_onsiteEs, new_hoppings, new_soc_lambdas = batch_onsiteEs[0], batch_hoppings[0], None
+            # the position of each bond in the outputs of the NN, which are sorted by bond type.
+            position = match_bonds(batch_bond_hoppings[0][:,1:], bonds, time_symm=self.time_symm)
+            for ib, iatom in enumerate(batch_bond_onsites[0][:,2].long().tolist()):
+                onsiteEs[onsite_row[iatom]] = new_onsiteEs[ib]
+                if soc_lambdas is not None:
+                    soc_lambdas[onsite_row[iatom]] = new_soc_lambdas[ib]
+                changed_onsite[onsite_row[iatom]] = True
+        hoppings = self._update_list(self.hamileig.hoppings, source, changed_hoppings, lambda select: [new_hoppings[ib] for ib in position[select]])
+
+        if self.apihost.model_config['use_correction'] and self.apihost.model_config['onsitemode'] == "strain":
+            _, onsite_coeffdict = self.apihost.sknet(mode='onsite')
+            onsitenvs, onsiteVs, changed_envs = self._update_onsite_envs(predict_process, moved, onsite_coeffdict)
+            changed_onsite = changed_onsite | changed_envs
+        else:
+            onsitenvs, onsiteVs = None, None
+
+        self.bonds_hoppings, self.onsite_envs, self.env_pairs = bonds, onsitenvs, env_pairs
+        self.hamileig.update_hs_list(struct=self.structure, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs, soc_lambdas=soc_lambdas)
+        self.hamileig.get_hs_blocks(bonds_onsite=self.bonds_onsite, bonds_hoppings=bonds, onsite_envs=onsitenvs,
+                                    changed_onsite=changed_onsite, changed_hoppings=changed_hoppings)
+        self._store_HR()
+
+    def _update_onsite_envs(self, predict_process, moved, onsite_coeffdict):
+        '''The onsite envs of the strain mode of the moved structure and their SK integrals, evaluated for the new envs
+        and the envs of the moved atoms.
+
+        Returns
+        -------
+            onsite_envs: the onsite env list [N_env, 11].
+            onsiteVs: the list of the SK integrals of the envs.
+            changed_onsite: [N_onsite] bool array of the atoms with a changed, new or removed onsite env.
+        '''
+        batch_onsite_envs = predict_process.get_onsitenv(cutoff=self.apihost.model_config['onsite_cutoff'], sorted=self.sorted_onsite)
+        order, source = self._merge_bonds(self.onsite_envs, batch_onsite_envs[0][:,1:], time_symm=False)
+        batch_onsite_envs = {0: batch_onsite_envs[0][torch.from_numpy(order)]}
+        onsite_envs = batch_onsite_envs[0][:,1:]
+        # i of the envs is the index of the projected atom, j the index of the atom in the structure.
+        ij = onsite_envs[:,[1,3]].long().cpu().numpy()
+        changed = (source < 0) | moved[self.structure.projatoms][ij[:,0]] | moved[ij[:,1]]
+        onsiteVs = self._update_list(self.hamileig.onsiteVs, source, changed, lambda select: self.apihost.onsitestrain_fun.get_skhops(
+            batch_bonds={0: batch_onsite_envs[0][torch.from_numpy(select)]}, coeff_paras=onsite_coeffdict)[0])
+
+        removed = match_bonds(onsite_envs, self.onsite_envs, time_symm=False) < 0
+        atoms = np.zeros(len(self.structure.proj_atom_symbols), dtype=bool)
+        atoms[ij[changed, 0]] = True
+        atoms[self.onsite_envs[:,1].long().cpu().numpy()[removed]] = True
+
+        return onsite_envs, onsiteVs, atoms[self.bonds_onsite[:,1].long().cpu().numpy()]
+
+    @staticmethod
+    def _merge_bonds(old, new, time_symm=True):
+        '''The order of the new bond list that keeps the bonds of the old list in their order, followed by the new
+        bonds, so that an unchanged bond topology gives the same plan.
+
+        Returns
+        -------
+            order: the order of the new bonds.
+            source: the position in the old list of each ordered bond, -1 for the new bonds.
+        '''
+        position = match_bonds(old, new, time_symm=time_symm)
+        found = np.nonzero(position >= 0)[0]
+        order = np.concatenate([found[np.argsort(position[found], kind='stable')], np.nonzero(position < 0)[0]])
+
+        return order, position[order]
+
+    @staticmethod
+    def _update_list(values, source, changed, evaluate):
+        '''The values of the ordered bonds, taken from the old values at source or given by evaluate(select) for the
+        changed bonds select.'''
+        updated = [values[ib] if ib >= 0 else None for ib in source]
+        select = np.nonzero(changed)[0]
+        if len(select) > 0:
+            for ib, value in zip(select, evaluate(select)):
+                updated[ib] = value
+
+        return updated
+
+    @staticmethod
+    def _get_env_pairs(batch_env):
+        '''The [N_env, 2] array of the projected atom i and the atom j of the envs of frame 0.'''
+        return np.concatenate([env[:,[2,4]].long().cpu().numpy() for env in batch_env.values()], axis=0)
@@ -1,5 +1,7 @@
 import torch
 import heapq
+import numpy as np
+from torch.utils.checkpoint import checkpoint
 import logging
 from dptb.utils.tools import get_lr_scheduler, j_must_have, get_optimizer
 from abc import ABCMeta, abstractmethod
@@ -7,6 +9,7 @@ from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 from future.utils import with_metaclass
 from dptb.utils.constants import dtype_dict
 from dptb.plugins.base_plugin import PluginUser
+from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
 
 
 log = logging.getLogger(__name__)
@@ -57,6 +60,60 @@ class Trainer(with_metaclass(ABCMeta, PluginUser)):
             self.epoch += 1
 
 
+    def get_band_window(self, loss_options):
+        '''The band window [band_min, band_max] of the eigenvalue loss, band_max is None for all the bands of the labels.
+        None if the option eig_band_window is off or the loss is not on the eigenvalues.'''
+        if not self.train_options.get("eig_band_window", True) or not loss_options['losstype'].startswith("eigs"):
+            return None
+        return [int(loss_options.get('band_min', 0)), loss_options.get('band_max', None)]
+
+    def solve_eigenvalues(self, kpoints, states, num_bands, band_window=None):
+        '''The eigenvalues of a batch of structures, as the prediction of the eigenvalue losses.
+
+        The H(R) of the structures, given by ``HamilEig.get_state``, are brought to the same k-points and the Heff of
+        all the structures are diagonalized together by ``HamilEig.solve_Heff``. With the band window of
+        ``get_band_window``, only the bands band_min <= n < band_max are solved and carry the gradients, by the band
+        window backward of ``EighBandWindow``. The other bands are NaN, the eigenvalues keep the shape
+        [nstruct, nk, norbs] so that the losses cut the same bands. num_bands is the number of bands of the labels.
+
+        With the train option k_chunk_size, the k-points are solved chunk by chunk under activation checkpointing:
+        only the eigenvalues of each chunk are kept for the backward, which recomputes H(k), S(k) and the
+        eigendecomposition of the chunk from the H(R). The loss and the gradients are the same, the peak memory
+        scales with the chunk size instead of the number of k-points.
+        '''
+        if getattr(self, "hamileig_batch", None) is None:
+            self.hamileig_batch = HamilEig(dtype=self.hamileig.dtype, device=self.hamileig.device)
+        hamileig = self.hamileig_batch
+        time_symm = self.common_options["time_symm"]
+        hamileig.load_state(states[0])
+        norbs = max([int(np.sum(state["num_orbs_per_atom"])) * (2 if state["soc"] else 1) for state in states])
+        if band_window is not None:
+            band_min = band_window[0]
+            band_max = min(norbs, num_bands) if band_window[1] is None else int(band_window[1])
+            band_window = None if band_min == 0 and band_max == norbs else [band_min, band_max]
+
+        def solve(kchunk):
+            heffs = []
+            for state in states:
+                hamileig.load_state(state)
+                real_mask, heff = hamileig.get_Heff(kpoints=kchunk, time_symm=time_symm)
+                heffs.append(heff)
+            eigks, _ = hamileig.solve_Heff(real_mask, heffs, unit=self.common_options["unit"],
+                                           driver=self.train_options.get("eig_driver", "auto"), band_window=band_window)
+            return eigks
+
+        kpoints = np.asarray(kpoints).reshape(-1,3)
+        k_chunk_size = self.train_options.get("k_chunk_size", None)
+        if k_chunk_size is None or len(kpoints) <= k_chunk_size or not torch.is_grad_enabled():
+            eigks = solve(kpoints)
+        else:
+            eigks = torch.cat([checkpoint(solve, kpoints[ist:ist+k_chunk_size], use_reentrant=False)
+                               for ist in range(0, len(kpoints), k_chunk_size)], dim=1)
+
+        if band_window is not None:
+            eigks = torch.nn.functional.pad(eigks, (band_window[0], norbs - band_window[1]), value=float('nan'))
+        return eigks
+
     @abstractmethod
     def calc(self, **data):
         '''
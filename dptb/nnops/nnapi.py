@@ -109,7 +109,7 @@ class DeePTB(ModelAPI):
                                             sk_onsiteSs=self.skhslist.onsiteSs, 
                                             sk_overlaps=self.skhslist.overlaps)
         
-        self.hamileig.update_hs_list(structure, hoppings, onsiteEs, overlaps, onsiteSs)
+        self.hamileig.update_hs_list(struct=structure, hoppings=hoppings, onsiteEs=onsiteEs, overlaps=overlaps, onsiteSs=onsiteSs)
         self.hamileig.get_hs_blocks(bonds_onsite=np.asarray(batch_bond_onsites[0][:,1:]),
                                         bonds_hoppings=np.asarray(batch_bond_hoppings[0][:,1:]))
 
@@ -123,12 +123,11 @@ class DeePTB(ModelAPI):
     def get_HK(self, kpoints):
         assert self.if_HR_ready
 
+        hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
         if not self.hamileig.use_orthogonal_basis:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm, dtype=self.hamileig.dtype)
-            skmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='S', time_symm=self.time_symm, dtype=self.hamileig.dtype)
+            skmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='S', time_symm=self.time_symm)
         else:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm, dtype=self.hamileig.dtype)
-            skmat = torch.eye(hkmat.shape[1], dtype=torch.complex64).unsqueeze(0).repeat(hkmat.shape[0], 1, 1)
+            skmat = None
         return hkmat, skmat
     
     def get_eigenvalues(self,kpoints,spindeg=2):
@@ -220,12 +219,11 @@ class NNSK(ModelAPI):
     def get_HK(self, kpoints):
         assert self.if_HR_ready
 
+        hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
         if not self.hamileig.use_orthogonal_basis:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
             skmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='S', time_symm=self.time_symm)
         else:
-            hkmat =  self.hamileig.hs_block_R2k(kpoints=kpoints, HorS='H', time_symm=self.time_symm)
-            skmat = torch.eye(hkmat.shape[1], dtype=torch.complex64).unsqueeze(0).repeat(hkmat.shape[0], 1, 1)
+            skmat = None
         return hkmat, skmat
 
     def get_eigenvalues(self,kpoints,spindeg=2):
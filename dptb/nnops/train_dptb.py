@@ -124,7 +124,7 @@ class DPTBTrainer(Trainer):
 
         self.hamileig = HamilEig(dtype=self.dtype, device=self.device)
 
-    def calc(self, batch_bond, batch_bond_onsites, batch_env, batch_onsitenvs, structs, kpoints, eigenvalues, wannier_blocks, decompose=True):
+    def calc(self, batch_bond, batch_bond_onsites, batch_env, batch_onsitenvs, structs, kpoints, eigenvalues, wannier_blocks, decompose=True, band_window=None):
         '''
         conduct one step forward computation, used in train, test and validation.
         '''
@@ -204,8 +204,8 @@ class DPTBTrainer(Trainer):
                                         onsite_envs=onsitenvs)
             
             if decompose:
-                eigenvalues_ii, _ = self.hamileig.Eigenvalues(kpoints=kpoints, time_symm=self.common_options["time_symm"],unit=self.common_options["unit"])
-                pred.append(eigenvalues_ii)
+                # the H(R) of the structure, the Heff of all the structures are diagonalized together after the loop.
+                pred.append(self.hamileig.get_state(time_symm=self.common_options["time_symm"]))
             else:
                 assert not self.soc, "soc should not open when using wannier blocks to fit."
                 pred.append(self.hamileig.hamil_blocks) # in order of [batch_bond_onsite, batch_bonds]
@@ -219,7 +219,7 @@ class DPTBTrainer(Trainer):
 
         if decompose:
             label = torch.from_numpy(eigenvalues.astype(float)).float()
-            pred = torch.stack(pred)
+            pred = self.solve_eigenvalues(kpoints, pred, num_bands=eigenvalues.shape[-1], band_window=band_window)
 
         return pred, label
 
@@ -247,7 +247,7 @@ class DPTBTrainer(Trainer):
             def closure():
                 # calculate eigenvalues.
                 self.optimizer.zero_grad()
-                pred, label = self.calc(*data, decompose=self.decompose)
+                pred, label = self.calc(*data, decompose=self.decompose, band_window=self.get_band_window(self.loss_options))
                 loss = self.train_lossfunc(pred, label, **self.loss_options)
 
                 if self.use_reference:
@@ -255,7 +255,7 @@ class DPTBTrainer(Trainer):
                         ref_processor = self.ref_processor_list[irefset]
                         self.reference_loss_options.update(self.ref_processor_list[irefset].bandinfo)
                         for refdata in ref_processor:
-                            ref_pred, ref_label = self.calc(*refdata, decompose=self.decompose)
+                            ref_pred, ref_label = self.calc(*refdata, decompose=self.decompose, band_window=self.get_band_window(self.reference_loss_options))
                             loss += (self.batch_size * 1.0 / (self.reference_batch_size * (1+self.n_reference_sets))) * \
                                         self.train_lossfunc(ref_pred, ref_label, **self.reference_loss_options)
                 
@@ -108,7 +108,7 @@ class NNSKTrainer(Trainer):
         self.hamileig = HamilEig(dtype=self.dtype, device=self.device)
     
 
-    def calc(self, batch_bonds, batch_bond_onsites, batch_envs, batch_onsitenvs, structs, kpoints, eigenvalues, wannier_blocks, decompose=True):
+    def calc(self, batch_bonds, batch_bond_onsites, batch_envs, batch_onsitenvs, structs, kpoints, eigenvalues, wannier_blocks, decompose=True, band_window=None):
         if len(kpoints.shape) != 2: 
             log.error(msg="kpoints should have shape of [num_kp, 3].")
             raise ValueError
@@ -182,8 +182,8 @@ class NNSKTrainer(Trainer):
             if decompose:
                 #if self.run_opt["freeze"]:
                 #    kpoints = np.array([[0,0,0]])
-                eigenvalues_ii, _ = self.hamileig.Eigenvalues(kpoints=kpoints, time_symm=self.common_options["time_symm"], unit=self.common_options["unit"])
-                pred.append(eigenvalues_ii)
+                # the H(R) of the structure, the Heff of all the structures are diagonalized together after the loop.
+                pred.append(self.hamileig.get_state(time_symm=self.common_options["time_symm"]))
             else:
                 assert not self.soc, "soc should not open when using wannier blocks to fit."
                 pred.append(self.hamileig.hamil_blocks) # in order of [batch_bond_onsite, batch_bonds]
@@ -200,7 +200,7 @@ class NNSKTrainer(Trainer):
             #    label = torch.from_numpy(eigenvalues.astype(float))[:,[0],:].float()
             #else:
             label = torch.from_numpy(eigenvalues.astype(float)).float()
-            pred = torch.stack(pred)
+            pred = self.solve_eigenvalues(kpoints, pred, num_bands=eigenvalues.shape[-1], band_window=band_window)
         return pred, label
     
     def train(self) -> None:
@@ -226,7 +226,7 @@ class NNSKTrainer(Trainer):
             def closure():
                 # calculate eigenvalues.
                 self.optimizer.zero_grad()
-                pred, label = self.calc(*data, decompose=self.decompose)
+                pred, label = self.calc(*data, decompose=self.decompose, band_window=self.get_band_window(self.loss_options))
 
                 loss = self.train_lossfunc(pred, label, **self.loss_options)
 
@@ -235,7 +235,7 @@ class NNSKTrainer(Trainer):
                         ref_processor = self.ref_processor_list[irefset]
                         self.reference_loss_options.update(self.ref_processor_list[irefset].bandinfo)
                         for refdata in ref_processor:
-                            ref_pred, ref_label = self.calc(*refdata, decompose=self.decompose)
+                            ref_pred, ref_label = self.calc(*refdata, decompose=self.decompose, band_window=self.get_band_window(self.reference_loss_options))
                             loss += (self.batch_size * 1.0 / (self.reference_batch_size * (1+self.n_reference_sets))) * \
                                         self.train_lossfunc(ref_pred, ref_label, **self.reference_loss_options)
                 loss.backward()
@@ -3,6 +3,7 @@ from dptb.utils.constants import atomic_num_dict_r
 from dptb.nnsktb.formula import SKFormula
 from dptb.utils.index_mapping import Index_Mapings
 from dptb.nnsktb.skintTypes import all_skint_types, all_onsite_intgrl_types
+from dptb.hamiltonian.hamil_plan import get_bond_classes, BOND_CLASS_MAX_FRACTION
 
 
 # define the function for output all the hoppongs for given i,j.
@@ -48,8 +49,13 @@ class SKintHops(SKFormula):
         # TODO: Expand rij and compute then in a single time.
         batch_hoppings = {}
         for fi in batch_bonds.keys():
+            # the integrals only depend on the atom types and the bond length, the bonds of the same class share the
+            # integrals of their first bond. The shared tensor collects the gradients of all its bonds.
+            rep, inverse = get_bond_classes(batch_bonds[fi][:,1:], direction=False)
+            if len(rep) > BOND_CLASS_MAX_FRACTION * len(batch_bonds[fi]):
+                rep, inverse = th.arange(len(batch_bonds[fi])), None
             hoppings = []
-            for ib in range(len(batch_bonds[fi])):
+            for ib in rep.tolist():
                 ibond = batch_bonds[fi][ib,1:8]
                 rij = batch_bonds[fi][ib,8]
                 ia, ja = atomic_num_dict_r[int(ibond[0])], atomic_num_dict_r[int(ibond[2])]
@@ -58,6 +64,8 @@ class SKintHops(SKFormula):
                 paras = {'paraArray':paraArray,'rij':rij, 'iatomtype':ia, 'jatomtype':ja, 'rcut':rcut,'w':w}
                 hij = self.skhij(**paras)
                 hoppings.append(hij)
+            if inverse is not None:
+                hoppings = [hoppings[ic] for ic in inverse.tolist()]
             batch_hoppings.update({fi:hoppings})
 
         return batch_hoppings
@@ -1,6 +1,7 @@
 import numpy as np
 from dptb.utils.tools import j_must_have
 from dptb.utils.make_kpoints  import ase_kpath, abacus_kpath, vasp_kpath
+from dptb.postprocess.kchunk import KChunkEngine, EigenvalueSink
 from ase.io import read
 import ase
 import matplotlib.pyplot as plt
@@ -50,7 +51,8 @@ class bandcalc(object):
             raise ValueError
         
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi = self.apiH.get_eigenvalues(self.klist)
+        engine = KChunkEngine.from_options(self.apiH, self.band_plot_options)
+        self.eigenvalues, self.estimated_E_fermi = engine.run(self.klist, [EigenvalueSink(), engine.fermi_counter(len(self.klist))])
 
         if self.band_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.band_plot_options['E_fermi']
@@ -1,6 +1,7 @@
 import numpy as np
 from dptb.utils.tools import j_must_have
-from dptb.utils.make_kpoints import monkhorst_pack,  gamma_center, kmesh_sampling
+from dptb.utils.make_kpoints import monkhorst_pack,  gamma_center, kmesh_sampling, kmesh_irreducible, periodic_directions
+from dptb.postprocess.kchunk import KChunkEngine, EigenvalueSink, DOSAccumulator, PDOSAccumulator
 from ase.io import read
 import ase
 import matplotlib.pyplot as plt
@@ -26,11 +27,11 @@ class doscalc (object):
     def get_dos(self):
         self.mesh_grid = self.dos_plot_options['mesh_grid']
         self.isgamma = self.dos_plot_options['gamma_center']
-        self.kpoints = kmesh_sampling(meshgrid= self.mesh_grid,is_gamma_center=self.isgamma)
+        self.kpoints, self.weights = self.get_kmesh()
         sigma = self.dos_plot_options.get('sigma',0.1)
         npoints = self.dos_plot_options.get('npoints',100)
         width = self.dos_plot_options.get('width',None)
-        self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints)
+        self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints, weights=self.weights)
 
         self.omega, self.dos = self._calc_dos(sigma=sigma, npoints=npoints, width=width)
         
@@ -39,12 +40,24 @@ class doscalc (object):
                         'dos':self.dos,
                         'sigma': sigma,
                         'width': [self.omega.min(), self.omega.max()],
+                        'weights': self.weights,
                         'eigenvalues': self.eigenvalues,
                         'E_fermi': self.E_fermi}
 
         np.save(f'{self.results_path}/DOS',eigenstatus)
         return eigenstatus
         
+    def get_kmesh(self):
+        '''The k-mesh and the weights of the k-points. With use_symmetry, the mesh is reduced to the irreducible
+        k-points by the point group and the time reversal. The directions that no bond crosses, e.g. the vacuum of a
+        2D slab, are collapsed to one k-point.'''
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        use_symmetry = self.dos_plot_options.get('use_symmetry', False)
+        return kmesh_irreducible(meshgrid=self.mesh_grid, is_gamma_center=self.isgamma,
+                                 structase=self.structase if use_symmetry else None, time_reversal=use_symmetry,
+                                 periodic=periodic_directions(self.structase, all_bonds),
+                                 symprec=self.dos_plot_options.get('symprec', 1e-5))
+        
     def dos_plot(self):
         plt.figure(figsize=(5,4),dpi=100)
         
@@ -62,42 +75,53 @@ class doscalc (object):
         plt.show()
 
 
-    def _calc_dos(self, sigma=0.1, npoints=100,  width=None, updata=False, kpoints=None):
+    def _calc_dos(self, sigma=0.1, npoints=100,  width=None, updata=False, kpoints=None, weights=None):
         if kpoints is not None:
             kpoint_use = kpoints
+            weight_use = weights
         else:
             kpoint_use = self.kpoints
-        nkp = len(kpoint_use)
+            weight_use = self.weights
 
         if updata:
-            self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use)
+            self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use, weights=weight_use)
         else:
             if not hasattr(self, 'eigenvalues'):
-                self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use)
+                self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use, weights=weight_use)
 
+        # the bands out of the energy window of the sparse eigen solver are NaN.
+        eigenvalues = self.eigenvalues[np.isfinite(self.eigenvalues)]
         if width is not None:
             emin,emax = width                
             if emin is None:
-                emin = self.eigenvalues.min()
+                emin = eigenvalues.min()
             if emax is None:
-                emax = self.eigenvalues.max()
+                emax = eigenvalues.max()
         else:
-            emin, emax = self.eigenvalues.min()- 5*sigma, self.eigenvalues.max() + 5*sigma
+            emin, emax = eigenvalues.min()- 5*sigma, eigenvalues.max() + 5*sigma
 
         self.omega = np.linspace(emin, emax, npoints)
         
-        xx = self.eigenvalues.reshape(-1,1) - self.E_fermi - self.omega.reshape(1,-1)
-        self.dos = np.sum(np.exp(-(xx)**2 / (2 * sigma**2)), axis=0) / (sigma * np.sqrt(2 * np.pi)) / nkp
+        # the eigenvalues are already reduced from the k-chunks, the DOS is accumulated in one step.
+        accumulator = DOSAccumulator(omega=self.omega, E_fermi=self.E_fermi, sigma=sigma)
+        accumulator.update(kpoint_use, self.eigenvalues, weights=weight_use)
+        self.dos = accumulator.result()
 
         return self.omega, self.dos
 
     
-    def get_eigenvalues(self, kpoints):
+    def get_eigenvalues(self, kpoints, weights=None):
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi = self.apiH.get_eigenvalues(kpoints)
+        engine = KChunkEngine.from_options(self.apiH, self.dos_plot_options)
+        nk = len(kpoints) if weights is None else np.sum(weights)
+        self.eigenvalues, self.estimated_E_fermi = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(nk)], weights=weights,
+                                                              meshgrid=self.mesh_grid)
         if self.dos_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.dos_plot_options['E_fermi']
             log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
+        elif self.estimated_E_fermi is None:
+            log.error('The Fermi level can not be estimated from the bands in the window of the sparse eigen solver, please set E_fermi.')
+            raise ValueError
         else:
             self.E_fermi = self.estimated_E_fermi
             log.info(f'set E_fermi by estimated value {self.estimated_E_fermi} .')
@@ -127,11 +151,11 @@ class pdoscalc (object):
     def get_pdos(self):
         self.mesh_grid = self.pdos_plot_options['mesh_grid']
         self.isgamma = self.pdos_plot_options['gamma_center']
-        self.kpoints = kmesh_sampling(meshgrid= self.mesh_grid,is_gamma_center=self.isgamma)
+        self.kpoints, self.weights = self.get_kmesh()
         sigma = self.pdos_plot_options.get('sigma',0.1)
         npoints = self.pdos_plot_options.get('npoints',100)
         width = self.pdos_plot_options.get('width',None)
-        self.eigenvalues, self.E_fermi, self.eigenvectors = self.get_eigenvalues(kpoints=self.kpoints)
+        self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints, weights=self.weights)
 
         self.omega, self.pdos = self._calc_pdos(sigma=sigma, npoints=npoints, width=width)
 
@@ -140,12 +164,21 @@ class pdoscalc (object):
                         'pdos':self.pdos,
                         'sigma': sigma,
                         'width': [self.omega.min(), self.omega.max()],
+                        'weights': self.weights,
                         'eigenvalues': self.eigenvalues,
                         'E_fermi': self.E_fermi}
 
         np.save(f'{self.results_path}/proj_DOS',eigenstatus)
         return eigenstatus
         
+    def get_kmesh(self):
+        '''The k-mesh and the weights of the k-points, see ``doscalc.get_kmesh``. The projection on an orbital is not
+        invariant under the point group, with use_symmetry only the time reversal is used, and only without SOC.'''
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        time_reversal = self.pdos_plot_options.get('use_symmetry', False) and not self.apiH.if_soc
+        return kmesh_irreducible(meshgrid=self.mesh_grid, is_gamma_center=self.isgamma, structase=None,
+                                 time_reversal=time_reversal, periodic=periodic_directions(self.structase, all_bonds))
+        
     def pdos_plot(self, atom_index=None, orbital_index=None):
         
         if atom_index is None:
@@ -186,18 +219,24 @@ class pdoscalc (object):
         plt.show()
 
 
-    def _calc_pdos(self, sigma=0.1, npoints=100,  width=None, updata=False, kpoints=None):
+    def _calc_pdos(self, sigma=0.1, npoints=100,  width=None, updata=False, kpoints=None, weights=None):
+        '''The orbital projected DOS, PDOS_a(w) = 1/nk \\sum_{k,n} |v_{kn}(a)|^2 g(w + E_fermi - e_kn).
+
+        The eigenvectors are solved and reduced chunk by chunk by ``PDOSAccumulator``, after the eigenvalues have
+        given the Fermi level and the energy grid.
+        '''
         if kpoints is not None:
             kpoint_use = kpoints
+            weight_use = weights
         else:
             kpoint_use = self.kpoints
-        nkp = len(kpoint_use)
+            weight_use = self.weights
 
         if updata:
-            self.eigenvalues, self.E_fermi, self.eigenvectors = self.get_eigenvalues(kpoints=kpoint_use)
+            self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use, weights=weight_use)
         else:
             if not hasattr(self, 'eigenvalues'):
-                self.eigenvalues, self.E_fermi, self.eigenvectors = self.get_eigenvalues(kpoints=kpoint_use)
+                self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=kpoint_use, weights=weight_use)
         
         if width is not None:
             emin,emax = width                
@@ -210,19 +249,19 @@ class pdoscalc (object):
 
         self.omega = np.linspace(emin, emax, npoints)
         
-        # prob = self.eigenvectors.abs()**2
-        prob = np.abs(self.eigenvectors)**2
-        xx = (self.omega[np.newaxis,np.newaxis,:] - self.eigenvalues[:,:,np.newaxis] + self.E_fermi)
-        dos_e_k = np.exp(-(xx)**2 / (2 * sigma**2)) / (sigma * np.sqrt(2 * np.pi))
-        pdos_e_k = prob[:,:,:,np.newaxis]  * dos_e_k[:,:,np.newaxis,:]
-        self.pdos = np.sum(np.sum(pdos_e_k,axis=0),axis=0) / nkp
+        engine = KChunkEngine.from_options(self.apiH, self.pdos_plot_options)
+        self.pdos, = engine.run(kpoint_use, [PDOSAccumulator(omega=self.omega, E_fermi=self.E_fermi, sigma=sigma)], weights=weight_use,
+                                meshgrid=self.mesh_grid)
 
         return self.omega, self.pdos
 
     
-    def get_eigenvalues(self, kpoints):
+    def get_eigenvalues(self, kpoints, weights=None):
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi, self.eigenvectors = self.apiH.get_eigenvalues(kpoints, if_eigvec=True)
+        engine = KChunkEngine.from_options(self.apiH, self.pdos_plot_options)
+        nk = len(kpoints) if weights is None else np.sum(weights)
+        self.eigenvalues, self.estimated_E_fermi = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(nk)], weights=weights,
+                                                              meshgrid=self.mesh_grid)
         if self.pdos_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.pdos_plot_options['E_fermi']
             log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
@@ -230,5 +269,4 @@ class pdoscalc (object):
             self.E_fermi = self.estimated_E_fermi
             log.info(f'set E_fermi by estimated value {self.estimated_E_fermi} .')
 
-        return self.eigenvalues, self.E_fermi, self.eigenvectors
-    
+        return self.eigenvalues, self.E_fermi
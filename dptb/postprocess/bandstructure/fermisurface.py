@@ -2,6 +2,7 @@ import numpy as np
 from dptb.utils.tools import j_must_have
 from dptb.utils.make_kpoints import monkhorst_pack,  gamma_center, kmesh_sampling
 from dptb.utils.make_kpoints import rot_revlatt_2D, kmesh_fs
+from dptb.postprocess.kchunk import KChunkEngine, EigenvalueSink, BandEdgeTracker
 from ase.io import read
 import ase
 from scipy.interpolate import  interp2d, interpn
@@ -39,15 +40,14 @@ class fs3dcalc(object):
         mesh_grid_intp = [Np1,Np2,Np3]
 
         line_xyz, self.kpoints = kmesh_fs(meshgrid= mesh_grid)
-        self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints)
+        # the end points k = 1 of kmesh_fs repeat k = 0, the k-points lie on the regular mesh of N - 1 points.
+        self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints, meshgrid=[max(n-1, 1) for n in mesh_grid])
 
         # E0 = self.E_fermi + E0
         self.E0 = E0
 
-        ist = np.sum(np.sum(self.eigenvalues - (self.E_fermi + E0 - 10*sigma) < 0, axis=0) / self.eigenvalues.shape[0]  >=1) -1
-        ied = np.sum(np.sum(self.eigenvalues - (self.E_fermi + E0 + 10*sigma) > 0, axis=0) /  self.eigenvalues.shape[0] < 1) + 1
-        if ist <0:
-            ist = 0
+        # the bands crossing the window around E0, from the band edges reduced over the k-chunks.
+        ist, ied = self.band_edges.band_range(self.E_fermi + E0 - 10*sigma, self.E_fermi + E0 + 10*sigma)
         
         eig_pick = self.eigenvalues[:,ist:ied]
         eig_pick = np.reshape(eig_pick,(N1,N2,N3,ied-ist))
@@ -156,12 +156,22 @@ class fs3dcalc(object):
         out_file.write(' END_BLOCK_BANDGRID_3D')
         out_file.close()
 
-    def get_eigenvalues(self, kpoints):
+    def get_eigenvalues(self, kpoints, meshgrid=None):
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi = self.apiH.get_eigenvalues(kpoints)
+        eig_solver = self.fs_plot_options.get('eig_solver', None)
+        if eig_solver is not None and eig_solver.get('energy_window', None) is not None:
+            log.error('The Fermi surface needs the same bands at all k-points, please use the band_window of the eigen solver.')
+            raise ValueError
+        engine = KChunkEngine.from_options(self.apiH, self.fs_plot_options)
+        self.band_edges = BandEdgeTracker()
+        self.eigenvalues, self.estimated_E_fermi, _ = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(len(kpoints)), self.band_edges],
+                                                                 meshgrid=meshgrid)
         if self.fs_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.fs_plot_options['E_fermi']
             log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
+        elif self.estimated_E_fermi is None:
+            log.error('The Fermi level can not be estimated from the bands in the window of the sparse eigen solver, please set E_fermi.')
+            raise ValueError
         else:
             self.E_fermi = self.estimated_E_fermi
             log.info(f'set E_fermi by estimated value {self.estimated_E_fermi} .')
@@ -214,10 +224,7 @@ class fs2dcalc (object):
         self.eigenvalues, self.E_fermi = self.get_eigenvalues(kpoints=self.kpoints)
         E0 = self.E_fermi + E0
 
-        ist = np.sum(np.sum(self.eigenvalues - (E0 - 10*sigma) < 0, axis=0) / self.eigenvalues.shape[0]  >=1) -1
-        ied = np.sum(np.sum(self.eigenvalues - (E0 + 10*sigma) > 0, axis=0) /  self.eigenvalues.shape[0] < 1) + 1
-        if ist <0:
-            ist = 0
+        ist, ied = self.band_edges.band_range(E0 - 10*sigma, E0 + 10*sigma)
         
         eig_pick = self.eigenvalues[:,ist:ied]
         eig_pick = np.reshape(eig_pick,(N1,N2,ied-ist))
@@ -266,7 +273,9 @@ class fs2dcalc (object):
 
     def get_eigenvalues(self, kpoints):
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi = self.apiH.get_eigenvalues(kpoints)
+        engine = KChunkEngine.from_options(self.apiH, self.fs_plot_options)
+        self.band_edges = BandEdgeTracker()
+        self.eigenvalues, self.estimated_E_fermi, _ = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(len(kpoints)), self.band_edges])
         if self.fs_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.fs_plot_options['E_fermi']
             log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
@@ -5,6 +5,7 @@ import ase
 from ase.io import read
 from dptb.utils.tools import j_must_have
 from dptb.utils.make_kpoints import  kmesh_fs
+from dptb.postprocess.kchunk import KChunkEngine, EigenvalueSink, BandEdgeTracker
 
 from collections import defaultdict
 from typing import DefaultDict, List, Optional, Tuple, Union
@@ -96,10 +97,7 @@ class ifermiapi (object):
         assert len(eigenvalues.shape) == 2, 'eigenvalues must be 2D array'
         assert eigenvalues.shape[0] == kpoints.shape[0], 'eigenvalues.shape[0] must be equal to kpoints.shape[0]' 
 
-        ist = np.sum(np.sum(eigenvalues - (E_fermi + self.mu - 10*self.sigma) < 0, axis=0) / eigenvalues.shape[0] >=1) - 1
-        ied = np.sum(np.sum(eigenvalues - (E_fermi + self.mu + 10*self.sigma) > 0, axis=0) / eigenvalues.shape[0] < 1) + 1
-        if ist <0:
-            ist = 0
+        ist, ied = self.band_edges.band_range(E_fermi + self.mu - 10*self.sigma, E_fermi + self.mu + 10*self.sigma)
         
 
         eig_pick = eigenvalues[:,ist:ied]
@@ -219,7 +217,9 @@ class ifermiapi (object):
 
     def get_eigenvalues(self, kpoints):
         all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
-        self.eigenvalues, self.estimated_E_fermi = self.apiH.get_eigenvalues(kpoints)
+        engine = KChunkEngine.from_options(self.apiH, self.fs_plot_options)
+        self.band_edges = BandEdgeTracker()
+        self.eigenvalues, self.estimated_E_fermi, _ = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(len(kpoints)), self.band_edges])
         if self.fs_plot_options.get('E_fermi',None) != None:
             self.E_fermi = self.fs_plot_options['E_fermi']
             log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
@@ -0,0 +1,179 @@
+import numpy as np
+from dptb.utils.make_kpoints import kmesh_irreducible, periodic_directions
+from dptb.hamiltonian.kpm import spectral_bounds, kpm_moments, kpm_dos, kpm_integrated_dos, kpm_fermi_level
+from ase.io import read
+import ase
+import matplotlib.pyplot as plt
+import logging
+log = logging.getLogger(__name__)
+
+
+class kpmcalc (object):
+    '''The DOS, the orbital projected DOS and the Fermi level by the kernel polynomial method.
+
+    The Chebyshev moments of the DOS are estimated from sparse products of H(k) on random vectors, see
+    ``dptb.hamiltonian.kpm``, without any diagonalization. The cost is linear in the size of the structure, for the
+    large supercells where the DOS of ``doscalc`` is out of reach. The moments of the k-points of the mesh are
+    averaged with their weights, the DOS is per cell and per k-point as in ``doscalc``.
+    '''
+    def __init__ (self, apiHrk, run_opt, jdata):
+        self.apiH = apiHrk
+        if isinstance(run_opt['structure'],str):
+            self.structase = read(run_opt['structure'])
+        elif isinstance(run_opt['structure'],ase.Atoms):
+            self.structase = run_opt['structure']
+        else:
+            raise ValueError('structure must be ase.Atoms or str')
+
+        self.kpm_options = jdata
+        self.results_path = run_opt.get('results_path')
+        self.apiH.update_struct(self.structase)
+
+        self.num_orbs_per_atom = []
+        for itype in apiHrk.structure.proj_atom_symbols:
+            norbs = apiHrk.structure.proj_atomtype_norbs[itype]
+            self.num_orbs_per_atom.append(norbs)
+
+    def get_dos(self):
+        self.mesh_grid = self.kpm_options.get('mesh_grid', [1,1,1])
+        self.isgamma = self.kpm_options.get('gamma_center', False)
+        self.kpoints, self.weights = self.get_kmesh()
+        npoints = self.kpm_options.get('npoints', 400)
+        width = self.kpm_options.get('width', None)
+
+        self.bounds, self.moments, self.local_moments = self.get_moments(self.kpoints, self.weights)
+        self.E_fermi = self.get_fermi_level()
+
+        if width is not None:
+            emin, emax = width
+            emin = self.bounds[0] - self.E_fermi if emin is None else emin
+            emax = self.bounds[1] - self.E_fermi if emax is None else emax
+        else:
+            emin, emax = self.bounds[0] - self.E_fermi, self.bounds[1] - self.E_fermi
+        self.omega = np.linspace(emin, emax, npoints)
+        self.dos = kpm_dos(self.moments, self.bounds, self.omega + self.E_fermi)
+        self.integrated_dos = kpm_integrated_dos(self.moments, self.bounds, self.omega + self.E_fermi)
+        self.ldos = None
+        if self.local_moments is not None:
+            self.ldos = kpm_dos(self.local_moments, self.bounds, self.omega + self.E_fermi)
+
+        eigenstatus =  {'kpoints': self.kpoints,
+                        'omega': self.omega,
+                        'dos': self.dos,
+                        'integrated_dos': self.integrated_dos,
+                        'ldos': self.ldos,
+                        'orbitals': self.orbitals,
+                        'width': [self.omega.min(), self.omega.max()],
+                        'weights': self.weights,
+                        'bounds': self.bounds,
+                        'moments': self.moments,
+                        'local_moments': self.local_moments,
+                        'E_fermi': self.E_fermi}
+
+        np.save(f'{self.results_path}/KPM_DOS',eigenstatus)
+        return eigenstatus
+
+    def get_kmesh(self):
+        '''The k-mesh and the weights of the k-points, see ``doscalc.get_kmesh``. The large supercells of the KPM are
+        usually sampled by the Gamma point only, with the default mesh [1,1,1].'''
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        return kmesh_irreducible(meshgrid=self.mesh_grid, is_gamma_center=self.isgamma, structase=None,
+                                 time_reversal=False, periodic=periodic_directions(self.structase, all_bonds))
+
+    def get_orbitals(self):
+        '''The (atom, orbital) pairs of the local DOS and their indices in H(k), from atom_index and orbital_index as in
+        ``pdoscalc.pdos_plot``. With SOC the spin up and spin down orbitals are summed.'''
+        atom_index = self.kpm_options.get('atom_index', None)
+        orbital_index = self.kpm_options.get('orbital_index', None)
+        if atom_index is None or orbital_index is None:
+            return None, None
+        if isinstance(atom_index, int):
+            atom_index = [atom_index]
+        if isinstance(orbital_index, int):
+            orbital_index = [orbital_index]
+
+        numOrbs = np.array(self.num_orbs_per_atom)
+        pairs, indices = [], []
+        for ia in atom_index:
+            for iorb in orbital_index:
+                if iorb >= numOrbs[ia]:
+                    log.error(f'The orbital {iorb} is out of the {numOrbs[ia]} orbitals of atom {ia}.')
+                    raise ValueError
+                pairs.append([ia, iorb])
+                indices.append(np.sum(numOrbs[:ia]) + iorb)
+        indices = np.array(indices, dtype=np.int64)
+        if self.apiH.if_soc:
+            indices = np.concatenate([indices, indices + np.sum(numOrbs)])
+        return np.array(pairs), indices
+
+    def get_moments(self, kpoints, weights=None):
+        '''The spectral bounds over all the k-points and the Chebyshev moments averaged over the k-points.'''
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        hamileig = self.apiH.hamileig
+        factor = hamileig.get_unit_factor(self.apiH.unit)
+        sparse_hr = hamileig.get_sparse_hr(HorS='H', time_symm=self.apiH.time_symm)
+        sparse_sr = None if self.apiH.use_orthogonal_basis else hamileig.get_sparse_hr(HorS='S', time_symm=self.apiH.time_symm)
+        weights = np.ones(len(kpoints)) if weights is None else np.asarray(weights, dtype=np.float64).reshape(-1)
+
+        def hsk(kp):
+            return sparse_hr.Rk(kp) * factor, None if sparse_sr is None else sparse_sr.Rk(kp)
+
+        # the moments of all the k-points are summed, they must share the bounds.
+        bounds = np.array([np.inf, -np.inf])
+        for kp in kpoints:
+            kbounds = spectral_bounds(*hsk(kp))
+            bounds = np.array([min(bounds[0], kbounds[0]), max(bounds[1], kbounds[1])])
+
+        self.atom_orbitals, self.orbitals = self.get_orbitals()
+        rng = np.random.default_rng(self.kpm_options.get('seed', None))
+        num_moments = self.kpm_options.get('num_moments', 512)
+        num_random = self.kpm_options.get('num_random', 16)
+        moments, local_moments = 0.0, None
+        for kp, wk in zip(kpoints, weights):
+            hk, sk = hsk(kp)
+            mu, local = kpm_moments(hk, sk, bounds=bounds, num_moments=num_moments, num_random=num_random,
+                                    orbitals=self.orbitals, rng=rng)
+            moments = moments + wk * mu
+            if local is not None:
+                local_moments = (0.0 if local_moments is None else local_moments) + wk * local
+        moments = moments / np.sum(weights)
+        if local_moments is not None:
+            local_moments = local_moments / np.sum(weights)
+            if self.apiH.if_soc:
+                # the spin up and spin down orbitals.
+                local_moments = local_moments.reshape(2, -1, num_moments).sum(axis=0)
+                self.orbitals = self.orbitals[:len(self.orbitals) // 2]
+
+        return bounds, moments, local_moments
+
+    def get_fermi_level(self):
+        num_el = np.sum(self.apiH.structure.proj_atom_neles_per)
+        spindeg = 1 if self.apiH.if_soc else 2
+        self.estimated_E_fermi = kpm_fermi_level(self.moments, self.bounds, num_el=num_el, spindeg=spindeg)
+        if self.kpm_options.get('E_fermi',None) != None:
+            self.E_fermi = self.kpm_options['E_fermi']
+            log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
+        else:
+            self.E_fermi = self.estimated_E_fermi
+            log.info(f'set E_fermi by estimated value {self.estimated_E_fermi} .')
+        return self.E_fermi
+
+    def dos_plot(self):
+        plt.figure(figsize=(5,4),dpi=100)
+
+        plt.plot(self.omega, self.dos, 'b-',lw=1, label='Total')
+        if self.ldos is not None:
+            for (ia, iorb), ldos in zip(self.atom_orbitals, self.ldos):
+                plt.plot(self.omega, ldos, '-',lw=1, label=f'atom-{ia} orb-{iorb}')
+            plt.legend(fontsize=8)
+
+        plt.xlim(self.omega.min(),self.omega.max())
+        plt.xticks(np.linspace(self.omega.min(),self.omega.max(),5),fontsize=8)
+        plt.yticks(fontsize=8)
+        plt.ylabel('Density of states',fontsize=8)
+        plt.xlabel('E - EF (eV)',fontsize=8)
+
+        plt.tick_params(direction='in')
+        plt.tight_layout()
+        plt.savefig(f'{self.results_path}/kpm_dos.png',dpi=300)
+        plt.show()
@@ -0,0 +1,108 @@
+import numpy as np
+import scipy.sparse as sp
+from ase.neighborlist import neighbor_list
+from dptb.hamiltonian.foe import FermiOperatorExpansion
+from ase.io import read
+import ase
+import logging
+log = logging.getLogger(__name__)
+
+
+class foecalc (object):
+    '''The density matrix, the band energy, the electron count and the Mulliken populations of a large structure by the
+    Fermi operator expansion, see ``dptb.hamiltonian.foe``.
+
+    H and S are assembled at the Gamma point from the sparse H(R) and S(R) of the model, for the supercells of the MD
+    where the Gamma point samples the Brillouin zone. Without SOC they are real. With the cutoff the matrices of the
+    expansion are restricted to the orbitals of the atoms within the cutoff, the localization region of the density
+    matrix, and the cost is linear in the number of atoms.
+    '''
+    def __init__ (self, apiHrk, run_opt, jdata):
+        self.apiH = apiHrk
+        if isinstance(run_opt['structure'],str):
+            self.structase = read(run_opt['structure'])
+        elif isinstance(run_opt['structure'],ase.Atoms):
+            self.structase = run_opt['structure']
+        else:
+            raise ValueError('structure must be ase.Atoms or str')
+
+        self.foe_options = jdata
+        self.results_path = run_opt.get('results_path')
+        self.apiH.update_struct(self.structase)
+
+    def get_hsk(self):
+        '''The sparse H in eV and S at the Gamma point, S is None for orthogonal basis.'''
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        hamileig = self.apiH.hamileig
+        factor = hamileig.get_unit_factor(self.apiH.unit)
+        gamma = np.zeros(3)
+        hk = hamileig.get_sparse_hr(HorS='H', time_symm=self.apiH.time_symm).Rk(gamma) * factor
+        sk = None
+        if not self.apiH.use_orthogonal_basis:
+            sk = hamileig.get_sparse_hr(HorS='S', time_symm=self.apiH.time_symm).Rk(gamma)
+        if not self.apiH.if_soc:
+            hk = hk.real
+            sk = None if sk is None else sk.real
+        return hk, sk
+
+    def get_pattern(self, cutoff):
+        '''The sparse boolean pattern of the orbital pairs of the atoms within the cutoff in Angstrom, over the periodic
+        images, in the basis of H.'''
+        struct = self.apiH.structure.projected_struct
+        num_orbs_per_atom = self.apiH.hamileig.num_orbs_per_atom
+        natom = len(num_orbs_per_atom)
+        ii, jj = neighbor_list('ij', struct, cutoff)
+        ii, jj = np.concatenate([ii, np.arange(natom)]), np.concatenate([jj, np.arange(natom)])
+        atom_pattern = sp.csr_matrix((np.ones(len(ii), dtype=bool), (ii, jj)), shape=(natom, natom))
+        # the incidence of the orbitals on the atoms.
+        norbs = int(np.sum(num_orbs_per_atom))
+        incidence = sp.csr_matrix((np.ones(norbs), (np.arange(norbs), np.repeat(np.arange(natom), num_orbs_per_atom))),
+                                  shape=(norbs, natom))
+        pattern = (incidence @ atom_pattern @ incidence.T).astype(bool)
+        if self.apiH.if_soc:
+            pattern = sp.kron(np.ones((2,2), dtype=bool), pattern, format='csr')
+        return sp.csr_matrix(pattern)
+
+    def get_density_matrix(self):
+        hk, sk = self.get_hsk()
+        spindeg = 1 if self.apiH.if_soc else 2
+        num_el = np.sum(self.apiH.structure.proj_atom_neles_per)
+        cutoff = self.foe_options.get('cutoff', None)
+        pattern = None if cutoff is None else self.get_pattern(cutoff)
+        self.foe = FermiOperatorExpansion(hk, sk, kT=self.foe_options.get('kT', 0.1), num_terms=self.foe_options.get('num_terms', None),
+                                          threshold=self.foe_options.get('threshold', 1e-6), pattern=pattern, spindeg=spindeg)
+        log.info(f'Fermi operator expansion of {self.foe.num_terms} terms in the spectral bounds {self.foe.bounds} .')
+
+        if self.foe_options.get('E_fermi',None) != None:
+            self.mu = self.foe_options['E_fermi']
+            log.info(f'set the chemical potential from jdata: {self.mu} .')
+        else:
+            self.mu = self.foe.chemical_potential(num_el, tol=self.foe_options.get('tol', 1e-8))
+            log.info(f'set the chemical potential by bisection: {self.mu} .')
+
+        self.num_electrons = self.foe.electron_count(self.mu)
+        self.band_energy = self.foe.band_energy(self.mu)
+        self.density_matrix, populations = self.foe.density_matrix(self.mu)
+
+        # the Mulliken populations of the orbitals and of the atoms, with the spin up and down orbitals with SOC.
+        num_orbs_per_atom = self.apiH.hamileig.num_orbs_per_atom
+        self.orbital_populations = spindeg * populations
+        if self.apiH.if_soc:
+            self.orbital_populations = self.orbital_populations.reshape(2, -1).sum(axis=0)
+        atom_index = np.repeat(np.arange(len(num_orbs_per_atom)), num_orbs_per_atom)
+        self.atom_populations = np.bincount(atom_index, weights=self.orbital_populations, minlength=len(num_orbs_per_atom))
+
+        results = {'mu': self.mu,
+                   'kT': self.foe.kT,
+                   'num_electrons': self.num_electrons,
+                   'band_energy': self.band_energy,
+                   'orbital_populations': self.orbital_populations,
+                   'atom_populations': self.atom_populations,
+                   'charges': self.apiH.structure.proj_atom_neles_per - self.atom_populations,
+                   'bounds': self.foe.bounds,
+                   'num_terms': self.foe.num_terms}
+
+        np.save(f'{self.results_path}/FOE', results)
+        # the density matrix per spin.
+        sp.save_npz(f'{self.results_path}/density_matrix.npz', self.density_matrix)
+        return results
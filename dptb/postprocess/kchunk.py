@@ -0,0 +1,361 @@
+import numpy as np
+import torch
+import logging
+import os
+from functools import partial
+from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
+
+log = logging.getLogger(__name__)
+
+# the default memory budget in GB of the k-chunks.
+DEFAULT_MEMORY_BUDGET = 4.0
+# the number of [norbs, norbs] complex matrices held per k-point during the diagonalization: H(k), the phase sum
+# before the time symmetrization, Heff, the eigenvectors and the LAPACK workspace, and S(k) with its Cholesky factor
+# for the non-orthogonal basis.
+NUM_MATRICES_PER_K = 5
+NUM_MATRICES_PER_K_OVERLAP = 2
+
+
+class KChunkEngine(object):
+    """ Evaluate the eigenvalues on a k-point set chunk by chunk and stream the chunks through the reducers.
+
+    The k-points are split into chunks whose H(k), S(k) and eigenvector stacks fit into the memory budget, so the full
+    [nk, norbs, norbs] arrays never exist. Each chunk is passed to every reducer before the next one is solved, the
+    reducers keep only what they accumulate, e.g. the eigenvalues, the DOS or the band edges.
+
+    With num_workers > 1 the chunks are solved by a pool of processes. The H(R) and S(R) triplets are put in shared
+    memory once, each worker builds its own H(k) from them, and the chunks are gathered in order.
+
+    Parameters
+    ----------
+    apiHrk
+        the ``NN2HRK`` object, with the H(R) of the structure ready.
+    eig_solver, optional
+        the ``eig_solver`` options passed to ``HamilEig.solve_eigenvalues``.
+    memory_budget, optional
+        the memory budget of the chunks in GB, shared by the workers, defaults to ``DEFAULT_MEMORY_BUDGET``.
+    chunk_size, optional
+        the number of k-points per chunk, overrides the memory budget.
+    num_workers, optional
+        the number of worker processes, defaults to 1, i.e. the chunks are solved in the current process.
+    num_threads, optional
+        the number of torch threads of each worker, defaults to the number of cores divided by num_workers.
+    fft, optional
+        if True, the H(k) and S(k) of the k-points on the regular mesh given to ``run`` are gathered from one FFT of
+        the whole mesh, see ``HamilEig.set_fft_mesh``. Defaults to True.
+    """
+    def __init__(self, apiHrk, eig_solver=None, memory_budget=None, chunk_size=None, num_workers=1, num_threads=None, fft=True) -> None:
+        self.apiH = apiHrk
+        self.eig_solver = eig_solver
+        self.memory_budget = DEFAULT_MEMORY_BUDGET if memory_budget is None else memory_budget
+        if self.memory_budget <= 0:
+            log.error('The memory budget of the k-chunks should be positive.')
+            raise ValueError
+        self.chunk_size = chunk_size
+        if num_workers < 1:
+            log.error('The number of workers should be at least 1.')
+            raise ValueError
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.fft = fft
+
+    @classmethod
+    def from_options(cls, apiHrk, options):
+        '''Build the engine from the options of a task: eig_solver, memory_budget, num_workers, num_threads and fft_hk.'''
+        return cls(apiHrk, eig_solver=options.get('eig_solver', None), memory_budget=options.get('memory_budget', None),
+                   num_workers=options.get('num_workers', 1), num_threads=options.get('num_threads', None),
+                   fft=options.get('fft_hk', True))
+
+    def get_chunk_size(self, nk):
+        '''The number of k-points per chunk, estimated from the matrix size and the memory budget.'''
+        if self.chunk_size is not None:
+            return max(1, min(int(self.chunk_size), nk))
+        hamileig = self.apiH.hamileig
+        norbs = int(np.sum(hamileig.num_orbs_per_atom))
+        if hamileig.soc:
+            norbs = 2 * norbs
+        nmat = NUM_MATRICES_PER_K
+        if not hamileig.use_orthogonal_basis:
+            nmat += NUM_MATRICES_PER_K_OVERLAP
+        itemsize = 16 if hamileig.dtype is torch.float64 else 8
+        bytes_per_k = nmat * norbs * norbs * itemsize
+
+        # each worker holds one chunk, and each worker gets at least one chunk.
+        chunk_size = int(self.memory_budget * 1024**3 / self.num_workers // bytes_per_k)
+        return max(1, min(chunk_size, int(np.ceil(nk / self.num_workers))))
+
+    def fermi_counter(self, nk):
+        '''The ``FermiCounter`` of the structure for nk k-points, with weights nk is the sum of the weights.'''
+        num_el = np.sum(self.apiH.structure.proj_atom_neles_per)
+        spindeg = 1 if self.apiH.if_soc else 2
+        return FermiCounter(num_el=num_el, nk=nk, spindeg=spindeg, eig_solver=self.eig_solver)
+
+    def run(self, kpoints, reducers, weights=None, meshgrid=None):
+        '''Solve the eigenvalues at kpoints chunk by chunk and pass each chunk to the reducers.
+
+        Parameters
+        ----------
+        kpoints
+            [nk, 3] k-points in fractional coordinates.
+        reducers
+            list of the reducers, each with ``update(kpoints, eigks, eigvec, weights)`` and ``result()``. The
+            eigenvectors are only solved if one of the reducers has ``need_eigvec`` set.
+        weights, optional
+            [nk] weights of the k-points, e.g. of the irreducible k-points given by ``kmesh_irreducible``. Defaults to
+            one for each k-point.
+        meshgrid, optional
+            [N1, N2, N3] the size of the regular mesh the kpoints are taken from, e.g. the mesh of ``kmesh_sampling``,
+            to build their H(k) by FFT. The k-points off the mesh fall back to the phase sum.
+
+        Returns
+        -------
+            the list of the results of the reducers.
+        '''
+        kpoints = np.asarray(kpoints).reshape(-1,3)
+        nk = len(kpoints)
+        weights = np.ones(nk) if weights is None else np.asarray(weights).reshape(-1)
+        if len(weights) != nk:
+            log.error('The number of the weights should equal the number of k-points.')
+            raise ValueError
+        if_eigvec = any([reducer.need_eigvec for reducer in reducers])
+        chunk_size = self.get_chunk_size(nk)
+        chunks = [kpoints[ist:ist+chunk_size] for ist in range(0, nk, chunk_size)]
+        if len(chunks) > 1:
+            log.info(f'The {nk} k-points are solved in {len(chunks)} chunks of {chunk_size} k-points.')
+
+        fft_mesh = meshgrid if self.fft else None
+        if self.num_workers > 1 and len(chunks) > 1:
+            results = self._solve_parallel(chunks, if_eigvec, fft_mesh)
+        else:
+            self.apiH.hamileig.set_fft_mesh(fft_mesh, max_memory=self.memory_budget)
+            results = (self.apiH.hamileig.solve_eigenvalues(kchunk, time_symm=self.apiH.time_symm, unit=self.apiH.unit,
+                                                             if_eigvec=if_eigvec, eig_solver=self.eig_solver) for kchunk in chunks)
+
+        try:
+            for ist, (kchunk, (eigks, eigvec)) in zip(range(0, nk, chunk_size), zip(chunks, results)):
+                for reducer in reducers:
+                    reducer.update(kchunk, eigks, eigvec, weights=weights[ist:ist+chunk_size])
+                del eigvec
+        finally:
+            # the H(k) of the mesh is only kept during the run.
+            self.apiH.hamileig.set_fft_mesh(None)
+
+        return [reducer.result() for reducer in reducers]
+
+    def _solve_parallel(self, chunks, if_eigvec, fft_mesh=None):
+        '''Solve the chunks by the worker processes, yield the results in the order of the chunks.'''
+        num_workers = min(self.num_workers, len(chunks))
+        num_threads = self.num_threads or max(1, (os.cpu_count() or 1) // num_workers)
+        log.info(f'The k-chunks are solved by {num_workers} processes with {num_threads} threads each.')
+        state = self.apiH.hamileig.get_shared_state(time_symm=self.apiH.time_symm)
+        ctx = torch.multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=num_workers, initializer=_init_worker,
+                      initargs=(state, self.apiH.time_symm, self.apiH.unit, num_threads, fft_mesh,
+                                self.memory_budget / num_workers)) as pool:
+            solve = partial(_solve_chunk, if_eigvec=if_eigvec, eig_solver=self.eig_solver)
+            for result in pool.imap(solve, chunks):
+                yield result
+
+
+# the Hamiltonian of a worker process, built by _init_worker from the shared state.
+_worker_state = {}
+
+def _init_worker(state, time_symm, unit, num_threads, fft_mesh=None, max_memory=None):
+    torch.set_num_threads(num_threads)
+    _worker_state["hamileig"] = HamilEig.from_shared_state(state)
+    _worker_state["hamileig"].set_fft_mesh(fft_mesh, max_memory=max_memory)
+    _worker_state["time_symm"] = time_symm
+    _worker_state["unit"] = unit
+
+def _solve_chunk(kpoints, if_eigvec=False, eig_solver=None):
+    return _worker_state["hamileig"].solve_eigenvalues(kpoints, time_symm=_worker_state["time_symm"], unit=_worker_state["unit"],
+                                                       if_eigvec=if_eigvec, eig_solver=eig_solver)
+
+
+class EigenvalueSink(object):
+    """ Collect the eigenvalues of all the chunks into a [nk, nband] array.
+
+    With the energy window of the eigen solvers the number of bands differs between chunks, the missing ones are NaN.
+    """
+    need_eigvec = False
+
+    def __init__(self) -> None:
+        self.eigks = []
+
+    def update(self, kpoints, eigks, eigvec=None, weights=None):
+        self.eigks.append(np.asarray(eigks))
+
+    def result(self):
+        nband = max([eigks.shape[1] for eigks in self.eigks])
+        out = np.full((sum([len(eigks) for eigks in self.eigks]), nband), np.nan, dtype=self.eigks[0].dtype)
+        ist = 0
+        for eigks in self.eigks:
+            out[ist:ist+len(eigks), :eigks.shape[1]] = eigks
+            ist += len(eigks)
+        return out
+
+
+class FermiCounter(object):
+    """ The Fermi level counted from the eigenvalues, as the middle of the highest occupied and the lowest unoccupied
+    levels over all the k-points, the same as ``NN2HRK.get_eigenvalues``.
+
+    Only the numek + 1 lowest eigenvalues seen so far are kept, with numek = num_el * nk // spindeg the number of
+    occupied levels of the whole k-point set. With the integer weights of the irreducible k-points, each eigenvalue is
+    counted as many times as its weight, the same as on the full mesh.
+
+    Parameters
+    ----------
+    num_el
+        the number of electrons per cell.
+    nk
+        the total number of k-points, or the sum of the weights.
+    spindeg, optional
+        the spin degeneracy, 2 without SOC and 1 with SOC, defaults to 2.
+    eig_solver, optional
+        the ``eig_solver`` options of the eigenvalues. If the band or energy window does not contain all the occupied
+        bands, the Fermi level can not be counted and the result is None.
+    """
+    need_eigvec = False
+
+    def __init__(self, num_el, nk, spindeg=2, eig_solver=None) -> None:
+        self.numek = int(num_el * nk // spindeg)
+        self.lowest = np.zeros(0)
+        self.counts = np.zeros(0)
+        eig_solver = eig_solver if eig_solver is not None else {}
+        band_window = eig_solver.get("band_window", None)
+        self.countable = eig_solver.get("energy_window", None) is None and \
+            (band_window is None or band_window[0] == 0 and band_window[1] * nk > self.numek)
+
+    def update(self, kpoints, eigks, eigvec=None, weights=None):
+        eigks = np.asarray(eigks)
+        counts = np.ones(eigks.shape) if weights is None else np.broadcast_to(np.asarray(weights).reshape(-1,1), eigks.shape)
+        finite = np.isfinite(eigks)
+        eigks = np.concatenate([self.lowest, eigks[finite]])
+        counts = np.concatenate([self.counts, counts[finite]])
+        keep = self.numek + 1
+        if len(eigks) > keep:
+            # the keep lowest eigenvalues hold at least keep levels whatever the weights are.
+            part = np.argpartition(eigks, keep - 1)[:keep]
+            eigks, counts = eigks[part], counts[part]
+        order = np.argsort(eigks, kind='stable')
+        eigks, counts = eigks[order], counts[order]
+        # drop the eigenvalues above the first numek + 1 levels.
+        nkeep = int(np.searchsorted(np.cumsum(counts), keep - 0.5)) + 1
+        self.lowest, self.counts = eigks[:nkeep], counts[:nkeep]
+
+    def result(self):
+        if not self.countable or np.sum(self.counts) < self.numek + 1 - 0.5 or self.numek < 1:
+            # the occupied bands are not all solved.
+            return None
+        levels = np.cumsum(self.counts)
+        homo = self.lowest[np.searchsorted(levels, self.numek - 0.5)]
+        lumo = self.lowest[np.searchsorted(levels, self.numek + 0.5)]
+        return (lumo + homo) / 2
+
+
+class BandEdgeTracker(object):
+    """ Track the minimum and the maximum of each band over the k-points, and the k-points where they are found.
+
+    Parameters
+    ----------
+    num_occ, optional
+        the number of occupied bands, if given the result also contains the valence band maximum, the conduction band
+        minimum and the gap.
+    """
+    need_eigvec = False
+
+    def __init__(self, num_occ=None) -> None:
+        self.num_occ = num_occ
+        self.band_min, self.band_max = None, None
+        self.kmin, self.kmax = None, None
+
+    def update(self, kpoints, eigks, eigvec=None, weights=None):
+        eigks = np.asarray(eigks)
+        if self.band_min is None:
+            nband = eigks.shape[1]
+            self.band_min, self.band_max = np.full(nband, np.inf), np.full(nband, -np.inf)
+            self.kmin, self.kmax = np.zeros((nband, 3)), np.zeros((nband, 3))
+        # the bands out of the energy window of the eigen solver are NaN, they are skipped.
+        eigks = eigks[:, :len(self.band_min)]
+        nband = eigks.shape[1]
+        finite = np.isfinite(eigks)
+        imin = np.argmin(np.where(finite, eigks, np.inf), axis=0)
+        imax = np.argmax(np.where(finite, eigks, -np.inf), axis=0)
+        emin, emax = eigks[imin, np.arange(nband)], eigks[imax, np.arange(nband)]
+
+        lower = finite[imin, np.arange(nband)] & (emin < self.band_min[:nband])
+        self.band_min[:nband][lower], self.kmin[:nband][lower] = emin[lower], kpoints[imin[lower]]
+        higher = finite[imax, np.arange(nband)] & (emax > self.band_max[:nband])
+        self.band_max[:nband][higher], self.kmax[:nband][higher] = emax[higher], kpoints[imax[higher]]
+
+    def result(self):
+        edges = {'band_min': self.band_min, 'band_max': self.band_max, 'kmin': self.kmin, 'kmax': self.kmax}
+        if self.num_occ is not None and 0 < self.num_occ < len(self.band_min):
+            edges['vbm'] = self.band_max[self.num_occ-1]
+            edges['cbm'] = self.band_min[self.num_occ]
+            edges['kvbm'] = self.kmax[self.num_occ-1]
+            edges['kcbm'] = self.kmin[self.num_occ]
+            edges['gap'] = max(edges['cbm'] - edges['vbm'], 0.0)
+        return edges
+
+    def band_range(self, emin, emax):
+        '''The band index range [ist, ied) of the bands which cross the energy window [emin, emax] at some k-point,
+        widened by one band on each side as used for the Fermi surface interpolation.'''
+        ist = int(np.sum(self.band_max < emin)) - 1
+        ied = int(np.sum(self.band_min <= emax)) + 1
+        return max(ist, 0), ied
+
+
+class DOSAccumulator(object):
+    """ Accumulate the Gaussian smeared density of states, DOS(w) = 1/nk \\sum_{k,n} g(w + E_fermi - e_kn).
+    With the weights of the k-points, DOS(w) = \\sum_{k,n} w_k g(w + E_fermi - e_kn) / \\sum_k w_k.
+
+    Parameters
+    ----------
+    omega
+        the energy grid relative to the Fermi level.
+    E_fermi
+        the Fermi level.
+    sigma, optional
+        the Gaussian broadening, defaults to 0.1.
+    """
+    need_eigvec = False
+
+    def __init__(self, omega, E_fermi, sigma=0.1) -> None:
+        self.omega = np.asarray(omega)
+        self.E_fermi = E_fermi
+        self.sigma = sigma
+        self.dos = 0.0
+        self.nk = 0
+
+    def update(self, kpoints, eigks, eigvec=None, weights=None):
+        eigks = np.asarray(eigks)
+        weights = np.ones(len(eigks)) if weights is None else np.asarray(weights).reshape(-1)
+        self.nk += np.sum(weights)
+        # the bands out of the energy window of the eigen solver are NaN.
+        finite = np.isfinite(eigks)
+        weights = np.broadcast_to(weights.reshape(-1,1), eigks.shape)[finite]
+        xx = eigks[finite].reshape(-1,1) - self.E_fermi - self.omega.reshape(1,-1)
+        self.dos = self.dos + weights @ np.exp(-(xx)**2 / (2 * self.sigma**2)) / (self.sigma * np.sqrt(2 * np.pi))
+
+    def result(self):
+        return self.dos / self.nk
+
+
+class PDOSAccumulator(DOSAccumulator):
+    """ Accumulate the orbital projected density of states,
+    PDOS_a(w) = 1/nk \\sum_{k,n} |v_{kn}(a)|^2 g(w + E_fermi - e_kn), with a the orbital index.
+    See ``DOSAccumulator`` for the parameters.
+    """
+    need_eigvec = True
+
+    def update(self, kpoints, eigks, eigvec=None, weights=None):
+        eigks = np.asarray(eigks)
+        weights = np.ones(len(eigks)) if weights is None else np.asarray(weights).reshape(-1)
+        self.nk += np.sum(weights)
+        prob = np.abs(np.asarray(eigvec))**2 * weights.reshape(-1,1,1)
+        xx = self.omega[np.newaxis,np.newaxis,:] - eigks[:,:,np.newaxis] + self.E_fermi
+        dos_e_k = np.exp(-(xx)**2 / (2 * self.sigma**2)) / (self.sigma * np.sqrt(2 * np.pi))
+        # the bands out of the energy window of the eigen solver are NaN, they do not contribute.
+        dos_e_k = np.where(np.isfinite(dos_e_k), dos_e_k, 0.0)
+        self.dos = self.dos + np.einsum('kan,knw->aw', prob, dos_e_k)
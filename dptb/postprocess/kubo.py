@@ -0,0 +1,113 @@
+import numpy as np
+from dptb.utils.make_kpoints import periodic_directions
+from dptb.hamiltonian.kpm import kpm_fermi_level
+from dptb.hamiltonian.kubo import kubo_moments, kubo_conductivity
+from ase.io import read
+import ase
+import matplotlib.pyplot as plt
+import logging
+log = logging.getLogger(__name__)
+
+
+class kubocalc (object):
+    '''The Kubo conductivity and the mean square displacements of a large structure by the time evolution of random phase
+    states, see ``dptb.hamiltonian.kubo``.
+
+    H and the velocity operators are assembled at the Gamma point from the sparse H(R) of the model, the structure is a
+    supercell large enough that the states do not spread over it within the simulated time. Only sparse products are
+    used, e.g. for the disordered samples of 10^6 orbitals, without exporting the Hamiltonian to an external code.
+    '''
+    def __init__ (self, apiHrk, run_opt, jdata):
+        self.apiH = apiHrk
+        if isinstance(run_opt['structure'],str):
+            self.structase = read(run_opt['structure'])
+        elif isinstance(run_opt['structure'],ase.Atoms):
+            self.structase = run_opt['structure']
+        else:
+            raise ValueError('structure must be ase.Atoms or str')
+
+        self.kubo_options = jdata
+        self.results_path = run_opt.get('results_path')
+        self.apiH.update_struct(self.structase)
+
+    def get_conductivity(self):
+        all_bonds, hamil_blocks, overlap_blocks = self.apiH.get_HR()
+        if not self.apiH.use_orthogonal_basis:
+            log.error('The Kubo conductivity by the time evolution is only implemented for the orthogonal basis.')
+            raise ValueError
+        directions = self.kubo_options.get('directions', ['x'])
+        if any(direction not in ['x', 'y', 'z'] for direction in directions):
+            log.error(f'The directions {directions} should be in x, y, z.')
+            raise ValueError
+
+        hamileig = self.apiH.hamileig
+        factor = hamileig.get_unit_factor(self.apiH.unit)
+        struct = self.apiH.structure.projected_struct
+        gamma = np.zeros(3)
+        hk = hamileig.get_sparse_hr(HorS='H', time_symm=self.apiH.time_symm).Rk(gamma) * factor
+        velocities = hamileig.get_sparse_velocity(positions=struct.positions, cell=np.asarray(struct.cell), time_symm=self.apiH.time_symm)
+        velocities = [velocities['xyz'.index(direction)].Rk(gamma) * factor for direction in directions]
+
+        rng = np.random.default_rng(self.kubo_options.get('seed', None))
+        self.bounds, self.times, self.dos_moments, self.msd_moments = kubo_moments(hk, velocities,
+            time_step=self.kubo_options.get('time_step', 1.0), num_steps=self.kubo_options.get('num_steps', 100),
+            num_moments=self.kubo_options.get('num_moments', 512), num_random=self.kubo_options.get('num_random', 1), rng=rng)
+
+        num_el = np.sum(self.apiH.structure.proj_atom_neles_per)
+        spindeg = 1 if self.apiH.if_soc else 2
+        self.estimated_E_fermi = kpm_fermi_level(self.dos_moments, self.bounds, num_el=num_el, spindeg=spindeg)
+        if self.kubo_options.get('E_fermi',None) != None:
+            self.E_fermi = self.kubo_options['E_fermi']
+            log.info(f'set E_fermi from jdata: {self.E_fermi} , While the estimated value is {self.estimated_E_fermi} .')
+        else:
+            self.E_fermi = self.estimated_E_fermi
+            log.info(f'set E_fermi by estimated value {self.estimated_E_fermi} .')
+
+        width = self.kubo_options.get('width', None)
+        emin, emax = (self.bounds[0] - self.E_fermi, self.bounds[1] - self.E_fermi) if width is None else width
+        self.omega = np.linspace(emin, emax, self.kubo_options.get('npoints', 400))
+        self.dos, self.msd, self.sigma_t, self.sigma = kubo_conductivity(self.dos_moments, self.msd_moments, self.bounds,
+            self.omega + self.E_fermi, self.times, measure=self.get_measure(all_bonds), spindeg=spindeg)
+
+        results = {'omega': self.omega,
+                   'times': self.times,
+                   'directions': directions,
+                   'dos': self.dos,
+                   'msd': self.msd,
+                   'sigma_t': self.sigma_t,
+                   'sigma': self.sigma,
+                   'bounds': self.bounds,
+                   'dos_moments': self.dos_moments,
+                   'msd_moments': self.msd_moments,
+                   'E_fermi': self.E_fermi}
+
+        np.save(f'{self.results_path}/KUBO', results)
+        return results
+
+    def get_measure(self, all_bonds=None):
+        '''The volume, the area or the length of the cell along its periodic directions, in Angstrom^d.'''
+        periodic = periodic_directions(self.structase, all_bonds)
+        cell = np.asarray(self.apiH.structure.projected_struct.cell)[periodic]
+        if len(cell) == 0:
+            return 1.0
+        return float(np.sqrt(np.linalg.det(cell @ cell.T)))
+
+    def kubo_plot(self):
+        fig, axes = plt.subplots(1, 2, figsize=(9,4), dpi=100)
+        iE = np.argmin(np.abs(self.omega))
+        for idir, direction in enumerate(self.kubo_options.get('directions', ['x'])):
+            axes[0].plot(self.omega, self.sigma[idir], '-', lw=1, label=f'{direction}{direction}')
+            axes[1].plot(self.times, self.msd[idir, :, iE], '-', lw=1, label=f'{direction}{direction}')
+
+        axes[0].set_xlim(self.omega.min(), self.omega.max())
+        axes[0].set_xlabel('E - EF (eV)', fontsize=8)
+        axes[0].set_ylabel('Conductivity (e$^2$/h)', fontsize=8)
+        axes[1].set_xlabel('Time (fs)', fontsize=8)
+        axes[1].set_ylabel('MSD at EF ($\\AA^2$)', fontsize=8)
+        for ax in axes:
+            ax.tick_params(direction='in', labelsize=8)
+            ax.legend(fontsize=8)
+
+        plt.tight_layout()
+        plt.savefig(f'{self.results_path}/kubo.png',dpi=300)
+        plt.show()
@@ -10,6 +10,7 @@ import os
 import torch
 import logging
 from dptb.utils.tools import write_skparam
+from dptb.hamiltonian.hr_blocks import HRBlocks
 from scipy import integrate
 
 log = logging.getLogger(__name__)
@@ -54,11 +55,15 @@ class TBPLaS(object):
         
         if os.path.exists(os.path.join(self.results_path, "HR.pth")):
             f = torch.load(os.path.join(self.results_path, "HR.pth"))
-            self.all_bonds, self.hamil_blocks = f["bonds"], f["HR"]
+            if "HR_index" in f:
+                self.all_bonds, self.hamil_blocks = f["bonds"], HRBlocks(blocks=f["HR"], index=f["HR_index"])
+            else:
+                # HR.pth saved as a list of blocks.
+                self.all_bonds, self.hamil_blocks = f["bonds"], HRBlocks.from_list(f["HR"], f["bonds"])
         else:
             self.all_bonds, self.hamil_blocks, self.overlap_blocks = self.apiH.get_HR()
             assert self.overlap_blocks is None
-            torch.save({"bonds":self.all_bonds, "HR":self.hamil_blocks}, os.path.join(self.results_path, "HR.pth"))
+            torch.save({"bonds":self.all_bonds, "HR":self.hamil_blocks.detach().blocks, "HR_index":self.hamil_blocks.index}, os.path.join(self.results_path, "HR.pth"))
 
         proj_atom_anglr_m = self.apiH.structure.proj_atom_anglr_m
         orbs = {}
@@ -106,28 +111,23 @@ class TBPLaS(object):
                     tbplus_cell.add_orbital(self.structase[i].scaled_position, 
                                             energy=onsite_blocks[io,io].item(), label=orbs[label][io])
         # accum_norbs = np.cumsum(accum_norbs)
-        # off-diagonal part
+        # off-diagonal part, the blocks of each bond type are processed together.
+        orb_start = torch.zeros(len(self.apiH.structure.proj_atom_symbols), dtype=torch.long)
+        for i, label in enumerate(self.apiH.structure.proj_atom_symbols):
+            orb_start[i] = orbsidict[str(i)+"-"+orbs[label][0]]
         
-        for ix, bond in enumerate(self.all_bonds):
-            i, j, Rx, Ry, Rz = int(bond[1]), int(bond[3]), int(bond[4]), int(bond[5]), int(bond[6])
-            block = self.hamil_blocks[ix] * factor
-            ilabel = self.apiH.structure.proj_atom_symbols[i]
-            jlabel = self.apiH.structure.proj_atom_symbols[j]
-            nx, ny = len(orbs[ilabel]), len(orbs[jlabel])
-
-            for xo in range(nx):
-                for yo in range(ny):
-                    energy = block[xo,yo].item()
-                    idx = orbsidict[str(i)+"-"+orbs[ilabel][xo]]
-                    idy = orbsidict[str(j)+"-"+orbs[jlabel][yo]]
-                    if abs(energy) > 1e-7 and not \
-                    ((R_bonds[ix] < 1e-14) & (idx==idy)):
-                        # tbplus_cell.add_hopping(rn=[Rx, Ry, Rz], 
-                        #                         orb_i=orbsidict[str(i)+"-"+orbs[ilabel][xo]],
-                        #                         orb_j=orbsidict[str(j)+"-"+orbs[jlabel][yo]],
-                        #                         energy=energy
-                        #                         )
-                        tbplus_cell._hopping_dict.add_hopping(rn=(Rx, Ry, Rz), orb_i=idx, orb_j=idy, energy=energy)
+        for _, blocks, index in self.hamil_blocks.items():
+            blocks = blocks.detach() * factor
+            bonds = self.all_bonds[index].long()
+            ib, xo, yo = torch.nonzero(blocks.abs() > 1e-7, as_tuple=True)
+            energy = blocks[ib, xo, yo]
+            idx = orb_start[bonds[ib,1]] + xo
+            idy = orb_start[bonds[ib,3]] + yo
+            rn = bonds[ib,4:7]
+            mask = ~((R_bonds[index][ib] < 1e-14) & (idx==idy))
+            for r, ix, iy, e in zip(rn[mask].tolist(), idx[mask].tolist(), idy[mask].tolist(), energy[mask].tolist()):
+                # tbplus_cell.add_hopping(rn=r, orb_i=ix, orb_j=iy, energy=e)
+                tbplus_cell._hopping_dict.add_hopping(rn=tuple(r), orb_i=ix, orb_j=iy, energy=e)
         
         if self.jdata["cal_fermi"]:
             
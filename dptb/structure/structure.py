@@ -47,6 +47,8 @@ class BaseStruct(AbstractStructure):
         self.if_env_ready = False
         self.if_onsitenv_ready = False
         self.onsite_cutoff = None
+        # the assembly plan of the hamiltonian blocks, built by HamilEig.
+        self.hamil_plan = None
 
     def updata_struct(self, atom, format, onsitemode:str='none'):
         self.init_desciption()
@@ -218,23 +220,16 @@ class BaseStruct(AbstractStructure):
 
         nbonds = bonds_.shape[0]
         if time_symm:
-            bonds_rd = []
-            bonds_rd_dict = {}
-            for inb in range(nbonds):
-                atomi, atomj, R = bonds_[inb, 0], bonds_[inb, 1], bonds_[inb, 2:]
-                bond_tmp = [atomi, atomj, R[0], R[1], R[2]]
-                bond_tmp_xc = [atomj, atomi, -R[0], -R[1], -R[2]]
-                
-                bond_tmp_key = f'{atomi}_{atomj}_{R[0]}_{R[1]}_{R[2]}'
-                bond_tmp_xc_key = f'{atomj}_{atomi}_{-R[0]}_{-R[1]}_{-R[2]}'
-
-                if not (bond_tmp_xc_key in bonds_rd_dict) and not (bond_tmp_key in bonds_rd_dict):
-                    bonds_rd_dict[bond_tmp_key] = ''
-                    bonds_rd.append(bond_tmp)
-                #if not (bond_tmp_xc in bonds_rd) and not (bond_tmp in bonds_rd):
-                #    bonds_rd.append(bond_tmp)
-
-            out_bonds = np.asarray(bonds_rd)
+            # keep the first of the bonds (i, j, R) and (j, i, -R), both are numbered by the smaller of their codes.
+            natom = len(self.projected_struct)
+            span = 2 * int(np.abs(bonds_[:, 2:]).max(initial=0)) + 1
+            def code(i, j, R):
+                R = R + span // 2
+                return (((i * natom + j) * span + R[:, 0]) * span + R[:, 1]) * span + R[:, 2]
+            bonds_ = bonds_.astype(np.int64)
+            keys = np.minimum(code(bonds_[:, 0], bonds_[:, 1], bonds_[:, 2:]), code(bonds_[:, 1], bonds_[:, 0], -bonds_[:, 2:]))
+            _, first = np.unique(keys, return_index=True)
+            out_bonds = bonds_[np.sort(first)]
         else:
             out_bonds = np.asarray(bonds_)
 
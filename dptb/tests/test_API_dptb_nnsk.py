@@ -60,7 +60,7 @@ def test_dptbapi_nnsk(root_directory):
 
     hkmat, skmat = dptb.get_HK(kpoints=klist)
     assert hkmat.shape == torch.Size([120, 8, 8])
-    assert skmat.shape == torch.Size([120, 8, 8])
+    assert skmat is None
 
     hk00 = np.array([-5.4950452e-01+0.j,  0.0000000e+00+0.j,  0.0000000e+00+0.j,
         0.0000000e+00+0.j, -2.6814380e-01+0.j, -1.6661943e-08+0.j,
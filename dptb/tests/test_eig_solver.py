@@ -0,0 +1,97 @@
+import pytest
+import numpy as np
+import torch
+from dptb.hamiltonian.eig_solver import dense_eigh, select_dense_solver, dense_solvers
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def random_hermitian(nk=2, n=60):
+    rng = np.random.default_rng(0)
+    a = rng.standard_normal((nk, n, n)) + 1j * rng.standard_normal((nk, n, n))
+    return torch.from_numpy(a + a.conj().transpose(0,2,1))
+
+@pytest.mark.parametrize('driver', list(dense_solvers.keys()))
+def test_dense_eigh_window(driver):
+    hk = random_hermitian()
+    ref = torch.linalg.eigvalsh(hk).numpy()
+
+    used, eigks, _ = dense_eigh(hk, driver=driver)
+    assert used == driver
+    assert np.abs(eigks.numpy() - ref).max() < 1e-10
+
+    _, eigks, eigvec = dense_eigh(hk, driver=driver, band_window=[3, 8], if_eigvec=True)
+    assert eigks.shape == (2, 5) and eigvec.shape == (2, 60, 5)
+    assert np.abs(eigks.numpy() - ref[:, 3:8]).max() < 1e-10
+    assert torch.allclose(hk @ eigvec, eigvec * eigks.unsqueeze(1).to(eigvec.dtype), atol=1e-8)
+
+    _, eigks, _ = dense_eigh(hk, driver=driver, energy_window=[-2.0, 2.0])
+    for ik in range(2):
+        inwin = ref[ik][(ref[ik] >= -2.0) & (ref[ik] <= 2.0)]
+        assert np.abs(eigks[ik, :len(inwin)].numpy() - inwin).max() < 1e-10
+        assert torch.isnan(eigks[ik, len(inwin):]).all()
+
+def test_select_dense_solver():
+    assert select_dense_solver(100) == "torch"
+    assert select_dense_solver(400, requires_grad=True, band_window=[0, 20]) == "window"
+    assert select_dense_solver(400, requires_grad=True, band_window=[0, 20], if_eigvec=True) == "torch"
+    assert select_dense_solver(400, band_window=[0, 20]) == "evx"
+    assert select_dense_solver(400, band_window=[0, 20], if_eigvec=True) == "evr"
+    assert select_dense_solver(400, energy_window=[-1, 1]) == "evr"
+    assert select_dense_solver(400, if_eigvec=True) == "torch"
+
+def test_dense_eigh_grad():
+    hk = random_hermitian(n=10).requires_grad_()
+    used, eigks, _ = dense_eigh(hk, driver="evr", band_window=[0, 2])
+    assert used == "window"
+    eigks.sum().backward()
+    assert hk.grad is not None
+
+    with pytest.raises(ValueError):
+        dense_eigh(hk.detach(), driver="lapack")
+
+def test_dense_eigh_energy_window_grad():
+    hk = random_hermitian(n=10)
+    ref = torch.linalg.eigh(hk)
+    hk = hk.requires_grad_()
+    used, eigks, eigvec = dense_eigh(hk, driver="evr", energy_window=[-2.0, 2.0], if_eigvec=True)
+    assert used == "torch"
+    assert eigks.requires_grad
+    inwin = (ref[0] >= -2.0) & (ref[0] <= 2.0)
+    for ik in range(2):
+        nin = int(inwin[ik].sum())
+        assert (eigks[ik, :nin] - ref[0][ik][inwin[ik]]).abs().max() < 1e-10
+        assert torch.isnan(eigks[ik, nin:]).all()
+        assert (eigvec[ik, :, nin:] == 0).all()
+    # the gradients of the eigenvalues in the window are the ones of the full spectrum.
+    torch.nan_to_num(eigks).sum().backward()
+    grad = hk.grad.clone()
+    hk.grad = None
+    torch.linalg.eigvalsh(hk)[inwin].sum().backward()
+    assert (grad - hk.grad).abs().max() < 1e-10
+
+@pytest.mark.parametrize('n', [10, 240])
+def test_eigh_band_window_grad(n):
+    from dptb.hamiltonian.eig_solver import EighBandWindow
+    hk = random_hermitian(nk=2, n=n)
+    # a threefold degenerate level cut by the lower edge of the window.
+    vec = torch.linalg.eigh(hk)[1]
+    eigs = torch.linspace(-3, 3, n, dtype=torch.float64)
+    eigs[3:6] = eigs[4]
+    hk = (vec * eigs.to(vec.dtype)) @ vec.transpose(1,2).conj()
+    hk = (0.5 * (hk + hk.transpose(1,2).conj())).requires_grad_()
+    weight = torch.linspace(1, 2, 4, dtype=torch.float64)
+
+    eigks = EighBandWindow.apply(hk, 5, 9)
+    ref = torch.linalg.eigvalsh(hk)
+    assert (eigks - ref[:, 5:9]).abs().max() < 1e-10
+
+    (eigks * weight).sum().backward()
+    grad = hk.grad.clone()
+    # the gradient is the projector on the multiplet times the mean incoming gradient.
+    proj = vec[:, :, 3:6] @ vec[:, :, 3:6].transpose(1,2).conj()
+    ref_grad = weight[0] / 3 * proj
+    for ib in range(6, 9):
+        ref_grad = ref_grad + weight[ib-5] * vec[:, :, [ib]] @ vec[:, :, [ib]].transpose(1,2).conj()
+    assert (grad - ref_grad).abs().max() < 1e-8
@@ -0,0 +1,47 @@
+import pytest
+import numpy as np
+import torch
+from dptb.hamiltonian.fft_hk import FFTHR, kmesh_index
+from dptb.utils.make_kpoints import kmesh_sampling, kmesh_fs
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def random_hr(norbs=3):
+    rng = np.random.default_rng(0)
+    Rlatt = torch.tensor([[0, 0, 0], [1, 0, 0], [-1, 2, 0], [0, -1, 1], [3, 1, -2]])
+    hR = torch.from_numpy(rng.standard_normal((len(Rlatt), norbs, norbs)) + 1j * rng.standard_normal((len(Rlatt), norbs, norbs)))
+    return Rlatt, hR
+
+def phase_sum(Rlatt, hR, kpoints):
+    phase = torch.exp(-1j * 2 * np.pi * (torch.from_numpy(kpoints) @ Rlatt.double().T))
+    return torch.einsum('kr,rij->kij', phase, hR)
+
+@pytest.mark.parametrize('is_gamma_center', [True, False])
+def test_fft_hk_kmesh(is_gamma_center):
+    Rlatt, hR = random_hr()
+    meshgrid = [4, 3, 2]
+    kpoints = kmesh_sampling(meshgrid, is_gamma_center=is_gamma_center)
+    shift, index = kmesh_index(kpoints, meshgrid)
+    assert shift is not None
+    fft = FFTHR(Rlatt, hR, meshgrid, shift=shift)
+    assert (fft.Rk(index) - phase_sum(Rlatt, hR, kpoints)).abs().max() < 1e-10
+
+    # a subset of the mesh, e.g. the irreducible k-points, is gathered from the same FFT.
+    shift_sub, index_sub = kmesh_index(kpoints[5:11], meshgrid)
+    assert shift_sub == shift
+    assert (fft.Rk(index_sub) - phase_sum(Rlatt, hR, kpoints[5:11])).abs().max() < 1e-10
+
+def test_fft_hk_kmesh_fs():
+    Rlatt, hR = random_hr()
+    meshgrid = [5, 4, 1]
+    _, kpoints = kmesh_fs(meshgrid)
+    mesh = [max(n-1, 1) for n in meshgrid]
+    shift, index = kmesh_index(kpoints, mesh)
+    fft = FFTHR(Rlatt, hR, mesh, shift=shift)
+    assert (fft.Rk(index) - phase_sum(Rlatt, hR, kpoints)).abs().max() < 1e-10
+
+def test_kmesh_index_off_mesh():
+    kpoints = np.array([[0.0, 0.0, 0.0], [0.1, 0.25, 0.0]])
+    assert kmesh_index(kpoints, [4, 4, 1]) == (None, None)
@@ -0,0 +1,92 @@
+import pytest
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+import ase.io
+from dptb.hamiltonian.foe import inverse_overlap, fermi_coefficients, FermiOperatorExpansion
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+from dptb.postprocess.foe import foecalc
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def chain(n=100):
+    # a dimerized chain with the random onsite energies and the nearest neighbour overlap.
+    rng = np.random.default_rng(1)
+    hop = -1 + 0.3 * (-1)**np.arange(n-1)
+    hk = sp.diags([rng.uniform(-0.2, 0.2, n), hop, hop], [0, 1, -1], format='csr')
+    sk = sp.diags([np.ones(n), 0.1*np.ones(n-1), 0.1*np.ones(n-1)], [0, 1, -1], format='csr')
+    return hk, sk
+
+def fermi(energies, mu, kT):
+    return 0.5 * (1 - np.tanh((energies - mu) / (2 * kT)))
+
+def test_fermi_coefficients():
+    bounds = [-3.0, 2.0]
+    coeff = fermi_coefficients(bounds, mu=-0.5, kT=0.1, num_terms=200)
+    energies = np.linspace(-3, 2, 50)
+    x = (energies + 0.5) / 2.5
+    assert np.abs(np.cos(np.outer(np.arccos(x), np.arange(200))) @ coeff - fermi(energies, -0.5, 0.1)).max() < 1e-8
+
+def test_inverse_overlap():
+    _, sk = chain()
+    sinv = inverse_overlap(sk, threshold=1e-10)
+    assert np.abs(sinv.toarray() - np.linalg.inv(sk.toarray())).max() < 1e-8
+
+@pytest.mark.parametrize('overlap', [False, True])
+def test_fermi_operator_expansion(overlap):
+    hk, sk = chain()
+    sk = sk if overlap else None
+    kT = 0.05
+    foe = FermiOperatorExpansion(hk, sk, kT=kT, threshold=1e-10)
+    mu = foe.chemical_potential(100)
+    dm, populations = foe.density_matrix(mu)
+
+    eigs, eigvec = sla.eigh(hk.toarray(), None if sk is None else sk.toarray())
+    occ = fermi(eigs, mu, kT)
+    dm_ref = (eigvec * occ) @ eigvec.T
+    assert 2 * occ.sum() == pytest.approx(100, abs=1e-6)
+    assert foe.electron_count(mu) == pytest.approx(100, abs=1e-6)
+    assert foe.band_energy(mu) == pytest.approx(2 * occ @ eigs, abs=1e-6)
+    assert np.abs(dm.toarray() - dm_ref).max() < 1e-7
+    sk_dense = np.eye(100) if sk is None else sk.toarray()
+    assert np.abs(populations - np.diag(dm_ref @ sk_dense)).max() < 1e-7
+
+    # the truncation keeps the decaying density matrix sparse.
+    truncated = FermiOperatorExpansion(hk, sk, kT=kT, threshold=1e-4, bounds=foe.bounds)
+    dm_trunc, _ = truncated.density_matrix(mu)
+    assert dm_trunc.nnz < dm.nnz
+    assert np.abs(dm_trunc.toarray() - dm_ref).max() < 1e-2
+
+    # the localization region of 20 sites, the density matrix of the gapped chain decays within a few sites.
+    pattern = sp.diags([np.ones(100 - abs(k)) for k in range(-20, 21)], list(range(-20, 21)), format='csr')
+    localized = FermiOperatorExpansion(hk, sk, kT=kT, threshold=1e-10, pattern=pattern, bounds=foe.bounds)
+    mu_loc = localized.chemical_potential(100)
+    dm_loc, _ = localized.density_matrix(mu_loc)
+    assert (dm_loc.toarray()[pattern.toarray() == 0] == 0).all()
+    assert abs(mu_loc - mu) < 1e-4
+    assert np.abs(dm_loc.toarray() - dm_ref).max() < 1e-3
+
+def test_foecalc(root_directory, tmp_path):
+    apihost = NNSKHost(checkpoint=f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth')
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    atoms = ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp').repeat((3,3,1))
+    run_opt = {'structure': atoms, 'results_path': str(tmp_path)}
+    foe = foecalc(apiHrk, run_opt, {'kT': 0.2, 'threshold': 1e-8})
+    result = foe.get_density_matrix()
+    # the cutoff larger than the supercell keeps all the pairs.
+    assert foe.get_pattern(cutoff=12.0).nnz == foe.density_matrix.shape[0]**2
+
+    eigks, _ = apiHrk.get_eigenvalues(np.zeros((1,3)))
+    occ = fermi(eigks[0].astype(np.float64), result['mu'], 0.2)
+    assert result['num_electrons'] == pytest.approx(72, abs=1e-6)
+    assert 2 * occ.sum() == pytest.approx(72, abs=1e-3)
+    assert result['band_energy'] == pytest.approx(2 * occ @ eigks[0], abs=1e-2)
+    assert result['atom_populations'].sum() == pytest.approx(72, abs=1e-6)
+    # the charges of the N and B atoms are opposite.
+    assert np.abs(result['charges'].reshape(-1, 2).sum(axis=1)).max() < 1e-4
@@ -361,4 +361,280 @@ def test_HamilRSK_SplitOnsite(root_directory):
 
     for i in range(len(hoppings)):
         assert (np.abs(hoppings[i] - hrsk.hamil_blocks[i].numpy()) < 1e-6).all()
-        assert (np.abs(overlaps[i] - hrsk.overlap_blocks[i].numpy()) < 1e-6).all()
\ No newline at end of file
+        assert (np.abs(overlaps[i] - hrsk.overlap_blocks[i].numpy()) < 1e-6).all()
+
+def test_hs_block_R2k_scatter():
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.hamil_blocks = [hop.double().requires_grad_() for hop in hoppings]
+    klist = np.array([[0.0, 0.0, 0.0], [0.1, 0.2, 0.0], [0.5, 0.0, 0.0], [1/3, 1/3, 0.0]])
+
+    HK = hrsk.hs_block_R2k(kpoints=klist, HorS='H', time_symm=True)
+
+    hk_ref = np.zeros([len(klist), 8, 8], dtype=np.complex128)
+    for ik, k in enumerate(klist):
+        for ib, bond in enumerate(all_bonds.numpy()):
+            i, j, R = bond[1], bond[3], bond[4:7]
+            scale = 0.5 if ib < 2 else 1.0
+            hk_ref[ik, 4*i:4*i+4, 4*j:4*j+4] += scale * hoppings[ib].numpy() * np.exp(-1j * 2 * np.pi * np.dot(k, R))
+        hk_ref[ik] = hk_ref[ik] + hk_ref[ik].T.conj()
+
+    assert HK.shape == (len(klist), 8, 8)
+    assert np.abs(HK.detach().numpy() - hk_ref).max() < 1e-10
+
+    HK.real.sum().backward()
+    assert hrsk.hamil_blocks[0].grad is not None
+    assert (hrsk.hamil_blocks[0].grad == len(klist)).all()
+
+def test_sparse_eigenvalues():
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = False
+    hrsk.hamil_blocks = [hop.double() for hop in hoppings]
+    hrsk.overlap_blocks = [torch.eye(4, dtype=torch.float64) if ib < 2 else 0.1 * hop.double() for ib, hop in enumerate(hoppings)]
+    klist = np.array([[0.0, 0.0, 0.0], [0.1, 0.2, 0.0], [0.5, 0.0, 0.0], [1/3, 1/3, 0.0]])
+
+    sparse_hr = hrsk.get_sparse_hr(HorS='H', time_symm=True)
+    HK = hrsk.hs_block_R2k(kpoints=klist, HorS='H', time_symm=True).numpy()
+    for ik, k in enumerate(klist):
+        assert np.abs(sparse_hr.Rk(k).toarray() - HK[ik]).max() < 1e-12
+
+    eigks, _ = hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV")
+    eigks = eigks.numpy()
+    for method in ['shift-invert', 'lanczos', 'lobpcg']:
+        eigs, _ = hrsk.Eigenvalues_sparse(kpoints=klist, time_symm=True, unit="eV", method=method, band_window=[1, 3])
+        assert np.abs(eigs - eigks[:, 1:3]).max() < 1e-8
+
+    emin, emax = -0.5, 0.2
+    eigs, eigvec = hrsk.Eigenvalues_sparse(kpoints=klist, time_symm=True, unit="eV", energy_window=[emin, emax], num_bands=2, if_eigvec=True)
+    for ik in range(len(klist)):
+        ref = eigks[ik][(eigks[ik] >= emin) & (eigks[ik] <= emax)]
+        assert np.abs(eigs[ik][:len(ref)] - ref).max() < 1e-8
+        assert np.isnan(eigs[ik][len(ref):]).all()
+
+def test_eigenvalues_overlap():
+    import scipy.linalg as sla
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = False
+    hrsk.hamil_blocks = [hop.double() for hop in hoppings]
+    hrsk.overlap_blocks = [torch.eye(4, dtype=torch.float64) if ib < 2 else 0.1 * hop.double() for ib, hop in enumerate(hoppings)]
+    klist = np.array([[0.0, 0.0, 0.0], [0.1, 0.2, 0.0], [0.5, 0.0, 0.0], [1/3, 1/3, 0.0]])
+
+    HK = hrsk.hs_block_R2k(kpoints=klist, HorS='H', time_symm=True).numpy()
+    SK = hrsk.hs_block_R2k(kpoints=klist, HorS='S', time_symm=True).numpy()
+    ref = np.stack([sla.eigh(HK[ik], SK[ik], eigvals_only=True) for ik in range(len(klist))])
+
+    eigks, _ = hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV")
+    assert np.abs(eigks.numpy() - ref).max() < 1e-10
+
+    # the fixed S(k) factors are cached and reused, Eigenvalues has cached the real and the complex k-points apart.
+    assert len(hrsk.overlap_cache) == 2
+    hrsk.overlap_cache = {}
+    factor = hrsk.get_overlap_factor(kpoints=klist, time_symm=True)
+    assert len(hrsk.overlap_cache) == 1
+    assert hrsk.get_overlap_factor(kpoints=klist, time_symm=True) is factor
+    hrsk.overlap_blocks = [2.0 * blk for blk in hrsk.overlap_blocks]
+    assert hrsk.get_overlap_factor(kpoints=klist, time_symm=True) is not factor
+
+    # the overlaps with gradients are not cached.
+    hrsk.overlap_cache = {}
+    hrsk.overlap_blocks = [blk.clone().requires_grad_() for blk in hrsk.overlap_blocks]
+    eigks, _ = hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV")
+    eigks.sum().backward()
+    assert len(hrsk.overlap_cache) == 0
+    assert hrsk.overlap_blocks[0].grad is not None
+
+def test_hs_onsite_strain(root_directory):
+    structname = root_directory + '/dptb/tests/data/hBN/hBN.vasp'
+    struct = BaseStruct(atom=structname, format='vasp', cutoff=4, proj_atom_anglr_m={"N":["2s","2p"],"B":["2s","2p"]},
+                        proj_atom_neles={"N":5,"B":3}, onsitemode='strain')
+    bonds, bonds_onsite = struct.get_bond()
+    # the hopping bonds serve as the onsite environment of their i atoms.
+    onsite_envs = np.asarray(bonds)
+    torch.manual_seed(0)
+    onsiteEs = [torch.randn(struct.onsite_num[struct.atom_symbols[int(bond[1])]], dtype=torch.float64) for bond in bonds_onsite]
+    envtypes = [struct.atom_symbols[int(env[1])] + '-' + struct.atom_symbols[int(env[3])] for env in onsite_envs]
+    onsiteVs = [torch.randn(struct.onsite_strain_num[envtype], dtype=torch.float64) for envtype in envtypes]
+    hoppings = [torch.zeros(struct.bond_num_hops[struct.atom_symbols[int(bond[1])] + '-' + struct.atom_symbols[int(bond[3])]],
+                            dtype=torch.float64) for bond in bonds]
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs)
+    hrsk.get_hs_blocks(onsite_envs=onsite_envs)
+
+    # reference: the strain blocks rotated one env and one shell pair at a time.
+    shells = [("2s", "s", 0, 1, 0), ("2p", "p", 1, 3, 1)]
+    for ib, bond in enumerate(bonds_onsite):
+        block = torch.diag_embed(torch.stack([onsiteEs[ib][0]] + [onsiteEs[ib][1]] * 3))
+        for ie, env in enumerate(onsite_envs):
+            if int(env[1]) != int(bond[1]):
+                continue
+            angvec = torch.as_tensor(env[8:11], dtype=torch.float64)
+            for ish, isym, li, ni, ist in shells:
+                for jsh, jsym, lj, nj, jst in shells:
+                    hvalue = onsiteVs[ie][struct.onsite_strain_index_map[envtypes[ie]][ish + '-' + jsh]]
+                    # the strain blocks have no (-1)^(l_i+l_j) factor.
+                    if li < lj:
+                        sub = hrsk.rot_HS(Htype=isym + jsym, Hvalue=hvalue, Angvec=angvec).T
+                    else:
+                        sub = hrsk.rot_HS(Htype=jsym + isym, Hvalue=hvalue, Angvec=angvec)
+                    block[ist:ist+ni, jst:jst+nj] += sub
+        assert torch.abs(hrsk.hamil_blocks[ib] - block).max() < 1e-10
+
+def test_shared_state():
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = False
+    hrsk.hamil_blocks = [hop.double() for hop in hoppings]
+    hrsk.overlap_blocks = [torch.eye(4, dtype=torch.float64) if ib < 2 else 0.1 * hop.double() for ib, hop in enumerate(hoppings)]
+    klist = np.array([[0.0, 0.0, 0.0], [0.1, 0.2, 0.0], [0.5, 0.0, 0.0], [1/3, 1/3, 0.0]])
+
+    shared = HamilEig.from_shared_state(hrsk.get_shared_state(time_symm=True))
+    eigks, _ = hrsk.solve_eigenvalues(kpoints=klist, time_symm=True, unit="eV")
+    eigks_shared, _ = shared.solve_eigenvalues(kpoints=klist, time_symm=True, unit="eV")
+    assert np.abs(eigks - eigks_shared).max() < 1e-12
+    with pytest.raises(ValueError):
+        shared.hs_block_R2k(kpoints=klist, HorS='H', time_symm=False)
+
+def test_eigenvalues_real_kpoints():
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = False
+    hrsk.hamil_blocks = [hop.double().requires_grad_() for hop in hoppings]
+    hrsk.overlap_blocks = [torch.eye(4, dtype=torch.float64) if ib < 2 else 0.1 * hop.double() for ib, hop in enumerate(hoppings)]
+    klist = np.array([[0.5, 0.0, 0.0], [0.1, 0.2, 0.0], [0.0, 0.0, 0.0], [1/3, 1/3, 0.0], [0.5, 0.5, 0.5]])
+    real_mask = hrsk.get_real_kmask(klist)
+    assert (real_mask == [True, False, True, False, True]).all()
+
+    HK = hrsk.hs_block_R2k(kpoints=klist[real_mask], HorS='H', time_symm=True)
+    HK_real = hrsk.hs_block_R2k_spinless(kpoints=klist[real_mask], HorS='H', time_symm=True, real=True)
+    assert not HK_real.is_complex()
+    assert (HK - HK_real).abs().max() < 1e-12
+
+    # the real and the complex k-points are solved apart and put back in order, with the gradients.
+    eigks, eigvec = hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV", if_eigvec=True)
+    assert eigvec.dtype == torch.complex128
+    for ik, kp in enumerate(klist):
+        eigk = torch.linalg.eigvalsh(hrsk._get_Heff(kpoints=kp.reshape(1,3), time_symm=True, real=False))
+        assert (eigks[ik] - eigk[0]).abs().max() < 1e-10
+    eigks.sum().backward()
+    grad = hrsk.hamil_blocks[2].grad.clone()
+    for blk in hrsk.hamil_blocks:
+        blk.grad = None
+    eigk = torch.linalg.eigvalsh(hrsk._get_Heff(kpoints=klist, time_symm=True, real=False))
+    eigk.sum().backward()
+    assert (grad - hrsk.hamil_blocks[2].grad).abs().max() < 1e-10
+
+    hrsk.soc = True
+    assert not hrsk.get_real_kmask(klist).any()
+
+def test_solve_heff_batch():
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = True
+    klist = np.array([[0.5, 0.0, 0.0], [0.1, 0.2, 0.0], [0.0, 0.0, 0.0]])
+
+    heffs, refs = [], []
+    for scale in [1.0, 0.7, 1.3]:
+        hrsk.hamil_blocks = [scale * hop.double() for hop in hoppings]
+        real_mask, heff = hrsk.get_Heff(kpoints=klist, time_symm=True)
+        heffs.append(heff)
+        refs.append(hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV")[0])
+    eigks, _ = hrsk.solve_Heff(real_mask, heffs, unit="eV")
+    assert eigks.shape == (3, 3, 8)
+    assert (eigks - torch.stack(refs)).abs().max() < 1e-10
+
+    eigks, _ = hrsk.solve_Heff(real_mask, heffs, unit="eV", band_window=[2, 5])
+    assert (eigks - torch.stack(refs)[:, :, 2:5]).abs().max() < 1e-10
+
+    # the structures of different sizes are padded, the missing bands are NaN.
+    rng = np.random.default_rng(0)
+    large, small = [torch.from_numpy(rng.standard_normal((3, n, n)) + 1j * rng.standard_normal((3, n, n))) for n in [8, 5]]
+    large, small = large + large.transpose(1,2).conj(), small + small.transpose(1,2).conj()
+    eigks, _ = hrsk.solve_Heff(np.zeros(3, dtype=bool), [{False: large}, {False: small}], unit="eV")
+    assert (eigks[0] - torch.linalg.eigvalsh(large)).abs().max() < 1e-10
+    assert torch.isnan(eigks[1, :, 5:]).all()
+    assert (eigks[1, :, :5] - torch.linalg.eigvalsh(small)).abs().max() < 1e-10
+
+def test_state_checkpoint_grad():
+    from torch.utils.checkpoint import checkpoint
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = True
+    blocks = [hop.double().requires_grad_() for hop in hoppings]
+    hrsk.hamil_blocks = blocks
+    klist = np.array([[0.5, 0.0, 0.0], [0.1, 0.2, 0.0], [0.0, 0.0, 0.0], [0.3, 0.1, 0.0], [0.25, 0.25, 0.0]])
+    state = hrsk.get_state(time_symm=True)
+
+    view = HamilEig(dtype=torch.float64)
+    view.load_state(state)
+    def solve(kchunk):
+        real_mask, heff = view.get_Heff(kpoints=kchunk, time_symm=True)
+        return view.solve_Heff(real_mask, [heff], unit="eV", band_window=[2, 6])[0]
+
+    loss = solve(klist).pow(2).sum()
+    grads = torch.autograd.grad(loss, blocks[2], retain_graph=True)[0]
+    # the chunks recomputed in the backward give the same loss and gradients.
+    eigks = torch.cat([checkpoint(solve, klist[ist:ist+2], use_reentrant=False) for ist in range(0, len(klist), 2)], dim=1)
+    loss_chunk = eigks.pow(2).sum()
+    grads_chunk = torch.autograd.grad(loss_chunk, blocks[2])[0]
+    assert abs(loss.item() - loss_chunk.item()) < 1e-10
+    assert (grads - grads_chunk).abs().max() < 1e-10
+
+def test_eigenvalues_fft_mesh():
+    from dptb.utils.make_kpoints import kmesh_sampling
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = True
+    hrsk.hamil_blocks = [hop.double() for hop in hoppings]
+    kpoints = kmesh_sampling([4, 4, 1], is_gamma_center=True)
+    ref = hrsk.solve_eigenvalues(kpoints, time_symm=True, unit="eV")[0]
+
+    hrsk.set_fft_mesh([4, 4, 1])
+    eigks = hrsk.solve_eigenvalues(kpoints, time_symm=True, unit="eV")[0]
+    assert len(hrsk.fft_cache) == 1
+    assert np.abs(eigks - ref).max() < 1e-10
+    # the k-points off the mesh fall back to the phase sum.
+    klist = np.array([[0.1, 0.2, 0.0]])
+    hrsk.set_fft_mesh(None)
+    ref = hrsk.solve_eigenvalues(klist, time_symm=True, unit="eV")[0]
+    hrsk.set_fft_mesh([4, 4, 1])
+    assert np.abs(hrsk.solve_eigenvalues(klist, time_symm=True, unit="eV")[0] - ref).max() < 1e-10
+
+@pytest.mark.parametrize('orthogonal', [True, False])
+def test_eigenvalues_velocity(orthogonal):
+    hrsk = HamilEig(dtype=torch.float64)
+    hrsk.all_bonds = all_bonds.int()
+    hrsk.num_orbs_per_atom = [4, 4]
+    hrsk.soc = False
+    hrsk.use_orthogonal_basis = orthogonal
+    hrsk.hamil_blocks = [hop.double() for hop in hoppings]
+    hrsk.overlap_blocks = [torch.eye(4, dtype=torch.float64) if ib < 2 else 0.1 * hop.double() for ib, hop in enumerate(hoppings)]
+    cell = np.array([[2.5, 0.0, 0.0], [-1.25, 2.165, 0.0], [0.0, 0.0, 10.0]])
+    klist = np.array([[0.1, 0.2, 0.0], [0.27, 0.05, 0.0]])
+
+    eigks, velocity = hrsk.Eigenvalues_velocity(kpoints=klist, time_symm=True, unit="eV", cell=cell)
+    assert (eigks - hrsk.Eigenvalues(kpoints=klist, time_symm=True, unit="eV")[0]).abs().max() < 1e-10
+    # the central differences along the cartesian k, k_frac = cell k_cart / 2pi.
+    delta = 1e-5
+    for ia in range(3):
+        dk = cell[:, ia] * delta / (2 * np.pi)
+        eplus = hrsk.Eigenvalues(kpoints=klist + dk, time_symm=True, unit="eV")[0]
+        eminus = hrsk.Eigenvalues(kpoints=klist - dk, time_symm=True, unit="eV")[0]
+        assert ((eplus - eminus) / (2 * delta) - velocity[:, :, ia]).abs().max() < 1e-6
@@ -0,0 +1,94 @@
+import pytest
+import torch
+import numpy as np
+import ase.io
+from dptb.structure.structure import BaseStruct
+from dptb.hamiltonian.hamil_plan import HamilPlan, get_bond_classes
+from dptb.nnsktb.integralFunc import SKintHops
+from dptb.utils.constants import atomic_num_dict_r
+from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+
+def test_hamil_plan(root_directory):
+    structname = root_directory + '/dptb/tests/data/hBN/hBN.vasp'
+    proj_atom_anglr_m = {"N":["2s","2p"],"B":["2s","2p"]}
+    proj_atom_neles = {"N":5,"B":3}
+    struct = BaseStruct(atom=structname, format='vasp', cutoff=3.5, proj_atom_anglr_m=proj_atom_anglr_m, proj_atom_neles=proj_atom_neles)
+    bonds, bonds_onsite = struct.get_bond()
+
+    plan = HamilPlan(struct, bonds_onsite=bonds_onsite, bonds_hoppings=bonds)
+    assert plan.total_orbs == 8
+    assert (plan.orb_offsets == np.array([0, 4, 8])).all()
+    assert plan.num_onsite == 2 and plan.num_hopping == len(bonds)
+    assert plan.shells['N'] == [('2s', 's', 0, 1, 0), ('2p', 'p', 1, 3, 1)]
+    assert plan.match(bonds_onsite, bonds)
+    assert not plan.match(bonds_onsite, bonds[:-1])
+
+    # s-p: the rotated p-s block is transposed and multiplied by (-1)^(0+1).
+    pairs = plan.hopping_groups['N-B']['shell_pairs']
+    assert pairs[1][6:9] == ('sp', -1.0, True)
+    assert pairs[2][6:9] == ('sp', 1.0, False)
+    nbonds = sum([len(group['bonds']) for group in plan.hopping_groups.values()])
+    assert nbonds == len(bonds)
+
+    nblocks = sum([len(group['bonds']) for group in plan.block_groups.values()])
+    assert nblocks == len(bonds) + len(bonds_onsite)
+    assert set(plan.block_groups.keys()) == {'N-N', 'B-B', 'N-B'}
+    assert plan.block_groups['N-N']['onsite'][0]
+    assert (plan.Rlatt.abs() <= 2).all()
+
+    hamileig = HamilEig(dtype=torch.float32)
+    hoppings = [torch.randn(struct.bond_num_hops['N-B']) for _ in range(len(bonds))]
+    onsiteEs = [torch.randn(2) for _ in range(len(bonds_onsite))]
+    hamileig.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs)
+    hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds)
+    assert struct.hamil_plan is hamileig.plan
+    hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds)
+    assert struct.hamil_plan is hamileig.plan
+    assert len(hamileig.hamil_blocks) == len(bonds) + len(bonds_onsite)
+    assert (torch.diag(hamileig.hamil_blocks[0]) == onsiteEs[0][[0,1,1,1]]).all()
+    assert hamileig.hamil_blocks.blocks['N-N'].shape[1:] == (4, 4)
+
+
+def test_bond_classes(root_directory):
+    structname = root_directory + '/dptb/tests/data/hBN/hBN.vasp'
+    proj_atom_anglr_m = {"N":["2s","2p"],"B":["2s","2p"]}
+    atoms = ase.io.read(structname).repeat((4,4,1))
+    struct = BaseStruct(atom=atoms, format='ase', cutoff=3.5, proj_atom_anglr_m=proj_atom_anglr_m, proj_atom_neles={"N":5,"B":3})
+    bonds, bonds_onsite = struct.get_bond()
+    rep, inverse = get_bond_classes(bonds)
+    assert len(rep) < len(bonds) // 4
+    assert (inverse[rep] == torch.arange(len(rep))).all()
+    assert torch.abs(bonds[rep][inverse][:,7:] - bonds[:,7:]).max() < 1e-6
+
+    # the bonds of a length class share one tensor of SK integrals, with the gradients of all of them. The lengths
+    # agree within the tolerance of the classes.
+    hops = SKintHops(proj_atom_anglr_m=proj_atom_anglr_m)
+    torch.manual_seed(0)
+    coeff = {key: torch.randn(4, dtype=torch.float64, requires_grad=True) for keys in hops.bond_index_dict.values() for key in keys}
+    batch_bonds = {0: torch.cat([torch.zeros(len(bonds), 1, dtype=torch.float64), bonds], dim=1)}
+    hoppings = hops.get_skhops(batch_bonds, coeff)[0]
+    assert len(set([id(hij) for hij in hoppings])) < len(bonds) // 4
+    reference = [hops.skhij(paraArray=torch.stack([coeff[key] for key in hops.bond_index_dict['{}-{}'.format(
+        atomic_num_dict_r[int(bond[0])], atomic_num_dict_r[int(bond[2])])]]), rij=bond[7]) for bond in bonds]
+    assert max([torch.abs(hij - ref).max() for hij, ref in zip(hoppings, reference)]) < 1e-6
+
+    # the blocks rotated once per class, against the blocks of the distinct tensors rotated one by one.
+    onsiteEs = [torch.randn(2, dtype=torch.float64) for _ in range(len(bonds_onsite))]
+    blocks, grads = [], []
+    for hopping_list in [hoppings, reference]:
+        hamileig = HamilEig(dtype=torch.float64)
+        hamileig.update_hs_list(struct=struct, hoppings=hopping_list, onsiteEs=onsiteEs)
+        hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds)
+        _, hR = hamileig.hs_block_R()
+        blocks.append(hR)
+        grads.append(torch.autograd.grad((hR**2).sum(), list(coeff.values()), allow_unused=True))
+    assert hamileig.get_block_classes(bonds, hoppings) is not None
+    assert hamileig.get_block_classes(bonds, reference) is None
+    assert torch.abs(blocks[0] - blocks[1]).max() < 1e-6
+    for g0, g1 in zip(*grads):
+        assert (g0 is None and g1 is None) or torch.abs(g0 - g1).max() < 1e-6 * max(1.0, torch.abs(g1).max().item())
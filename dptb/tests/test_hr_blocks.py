@@ -0,0 +1,26 @@
+import pytest
+import torch
+from dptb.hamiltonian.hr_blocks import HRBlocks
+
+
+def test_hr_blocks():
+    all_bonds = torch.tensor([[7, 0, 7, 0, 0, 0, 0],
+                              [5, 1, 5, 1, 0, 0, 0],
+                              [7, 0, 5, 1, 0, 0, 0],
+                              [7, 0, 7, 0, 1, 0, 0],
+                              [7, 0, 5, 1, -1, 0, 0]])
+    blocks = [torch.randn(4, 4) for _ in range(5)]
+    hr = HRBlocks.from_list(blocks, all_bonds)
+
+    assert set(hr.keys()) == {'N-N', 'B-B', 'N-B'}
+    assert hr.blocks['N-N'].shape == (2, 4, 4)
+    assert (hr.index['N-N'] == torch.tensor([0, 3])).all()
+    assert (hr.index['N-B'] == torch.tensor([2, 4])).all()
+    assert len(hr) == 5
+    for ib, block in enumerate(hr):
+        assert (block == blocks[ib]).all()
+    assert (hr[4] == blocks[4]).all()
+
+    hr2 = hr.apply(lambda block: 2 * block)
+    assert (hr2[3] == 2 * blocks[3]).all()
+    assert len(hr2.tolist()) == 5
@@ -0,0 +1,92 @@
+import pytest
+import numpy as np
+import ase.io
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+from dptb.utils.make_kpoints import kmesh_sampling
+from dptb.postprocess.kchunk import KChunkEngine, EigenvalueSink, FermiCounter, BandEdgeTracker, DOSAccumulator, PDOSAccumulator
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def get_apihrk(root_directory):
+    checkpoint = f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth'
+    apihost = NNSKHost(checkpoint=checkpoint)
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    apiHrk.update_struct(ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp'))
+    apiHrk.get_HR()
+    return apiHrk
+
+def test_kchunk_reducers(root_directory):
+    apiHrk = get_apihrk(root_directory)
+    kpoints = kmesh_sampling(meshgrid=[4,4,1], is_gamma_center=True)
+    eigks, EF, _ = apiHrk.get_eigenvalues(kpoints, if_eigvec=True)
+
+    engine = KChunkEngine(apiHrk, chunk_size=5)
+    assert engine.get_chunk_size(len(kpoints)) == 5
+    omega = np.linspace(-10, 10, 50)
+    edges = BandEdgeTracker(num_occ=4)
+    eigs, EF_chunk, dos, pdos, _ = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(len(kpoints)),
+                                                        DOSAccumulator(omega, E_fermi=EF, sigma=0.2),
+                                                        PDOSAccumulator(omega, E_fermi=EF, sigma=0.2), edges])
+    assert np.abs(eigs - eigks).max() < 1e-4
+    assert abs(EF_chunk - EF) < 1e-4
+
+    xx = eigks.reshape(-1,1) - EF - omega.reshape(1,-1)
+    dos_ref = np.sum(np.exp(-xx**2 / (2 * 0.2**2)), axis=0) / (0.2 * np.sqrt(2 * np.pi)) / len(kpoints)
+    assert np.abs(dos - dos_ref).max() < 1e-5
+    # orthogonal basis, the projections of each band sum to one.
+    assert pdos.shape == (eigks.shape[1], len(omega))
+    assert np.abs(pdos.sum(axis=0) - dos_ref).max() < 1e-4
+
+    result = edges.result()
+    assert np.abs(result['band_min'] - eigks.min(axis=0)).max() < 1e-4
+    assert np.abs(result['band_max'] - eigks.max(axis=0)).max() < 1e-4
+    assert abs(result['gap'] - max(eigks[:,4].min() - eigks[:,3].max(), 0)) < 1e-4
+    ist, ied = edges.band_range(EF - 1, EF + 1)
+    assert ist == max(np.sum(np.sum(eigks - (EF - 1) < 0, axis=0) / len(eigks) >= 1) - 1, 0)
+    assert ied == np.sum(np.sum(eigks - (EF + 1) > 0, axis=0) / len(eigks) < 1) + 1
+
+def test_fermi_counter():
+    rng = np.random.default_rng(0)
+    eigks = np.sort(rng.standard_normal((10, 6)), axis=1)
+    counter = FermiCounter(num_el=4, nk=10, spindeg=2)
+    for ist in range(0, 10, 3):
+        counter.update(None, eigks[ist:ist+3])
+    sorteigs = np.sort(eigks.reshape(-1))
+    assert counter.result() == (sorteigs[20] + sorteigs[19]) / 2
+
+    # the occupied bands are not all in the window.
+    counter = FermiCounter(num_el=4, nk=10, spindeg=2, eig_solver={"band_window": [1, 4]})
+    counter.update(None, eigks[:, 1:4])
+    assert counter.result() is None
+
+def test_kchunk_workers(root_directory):
+    apiHrk = get_apihrk(root_directory)
+    kpoints = kmesh_sampling(meshgrid=[4,4,1], is_gamma_center=True)
+    omega = np.linspace(-10, 10, 50)
+    serial = KChunkEngine(apiHrk, chunk_size=4).run(kpoints, [EigenvalueSink(), PDOSAccumulator(omega, E_fermi=0.0, sigma=0.2)])
+    parallel = KChunkEngine(apiHrk, chunk_size=4, num_workers=2, num_threads=1).run(kpoints, [EigenvalueSink(), PDOSAccumulator(omega, E_fermi=0.0, sigma=0.2)])
+    assert np.abs(serial[0] - parallel[0]).max() < 1e-6
+    assert np.abs(serial[1] - parallel[1]).max() < 1e-6
+
+def test_kchunk_weights(root_directory):
+    from dptb.utils.make_kpoints import kmesh_irreducible, periodic_directions
+    apiHrk = get_apihrk(root_directory)
+    structase = ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp')
+    kfull = kmesh_sampling(meshgrid=[6,6,1], is_gamma_center=True)
+    periodic = periodic_directions(structase, apiHrk.allbonds)
+    assert (periodic == [True, True, False]).all()
+    kpoints, weights = kmesh_irreducible(meshgrid=[6,6,3], is_gamma_center=True, structase=structase, periodic=periodic)
+    assert len(kpoints) < len(kfull) and weights.sum() == len(kfull)
+
+    engine = KChunkEngine(apiHrk, chunk_size=4)
+    omega = np.linspace(-20, 10, 200)
+    eigks, EF, dos = engine.run(kfull, [EigenvalueSink(), engine.fermi_counter(len(kfull)), DOSAccumulator(omega, 0.0, 0.2)])
+    _, EF_w, dos_w = engine.run(kpoints, [EigenvalueSink(), engine.fermi_counter(weights.sum()), DOSAccumulator(omega, 0.0, 0.2)], weights=weights)
+    assert np.abs(EF - EF_w) < 1e-5
+    assert np.abs(dos - dos_w).max() < 1e-4
@@ -0,0 +1,78 @@
+import pytest
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+from scipy import integrate
+import ase.io
+from dptb.hamiltonian.kpm import spectral_bounds, kpm_moments, kpm_dos, kpm_integrated_dos, kpm_fermi_level
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+from dptb.postprocess.bandstructure.kpm import kpmcalc
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def chain(n=100, dimer=0.0):
+    # a disordered chain with the nearest neighbour overlap, with the alternating hoppings -1 -/+ dimer.
+    rng = np.random.default_rng(1)
+    hop = -1 + dimer * (-1)**np.arange(n-1)
+    hk = sp.diags([rng.uniform(-0.2, 0.2, n), hop, hop], [0, 1, -1], format='csr') + 0j
+    sk = sp.diags([np.ones(n), 0.1*np.ones(n-1), 0.1*np.ones(n-1)], [0, 1, -1], format='csc') + 0j
+    return hk, sk
+
+def test_kpm_moments_exact():
+    hk, sk = chain()
+    eigs, vecs = sla.eigh(hk.toarray(), sk.toarray())
+    bounds = spectral_bounds(hk, sk)
+    assert bounds[0] < eigs[0] and bounds[1] > eigs[-1]
+    # with as many vectors as orbitals the trace is exact.
+    orbitals = [0, 50]
+    moments, local = kpm_moments(hk, sk, bounds=bounds, num_moments=64, num_random=100, orbitals=orbitals)
+    a, b = (bounds[1] - bounds[0]) / 2, (bounds[1] + bounds[0]) / 2
+    tn = np.cos(np.outer(np.arange(64), np.arccos((eigs - b) / a)))
+    assert np.abs(moments - tn.sum(axis=1)).max() < 1e-8
+    # the Mulliken projection of the eigenvectors on the orbitals.
+    mulliken = np.real(vecs.conj() * (sk @ vecs))[orbitals]
+    assert np.abs(local - mulliken @ tn.T).max() < 1e-8
+
+    # the random phase vectors estimate the moments.
+    moments_r, _ = kpm_moments(hk, sk, bounds=bounds, num_moments=64, num_random=50, rng=np.random.default_rng(0))
+    assert moments_r[0] == pytest.approx(100)
+    assert np.abs(moments_r - moments).max() < 10
+
+def test_kpm_dos_fermi_level():
+    hk, _ = chain(200, dimer=0.3)
+    eigs = np.linalg.eigvalsh(hk.toarray())
+    bounds = spectral_bounds(hk)
+    moments, _ = kpm_moments(hk, bounds=bounds, num_moments=256, num_random=200)
+    energies = np.linspace(bounds[0], bounds[1], 2001)
+    dos = kpm_dos(moments, bounds, energies)
+    assert (dos > -1e-8).all()
+    assert integrate.trapezoid(dos, energies) == pytest.approx(200, rel=1e-3)
+    assert kpm_integrated_dos(moments, bounds, [bounds[0], bounds[1]]) == pytest.approx([0, 200], abs=1e-8)
+    # the dimerized chain is an insulator at half filling.
+    EF = kpm_fermi_level(moments, bounds, num_el=200)
+    assert eigs[99] < EF < eigs[100]
+    with pytest.raises(ValueError):
+        kpm_fermi_level(moments, bounds, num_el=500)
+
+def test_kpmcalc(root_directory, tmp_path):
+    apihost = NNSKHost(checkpoint=f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth')
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    atoms = ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp').repeat((3,3,1))
+    run_opt = {'structure': atoms, 'results_path': str(tmp_path)}
+    kpm = kpmcalc(apiHrk, run_opt, {'mesh_grid': [1,1,1], 'num_moments': 512, 'num_random': 100, 'npoints': 2000,
+                                    'atom_index': [0, 1], 'orbital_index': [0]})
+    result = kpm.get_dos()
+
+    eigks, EF = apiHrk.get_eigenvalues(np.zeros((1,3)))
+    eigs = eigks[0]
+    assert eigs[eigs < EF].max() < result['E_fermi'] < eigs[eigs > EF].min()
+    assert integrate.trapezoid(result['dos'], result['omega']) == pytest.approx(len(eigs), rel=1e-3)
+    # orthogonal basis, each orbital holds one state.
+    assert result['ldos'].shape == (2, 2000)
+    assert integrate.trapezoid(result['ldos'], result['omega'], axis=1) == pytest.approx([1, 1], rel=1e-3)
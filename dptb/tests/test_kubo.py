@@ -0,0 +1,94 @@
+import pytest
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+import ase.io
+from dptb.hamiltonian.kpm import ChebyshevOperator, spectral_bounds
+from dptb.hamiltonian.kubo import HBAR, propagator_coefficients, evolve, kubo_moments, kubo_conductivity
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+from dptb.postprocess.kubo import kubocalc
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def chain(n, periodic=False, disorder=0.0):
+    # the chain of hopping -1 eV and lattice constant 1 Angstrom, with the random onsite energies.
+    rng = np.random.default_rng(1)
+    hk = sp.diags([rng.uniform(-disorder, disorder, n), -np.ones(n-1), -np.ones(n-1)], [0, 1, -1], format='lil') + 0j
+    # the velocity i[H, X], with the bond vectors across the periodic boundary.
+    vk = sp.diags([-1j * np.ones(n-1), 1j * np.ones(n-1)], [1, -1], format='lil')
+    if periodic:
+        hk[0, n-1] = hk[n-1, 0] = -1
+        vk[n-1, 0], vk[0, n-1] = -1j, 1j
+    return sp.csr_matrix(hk), sp.csr_matrix(vk)
+
+def test_evolve():
+    n = 40
+    hk, vk = chain(n, disorder=0.5)
+    x = np.diag(np.arange(n, dtype=np.float64))
+    # the velocity of the open chain is i[H, X].
+    assert np.abs(vk.toarray() - 1j * (hk.toarray() @ x - x @ hk.toarray())).max() < 1e-12
+
+    A = ChebyshevOperator(hk, bounds=spectral_bounds(hk))
+    dt = 2.0
+    coeff = propagator_coefficients(A.a, dt)
+    phase = np.exp(-1j * A.b * dt / HBAR)
+    psi, chi = np.eye(n, dtype=np.complex128), np.zeros((n, n), dtype=np.complex128)
+    for _ in range(3):
+        psi, chi = evolve(A, vk, psi, chi, coeff, phase)
+    U = sla.expm(-1j * hk.toarray() * 3 * dt / HBAR)
+    assert np.abs(psi - U).max() < 1e-9
+    assert np.abs(chi - (x @ U - U @ x)).max() < 1e-9
+
+def test_kubo_ballistic():
+    # the clean periodic chain is ballistic, DX^2(E, t) = v(E)^2 t^2 with hbar v(0) = 2 eV*Angstrom.
+    hk, vk = chain(3000, periodic=True)
+    bounds, times, dos_moments, msd_moments = kubo_moments(hk, [vk], time_step=2.0, num_steps=5, num_moments=256,
+                                                           num_random=2, rng=np.random.default_rng(0))
+    energies = np.array([-0.5, 0.0, 0.5])
+    dos, msd, sigma_t, sigma = kubo_conductivity(dos_moments, msd_moments, bounds, energies, times, measure=3000)
+    velocity = np.sqrt(4 - energies**2) / HBAR
+    assert np.abs(msd[0] / (velocity * times.reshape(-1,1))**2 - 1).max() < 0.05
+    assert sigma_t.shape == (1, 5, 3)
+    assert (sigma == sigma_t[:, -1]).all()
+
+def test_kubocalc(root_directory, tmp_path):
+    apihost = NNSKHost(checkpoint=f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth')
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    atoms = ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp').repeat((8,8,1))
+    run_opt = {'structure': atoms, 'results_path': str(tmp_path)}
+    kubo = kubocalc(apiHrk, run_opt, {'directions': ['x', 'y'], 'time_step': 0.5, 'num_steps': 4, 'num_moments': 128,
+                                      'num_random': 1, 'npoints': 100, 'seed': 0})
+    result = kubo.get_conductivity()
+    assert result['msd'].shape == (2, 4, 100)
+    assert (result['msd'] >= -1e-6).all()
+    # hBN is isotropic in plane, the states spread in x and y alike.
+    msd = result['msd'][:, -1].mean(axis=1)
+    assert abs(msd[0] - msd[1]) < 0.2 * msd[0]
+
+def test_sparse_velocity(root_directory):
+    apihost = NNSKHost(checkpoint=f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth')
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    apiHrk.update_struct(ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp'))
+    apiHrk.get_HR()
+    hamileig = apiHrk.hamileig
+    factor = hamileig.get_unit_factor(apiHrk.unit)
+    struct = apiHrk.structure.projected_struct
+    velocities = hamileig.get_sparse_velocity(positions=struct.positions, cell=np.asarray(struct.cell), time_symm=apiHrk.time_symm)
+
+    # the expectation values of the velocity operators are the band velocities, with the sign of the k of exp(-ik.R).
+    kpoint = np.array([0.13, 0.27, 0.0])
+    eigks, velocity = apiHrk.get_velocities(kpoint.reshape(1,3))
+    _, eigvec = np.linalg.eigh(hamileig.get_sparse_hr(HorS='H', time_symm=apiHrk.time_symm).Rk(kpoint).toarray())
+    for idir in range(3):
+        vk = velocities[idir].Rk(kpoint).toarray() * factor
+        assert np.abs(vk - vk.conj().T).max() < 1e-10
+        expect = np.real(np.einsum('in,ij,jn->n', eigvec.conj(), vk, eigvec))
+        assert np.abs(expect + velocity[0, :, idir]).max() < 1e-4
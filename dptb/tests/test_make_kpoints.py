@@ -66,4 +66,30 @@ def test_intpkpath2(root_directory):
     klist, xlist, high_sym_kpoints = abacus_kpath(structase=struct, kpath=kpath)
     assert (np.abs(klist -  true_klist2) < 1e-6).all()
     assert (np.abs(xlist -  true_xlist2) < 1e-6).all()
-    assert (np.abs(high_sym_kpoints - true_hskp2)< 1e-6).all()
\ No newline at end of file
+    assert (np.abs(high_sym_kpoints - true_hskp2)< 1e-6).all()
+def test_kmesh_irreducible(root_directory):
+    from ase.build import bulk
+    from dptb.utils.make_kpoints import kmesh_irreducible, kmesh_sampling
+
+    # a function with the full symmetry of the fcc lattice, the nearest neighbor s band of Si.
+    silicon = bulk('Si', 'diamond', a=5.43)
+    latt = np.array(silicon.cell)
+    neighbors = np.array([[0, 1, 1], [1, 0, 1], [1, 1, 0], [0, -1, 1], [-1, 0, 1], [-1, 1, 0]]) * 5.43 / 2
+    Rfrac = neighbors @ np.linalg.inv(latt)
+    band = lambda kpts: np.cos(2 * np.pi * kpts @ Rfrac.T).sum(axis=1)
+
+    for is_gamma_center in [True, False]:
+        kfull = kmesh_sampling(meshgrid=[8,8,8], is_gamma_center=is_gamma_center)
+        kpoints, weights = kmesh_irreducible(meshgrid=[8,8,8], is_gamma_center=is_gamma_center, structase=silicon)
+        assert weights.sum() == len(kfull)
+        assert len(kpoints) * 6 < len(kfull)
+        assert np.abs((weights * band(kpoints)).sum() - band(kfull).sum()) < 1e-8
+        assert np.abs((weights * band(kpoints)**2).sum() - (band(kfull)**2).sum()) < 1e-8
+
+    # the full mesh is kept without the symmetry, the vacuum direction is collapsed.
+    hbn = read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp')
+    kpoints, weights = kmesh_irreducible(meshgrid=[6,6,4], is_gamma_center=True, time_reversal=False)
+    assert (kpoints == kmesh_sampling(meshgrid=[6,6,4], is_gamma_center=True)).all() and (weights == 1).all()
+    kpoints, weights = kmesh_irreducible(meshgrid=[6,6,4], is_gamma_center=True, structase=hbn, periodic=[True, True, False])
+    assert weights.sum() == 36 and (kpoints[:,2] == 0).all()
+    assert len(kpoints) < 36 // 6 + 3
@@ -2,7 +2,7 @@ import pytest
 import torch
 
 from dptb.hamiltonian.soc import creat_basis_lm, get_matrix_lmbasis
-from dptb.hamiltonian.soc import lm2cubic_mat,get_soc_matrix_cubic_basis
+from dptb.hamiltonian.soc import lm2cubic_mat,get_soc_matrix_cubic_basis, get_soc_matrix_cached
 
 def test_creat_basis():
     assert creat_basis_lm('s') == [[0, 0, 1], [0, 0, -1]]
@@ -158,3 +158,10 @@ def test_get_soc_matrix_cubic_basis():
          -1.2688e-08+0.0000j]])
 
     assert (torch.abs(mat-mat_true) < 1e-4).all()
+
+def test_get_soc_matrix_cached():
+    for orb in ['s', 'p', 'd']:
+        for dtype in [torch.float32, torch.float64]:
+            soc = get_soc_matrix_cached(orb, dtype=dtype)
+            assert soc is get_soc_matrix_cached(orb, dtype=dtype)
+            assert torch.equal(soc, get_soc_matrix_cubic_basis(orb, dtype=dtype))
@@ -0,0 +1,73 @@
+import pytest
+import numpy as np
+import scipy.sparse as sp
+import scipy.linalg as sla
+from dptb.hamiltonian.sparse_eig import sparse_eigh, sparse_eigh_path, path_breaks
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+def chain(n=200):
+    # a disordered chain with the nearest neighbour overlap.
+    rng = np.random.default_rng(1)
+    hk = sp.diags([rng.uniform(-1, 1, n), -np.ones(n-1), -np.ones(n-1)], [0, 1, -1], format='csr') + 0j
+    sk = sp.diags([np.ones(n), 0.1*np.ones(n-1), 0.1*np.ones(n-1)], [0, 1, -1], format='csc') + 0j
+    return hk, sk
+
+@pytest.mark.parametrize('method', ['shift-invert', 'lanczos', 'lobpcg'])
+def test_sparse_eigh_band_window(method):
+    hk, sk = chain()
+    ref = sla.eigh(hk.toarray(), sk.toarray(), eigvals_only=True)
+    eigs, eigvec = sparse_eigh(hk, sk, method=method, band_window=[2, 6], tol=1e-10, if_eigvec=True)
+    assert np.abs(eigs - ref[2:6]).max() < 1e-6
+    # the eigenvectors are S-orthonormal.
+    assert np.abs(eigvec.conj().T @ sk @ eigvec - np.eye(4)).max() < 1e-6
+
+@pytest.mark.parametrize('method', ['shift-invert', 'lanczos'])
+def test_sparse_eigh_energy_window(method):
+    hk, sk = chain()
+    ref = sla.eigh(hk.toarray(), sk.toarray(), eigvals_only=True)
+    emin, emax = -1.5, -1.2
+    eigs, _ = sparse_eigh(hk, sk, method=method, energy_window=[emin, emax], num_bands=4)
+    ref = ref[(ref >= emin) & (ref <= emax)]
+    assert len(eigs) == len(ref)
+    assert np.abs(eigs - ref).max() < 1e-8
+
+def test_sparse_eigh_no_window():
+    hk, sk = chain(10)
+    with pytest.raises(ValueError):
+        sparse_eigh(hk, sk)
+
+def test_path_breaks():
+    kpoints = np.array([[0.0, 0, 0], [0.1, 0, 0], [0.2, 0, 0], [0.5, 0.5, 0], [0.5, 0.4, 0], [0.5, 0.3, 0]])
+    assert path_breaks(kpoints).tolist() == [0, 3]
+
+@pytest.mark.parametrize('method', ['shift-invert', 'lanczos'])
+def test_sparse_eigh_path(method):
+    hk, sk = chain(300)
+    rng = np.random.default_rng(2)
+    pert = sp.diags([rng.uniform(-1, 1, 300)], [0], format='csr') + 0j
+    ts = np.concatenate([np.linspace(0, 0.2, 6), np.linspace(0.8, 1.0, 4)])
+    kpoints = np.stack([ts, np.zeros_like(ts), np.zeros_like(ts)], axis=1)
+    hks = [hk + t * pert for t in ts]
+    eigks, eigvecs = sparse_eigh_path(hks, [sk] * len(ts), kpoints=kpoints, band_window=[3, 8], method=method, tol=1e-10, if_eigvec=True)
+    for h, eigs, eigvec in zip(hks, eigks, eigvecs):
+        ref = sla.eigh(h.toarray(), sk.toarray(), eigvals_only=True)
+        assert np.abs(eigs - ref[3:8]).max() < 1e-6
+        assert eigvec.shape == (300, 5)
+
+@pytest.mark.parametrize('window', [[-5.0, -2.0], [2.9, 5.0]])
+def test_sparse_eigh_energy_window_edge(window, monkeypatch):
+    # the windows past the band edges are covered by the shift-invert solver without the dense fallback.
+    import dptb.hamiltonian.sparse_eig as sparse_eig
+    def dense_eigh(*args, **kwargs):
+        raise AssertionError("the dense solver is called.")
+    monkeypatch.setattr(sparse_eig, '_dense_eigh', dense_eigh)
+    hk, sk = chain(1000)
+    ref = sla.eigh(hk.toarray(), sk.toarray(), eigvals_only=True)
+    emin, emax = window
+    eigs, _ = sparse_eigh(hk, sk, method='shift-invert', energy_window=window, num_bands=4)
+    ref = ref[(ref >= emin) & (ref <= emax)]
+    assert len(eigs) == len(ref)
+    assert np.abs(eigs - ref).max() < 1e-8
@@ -0,0 +1,100 @@
+import pytest
+import torch
+import numpy as np
+import scipy.linalg as sla
+import ase.io
+from dptb.structure.structure import BaseStruct
+from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
+from dptb.hamiltonian.sparse_eig import SparseHR
+from dptb.hamiltonian.supercell import SupercellHR
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+
+def get_hamileig(root_directory):
+    structname = root_directory + '/dptb/tests/data/hBN/hBN.vasp'
+    struct = BaseStruct(atom=structname, format='vasp', cutoff=3.5, proj_atom_anglr_m={"N":["2s","2p"],"B":["2s","2p"]},
+                        proj_atom_neles={"N":5,"B":3})
+    bonds, bonds_onsite = struct.get_bond()
+    torch.manual_seed(0)
+    hoppings = [torch.randn(struct.bond_num_hops['N-B'], dtype=torch.float64) for _ in range(len(bonds))]
+    onsiteEs = [torch.randn(2, dtype=torch.float64) for _ in range(len(bonds_onsite))]
+    hamileig = HamilEig(dtype=torch.float64)
+    hamileig.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs)
+    hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds)
+    return struct, hamileig
+
+
+@pytest.mark.parametrize("repeat", [[3, 2, 1], [[2, 1, 0], [-1, 1, 0], [0, 0, 1]]])
+def test_supercell_hr(root_directory, repeat):
+    struct, hamileig = get_hamileig(root_directory)
+    Rlatt, index, values = hamileig.hs_block_values(HorS='H', time_symm=True)
+    supercell = SupercellHR(repeat, num_orbs_per_atom=hamileig.num_orbs_per_atom)
+    assert supercell.ncell == 6 if np.asarray(repeat).ndim == 1 else supercell.ncell == 3
+    Rsc, index_sc, values_sc = supercell.tile(Rlatt.numpy(), index.numpy(), values.numpy())
+    hk = SparseHR(Rlatt=Rsc, index=index_sc, values=values_sc, norbs=supercell.size).Rk([0.0, 0.0, 0.0]).toarray()
+    assert np.abs(hk - hk.conj().T).max() < 1e-12
+
+    # the Gamma point of the supercell holds the primitive k-points k = G M^-1 of the supercell reciprocal lattice.
+    matrix = supercell.matrix
+    kpoints = np.array([[i, j, 0] for i in range(-3, 4) for j in range(-3, 4)]) @ np.linalg.inv(matrix).T
+    kpoints = np.unique(np.round(np.mod(kpoints, 1.0), 12) % 1.0, axis=0)
+    assert len(kpoints) == supercell.ncell
+    eigks, _ = hamileig.Eigenvalues(kpoints=kpoints, time_symm=True, unit='eV')
+    assert np.abs(np.sort(sla.eigvalsh(hk)) - np.sort(eigks.reshape(-1).numpy())).max() < 1e-10
+
+    atoms = supercell.atoms(struct.projected_struct)
+    assert len(atoms) == supercell.natom
+    assert np.abs(np.asarray(atoms.cell) - matrix @ np.asarray(struct.projected_struct.cell)).max() < 1e-10
+    if np.asarray(repeat).ndim == 1:
+        reference = struct.projected_struct.repeat(repeat)
+        assert np.abs(atoms.positions - reference.positions).max() < 1e-10
+
+
+def test_supercell_defects(root_directory):
+    struct, hamileig = get_hamileig(root_directory)
+    Rlatt, index, values = hamileig.hs_block_values(HorS='H', time_symm=True)
+    supercell = SupercellHR([2, 2, 1], num_orbs_per_atom=hamileig.num_orbs_per_atom, vacancies=[3])
+    assert supercell.size == 7 * 4
+    Rsc, index_sc, values_sc = supercell.tile(Rlatt.numpy(), index.numpy(), values.numpy())
+    hk = SparseHR(Rlatt=Rsc, index=index_sc, values=values_sc, norbs=supercell.size).Rk([0.2, 0.1, 0.0]).toarray()
+    full = SupercellHR([2, 2, 1], num_orbs_per_atom=hamileig.num_orbs_per_atom)
+    Rsc, index_sc, values_sc = full.tile(Rlatt.numpy(), index.numpy(), values.numpy())
+    hk_full = SparseHR(Rlatt=Rsc, index=index_sc, values=values_sc, norbs=full.size).Rk([0.2, 0.1, 0.0]).toarray()
+    keep = np.r_[0:12, 16:32]
+    assert np.abs(hk - hk_full[np.ix_(keep, keep)]).max() < 1e-12
+
+    # a substitution replaces the onsite block of one atom only.
+    block = np.diag([1.0, 2.0, 2.0, 2.0])
+    Rsc, index_sc, values_sc = supercell.tile(Rlatt.numpy(), index.numpy(), values.numpy(), substitutions={5: block})
+    hk_sub = SparseHR(Rlatt=Rsc, index=index_sc, values=values_sc, norbs=supercell.size).Rk([0.2, 0.1, 0.0]).toarray()
+    diff = hk_sub - hk
+    # atom 5 is the 5th kept atom, after the vacancy 3.
+    assert np.abs(diff[16:20, 16:20] - (block - hk[16:20, 16:20])).max() < 1e-12
+    diff[16:20, 16:20] = 0
+    assert np.abs(diff).max() < 1e-12
+    with pytest.raises(ValueError):
+        supercell.tile(Rlatt.numpy(), index.numpy(), values.numpy(), substitutions={3: block})
+
+
+def test_nn2hrk_supercell(root_directory):
+    checkpoint = f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth'
+    apihost = NNSKHost(checkpoint=checkpoint)
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    apiHrk = NN2HRK(apihost=apihost, mode='nnsk')
+    apiHrk.update_struct(ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp'))
+    atoms, sparse_hr, sparse_sr = apiHrk.get_supercell_HR([3, 3, 1])
+    assert sparse_sr is None and sparse_hr.size == 9 * 8
+
+    # against the H(R) of the supercell built from its own bonds.
+    apiHrk.update_struct(atoms)
+    apiHrk.get_HR()
+    kpoint = np.array([0.13, 0.27, 0.0])
+    eigks, _ = apiHrk.get_eigenvalues(kpoint.reshape(1, 3))
+    assert np.abs(np.sort(sla.eigvalsh(sparse_hr.Rk(kpoint).toarray())) - eigks[0]).max() < 1e-3
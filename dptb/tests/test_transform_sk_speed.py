@@ -0,0 +1,29 @@
+import pytest
+import numpy as np
+import torch as th
+from dptb.hamiltonian.transform_sk import RotationSK as RotationSKRef
+from dptb.hamiltonian.transform_sk_speed import RotationSK, get_rot_kernels
+
+class TestRotationSKBatch:
+
+    rotmap_ref = RotationSKRef(rot_type=th.float64, device='cpu')
+    rotmap = RotationSK(rot_type=th.float64, device='cpu')
+
+    @pytest.mark.parametrize("Htype, nparam", [('ss',1), ('sp',1), ('sd',1), ('pp',2), ('pd',2), ('dd',3)])
+    def test_rot_HS_batch(self, Htype, nparam):
+        vec = np.random.uniform(-1, 1, size=[6,3])
+        vec = th.from_numpy(vec/np.linalg.norm(vec, axis=1, keepdims=True))
+        Hvalue = th.from_numpy(np.random.uniform(size=[6,nparam]))
+
+        res = self.rotmap.rot_HS_batch(Htype, Hvalue=Hvalue, Angvec=vec)
+        ref = th.stack([self.rotmap_ref.rot_HS(Htype, Hvalue=Hvalue[i], Angvec=vec[i]) for i in range(6)])
+        assert res.shape == ref.shape
+        assert (th.abs(res - ref) < 1e-10).all()
+
+        res_single = self.rotmap.rot_HS(Htype, Hvalue=Hvalue[2], Angvec=vec[2])
+        assert (th.abs(res_single - ref[2]) < 1e-10).all()
+
+    def test_shared_kernels(self):
+        rotmap = RotationSK(rot_type=th.float32, device='cpu')
+        assert rotmap.dd is self.rotmap.dd
+        assert rotmap.dd is get_rot_kernels()['dd']
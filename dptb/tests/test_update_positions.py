@@ -0,0 +1,93 @@
+import pytest
+import torch
+import numpy as np
+import ase.io
+from dptb.structure.structure import BaseStruct
+from dptb.hamiltonian.hamil_plan import match_bonds
+from dptb.hamiltonian.hamil_eig_sk_crt import HamilEig
+from dptb.plugins.init_nnsk import InitSKModel
+from dptb.nnops.NN2HRK import NN2HRK
+from dptb.nnops.apihost import NNSKHost
+
+@pytest.fixture(scope='session', autouse=True)
+def root_directory(request):
+    return str(request.config.rootdir)
+
+
+def test_match_bonds(root_directory):
+    struct = BaseStruct(atom=root_directory + '/dptb/tests/data/hBN/hBN.vasp', format='vasp', cutoff=3.5, proj_atom_anglr_m={"N":["2s","2p"],"B":["2s","2p"]},
+                        proj_atom_neles={"N":5,"B":3})
+    bonds, _ = struct.get_bond()
+    perm = torch.randperm(len(bonds), generator=torch.Generator().manual_seed(0))
+    assert (match_bonds(bonds, bonds[perm]) == perm.numpy()).all()
+    assert (match_bonds(bonds[:-3], bonds)[-3:] == -1).all()
+
+    # the bond of an atom with its own image is the same bond with R or -R.
+    flipped = bonds.clone()
+    self_bonds = flipped[:,1] == flipped[:,3]
+    assert self_bonds.any()
+    flipped[self_bonds, 4:7] = -flipped[self_bonds, 4:7]
+    assert (match_bonds(bonds, flipped) == np.arange(len(bonds))).all()
+    assert (match_bonds(bonds, flipped, time_symm=False)[self_bonds.numpy()] == -1).all()
+
+
+def test_patch_hs_blocks(root_directory):
+    atoms = ase.io.read(root_directory + '/dptb/tests/data/hBN/hBN.vasp').repeat((2,2,1))
+    struct = BaseStruct(atom=atoms, format='ase', cutoff=3.5, proj_atom_anglr_m={"N":["2s","2p"],"B":["2s","2p"]},
+                        proj_atom_neles={"N":5,"B":3}, onsitemode='strain')
+    bonds, bonds_onsite = struct.get_bond()
+    onsite_envs = struct.get_onsitenv(onsite_cutoff=3.0, sorted=None)
+    torch.manual_seed(0)
+    nhops = struct.bond_num_hops['N-B']
+    hoppings = [torch.randn(nhops, dtype=torch.float64) for _ in range(len(bonds))]
+    onsiteEs = [torch.randn(2, dtype=torch.float64) for _ in range(len(bonds_onsite))]
+    onsiteVs = [torch.randn(4, dtype=torch.float64) for _ in range(len(onsite_envs))]
+    hamileig = HamilEig(dtype=torch.float64)
+    hamileig.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs)
+    hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds, onsite_envs=onsite_envs)
+
+    # new values for the bonds and the onsite envs of atom 0, the onsite block of atom 0 is built with all its envs.
+    changed_hoppings = ((bonds[:,1] == 0) | (bonds[:,3] == 0)).numpy()
+    changed_envs = (onsite_envs[:,1] == 0).numpy()
+    changed_onsite = (bonds_onsite[:,1] == 0).numpy()
+    hoppings = [torch.randn(nhops, dtype=torch.float64) if changed else hij for hij, changed in zip(hoppings, changed_hoppings)]
+    onsiteVs = [torch.randn(4, dtype=torch.float64) if changed else vij for vij, changed in zip(onsiteVs, changed_envs)]
+    hamileig.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs)
+    plan = hamileig.plan
+    hamileig.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds, onsite_envs=onsite_envs,
+                           changed_onsite=changed_onsite, changed_hoppings=changed_hoppings)
+    assert hamileig.plan is plan
+
+    reference = HamilEig(dtype=torch.float64)
+    reference.update_hs_list(struct=struct, hoppings=hoppings, onsiteEs=onsiteEs, onsiteVs=onsiteVs)
+    reference.get_hs_blocks(bonds_onsite=bonds_onsite, bonds_hoppings=bonds, onsite_envs=onsite_envs)
+    for key, block in reference.hamil_blocks.blocks.items():
+        assert torch.allclose(hamileig.hamil_blocks.blocks[key], block, atol=1e-12)
+
+
+@pytest.mark.parametrize("displacement, same_topology", [([0.05, -0.02, 0.01], True), ([0.6, 0.4, 0.0], False)])
+def test_update_positions(root_directory, displacement, same_topology):
+    apihost = NNSKHost(checkpoint=f'{root_directory}/dptb/tests/data/hBN/checkpoint/best_nnsk.pth')
+    apihost.register_plugin(InitSKModel())
+    apihost.build()
+    atoms = ase.io.read(f'{root_directory}/dptb/tests/data/hBN/hBN.vasp').repeat((3,3,1))
+    atoms.rattle(0.01, seed=0)
+    nhrk = NN2HRK(apihost, 'nnsk')
+    nhrk.update_struct(atoms)
+    nhrk.get_HR()
+    plan = nhrk.hamileig.plan
+
+    positions = atoms.positions[[0, 7]] + np.array(displacement)
+    nhrk.update_positions([0, 7], positions)
+    moved = atoms.copy()
+    moved.positions[[0, 7]] = positions
+    reference = NN2HRK(apihost, 'nnsk')
+    reference.update_struct(moved)
+    reference.get_HR()
+
+    # a small displacement keeps the bond topology, and only the blocks of the moved atoms are built again.
+    assert (nhrk.hamileig.plan is plan) == same_topology
+    kpoints = np.array([[0.0, 0.0, 0.0], [0.1, 0.2, 0.0], [1/3, 1/3, 0.0]])
+    eigks, _ = nhrk.get_eigenvalues(kpoints)
+    eigks_ref, _ = reference.get_eigenvalues(kpoints)
+    assert np.abs(np.asarray(eigks) - np.asarray(eigks_ref)).max() < 1e-5
@@ -79,6 +79,13 @@ def train_options():
         - `LBFGS`: [On the limited memory BFGS method for large scale optimization.](http://users.iems.northwestern.edu/~nocedal/PDFfiles/limited-memory.pdf) \n\n\
     "
     doc_lr_scheduler = "The learning rate scheduler tools settings, the lr scheduler is used to scales down the learning rate during the training process. Proper setting can make the training more stable and efficient. The supported lr schedular includes: `Exponential Decaying (exp)`, `Linear multiplication (linear)`"
+    doc_eig_driver = "The dense eigen solver backend used to compute the eigenvalues in training and validation: `auto`, `torch`, `window`, `evr`, `evx` or `evd`. \
+        Only `torch` and `window` are differentiable, one of them is always used when the gradients are needed, the other backends apply to the validation. Default: `auto`"
+    doc_eig_band_window = "If True, the training steps of the eigenvalue losses only solve the bands from band_min to band_max of the loss, \
+        and backpropagate through these bands only. Default: True"
+    doc_k_chunk_size = "The number of k-points per chunk in the training steps. The chunks are solved with activation checkpointing, \
+        only their eigenvalues are kept and H(k) is recomputed in the backward, which bounds the memory for large k-point sets \
+        with the same loss and gradients. Default: None, all the k-points at once"
 
     args = [
         Argument("num_epoch", int, optional=False, doc=doc_num_epoch),
@@ -87,7 +94,10 @@ def train_options():
         Argument("lr_scheduler", dict, sub_fields=[], optional=True, default={}, sub_variants=[lr_scheduler()], doc = doc_lr_scheduler),
         Argument("save_freq", int, optional=True, default=10, doc=doc_save_freq),
         Argument("validation_freq", int, optional=True, default=10, doc=doc_validation_freq),
-        Argument("display_freq", int, optional=True, default=1, doc=doc_display_freq)
+        Argument("display_freq", int, optional=True, default=1, doc=doc_display_freq),
+        Argument("eig_driver", str, optional=True, default="auto", doc=doc_eig_driver),
+        Argument("eig_band_window", bool, optional=True, default=True, doc=doc_eig_band_window),
+        Argument("k_chunk_size", [int, None], optional=True, default=None, doc=doc_k_chunk_size)
     ]
 
     doc_train_options = "Options that defines the training behaviour of DeePTB."
@@ -388,6 +398,9 @@ def task_options():
         - `band`: for band structure plotting. \n\n\
         - `dos`: for density of states plotting.\n\n\
         - `pdos`: for projected density of states plotting.\n\n\
+        - `kpm`: for the density of states, the local density of states and the Fermi level of large structures by the kernel polynomial method.\n\n\
+        - `kubo`: for the Kubo conductivity and the mean square displacements of large structures by the time evolution of random phase states.\n\n\
+        - `foe`: for the density matrix, the band energy and the Mulliken populations of large structures by the Fermi operator expansion.\n\n\
         - `FS2D`: for 2D fermi-surface plotting.\n\n\
         - `FS3D`: for 3D fermi-surface plotting.\n\n\
         - `write_sk`: for transcript the nnsk model to standard sk parameter table\n\n\
@@ -396,6 +409,9 @@ def task_options():
             Argument("band", dict, band()),
             Argument("dos", dict, dos()),
             Argument("pdos", dict, pdos()),
+            Argument("kpm", dict, kpm()),
+            Argument("kubo", dict, kubo()),
+            Argument("foe", dict, foe()),
             Argument("FS2D", dict, FS2D()),
             Argument("FS3D", dict, FS3D()),
             Argument("write_sk", dict, write_sk()),
@@ -475,7 +491,9 @@ def band():
         Argument("emin", [float, int, None], optional=True, doc=doc_emin, default=None),
         Argument("emax", [float, int, None], optional=True, doc=doc_emax, default=None),
         Argument("nkpoints", int, optional=True, doc=doc_emax, default=0),
-        Argument("ref_band", [str, None], optional=True, default=None, doc=doc_ref_band)
+        Argument("ref_band", [str, None], optional=True, default=None, doc=doc_ref_band),
+        eig_solver(),
+        *kchunk_options()
     ]
 
 
@@ -486,6 +504,9 @@ def dos():
     doc_npoints = ""
     doc_width = ""
     doc_E_fermi=""
+    doc_use_symmetry = "If True, the k-mesh is reduced to the irreducible k-points by the point group of the structure and the time reversal, \
+        the DOS and the Fermi level are summed with the weights of the k-points. Default: False"
+    doc_symprec = "The tolerance of spglib to find the symmetry operations. Default: 1e-5"
 
     return [
         Argument("mesh_grid", list, optional=False, doc=doc_mesh_grid),
@@ -493,7 +514,11 @@ def dos():
         Argument("npoints", int, optional=False, doc=doc_npoints),
         Argument("width", list, optional=False, doc=doc_width),
         Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
-        Argument("gamma_center", bool, optional=True, default=False, doc=doc_gamma_center)
+        Argument("gamma_center", bool, optional=True, default=False, doc=doc_gamma_center),
+        Argument("use_symmetry", bool, optional=True, default=False, doc=doc_use_symmetry),
+        Argument("symprec", float, optional=True, default=1e-5, doc=doc_symprec),
+        eig_solver(),
+        *kchunk_options()
     ]
 
 def pdos():
@@ -505,6 +530,8 @@ def pdos():
     doc_E_fermi=""
     doc_atom_index = ""
     doc_orbital_index = ""
+    doc_use_symmetry = "If True, the k-points k and -k of the mesh are merged by the time reversal, without SOC. The orbital projections \
+        are not invariant under the point group, it is not used. Default: False"
 
     return [
         Argument("mesh_grid", list, optional=False, doc=doc_mesh_grid),
@@ -514,7 +541,76 @@ def pdos():
         Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
         Argument("atom_index", list, optional=False, doc=doc_atom_index),
         Argument("orbital_index", list, optional=False, doc=doc_orbital_index),
-        Argument("gamma_center", bool, optional=True, default=False, doc=doc_gamma_center)
+        Argument("gamma_center", bool, optional=True, default=False, doc=doc_gamma_center),
+        Argument("use_symmetry", bool, optional=True, default=False, doc=doc_use_symmetry),
+        *kchunk_options()
+    ]
+
+def kpm():
+    doc_mesh_grid = "The k-mesh of the moments, the large supercells are usually sampled by the Gamma point only. Default: [1,1,1]"
+    doc_gamma_center = ""
+    doc_num_moments = "The number of Chebyshev moments, the energy resolution is about pi times the spectral width over twice the number of moments. Default: 512"
+    doc_num_random = "The number of random vectors of the stochastic trace, the error of the DOS decreases as one over the square root of \
+        num_random times the number of orbitals. Default: 16"
+    doc_npoints = ""
+    doc_width = "The energy window [emin, emax] relative to the Fermi level, None for the spectral bounds. Default: None"
+    doc_E_fermi = "The Fermi level, if None it is estimated from the integrated DOS of the moments. Default: None"
+    doc_atom_index = "The atoms of the local density of states. Default: None"
+    doc_orbital_index = "The orbitals of each atom in atom_index of the local density of states. Default: None"
+    doc_seed = "The seed of the random vectors. Default: None"
+
+    return [
+        Argument("mesh_grid", list, optional=True, default=[1,1,1], doc=doc_mesh_grid),
+        Argument("gamma_center", bool, optional=True, default=False, doc=doc_gamma_center),
+        Argument("num_moments", int, optional=True, default=512, doc=doc_num_moments),
+        Argument("num_random", int, optional=True, default=16, doc=doc_num_random),
+        Argument("npoints", int, optional=True, default=400, doc=doc_npoints),
+        Argument("width", [list, None], optional=True, default=None, doc=doc_width),
+        Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
+        Argument("atom_index", [list, int, None], optional=True, default=None, doc=doc_atom_index),
+        Argument("orbital_index", [list, int, None], optional=True, default=None, doc=doc_orbital_index),
+        Argument("seed", [int, None], optional=True, default=None, doc=doc_seed)
+    ]
+
+def kubo():
+    doc_directions = "The directions of the conductivity and the mean square displacements, in x, y, z. Default: [\"x\"]"
+    doc_time_step = "The time step of the evolution in fs. Default: 1.0"
+    doc_num_steps = "The number of time steps. Default: 100"
+    doc_num_moments = "The number of Chebyshev moments of the energy resolution, see `kpm`. Default: 512"
+    doc_num_random = "The number of random phase states. Default: 1"
+    doc_npoints = ""
+    doc_width = "The energy window [emin, emax] relative to the Fermi level, None for the spectral bounds. Default: None"
+    doc_E_fermi = "The Fermi level, if None it is estimated from the integrated DOS of the moments. Default: None"
+    doc_seed = "The seed of the random phase states. Default: None"
+
+    return [
+        Argument("directions", list, optional=True, default=["x"], doc=doc_directions),
+        Argument("time_step", [float, int], optional=True, default=1.0, doc=doc_time_step),
+        Argument("num_steps", int, optional=True, default=100, doc=doc_num_steps),
+        Argument("num_moments", int, optional=True, default=512, doc=doc_num_moments),
+        Argument("num_random", int, optional=True, default=1, doc=doc_num_random),
+        Argument("npoints", int, optional=True, default=400, doc=doc_npoints),
+        Argument("width", [list, None], optional=True, default=None, doc=doc_width),
+        Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
+        Argument("seed", [int, None], optional=True, default=None, doc=doc_seed)
+    ]
+
+def foe():
+    doc_kT = "The electronic temperature of the Fermi function in eV. The number of terms of the expansion is inversely proportional to it. Default: 0.1"
+    doc_num_terms = "The number of Chebyshev terms of the Fermi operator, if None it is set by the spectral width and kT. Default: None"
+    doc_threshold = "The truncation threshold of the elements of the sparse matrices of the expansion. Default: 1e-6"
+    doc_cutoff = "The localization radius in Angstrom of the density matrix, the matrices of the expansion only keep the orbital pairs of the atoms \
+        within the radius, which makes the cost linear in the number of atoms. None keeps all the pairs. Default: None"
+    doc_E_fermi = "The chemical potential, if None it is given by the bisection of the electron count. Default: None"
+    doc_tol = "The tolerance of the electron count of the bisection. Default: 1e-8"
+
+    return [
+        Argument("kT", [float, int], optional=True, default=0.1, doc=doc_kT),
+        Argument("num_terms", [int, None], optional=True, default=None, doc=doc_num_terms),
+        Argument("threshold", [float, int], optional=True, default=1e-6, doc=doc_threshold),
+        Argument("cutoff", [float, int, None], optional=True, default=None, doc=doc_cutoff),
+        Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
+        Argument("tol", float, optional=True, default=1e-8, doc=doc_tol)
     ]
 
 def FS2D():
@@ -527,7 +623,8 @@ def FS2D():
         Argument("mesh_grid", list, optional=False, doc=doc_mesh_grid),
         Argument("sigma", float, optional=False, doc=doc_sigma),
         Argument("E0", int, optional=False, doc=doc_E0),
-        Argument("intpfactor", int, optional=False, doc=doc_intpfactor)
+        Argument("intpfactor", int, optional=False, doc=doc_intpfactor),
+        *kchunk_options()
     ]
 
 def FS3D():
@@ -535,12 +632,79 @@ def FS3D():
     doc_E0 = ""
     doc_sigma = ""
     doc_intpfactor = ""
+    doc_E_fermi = "The Fermi level in eV. It has to be set when the sparse eigen solver does not solve all the occupied bands."
 
     return [
         Argument("mesh_grid", list, optional=False, doc=doc_mesh_grid),
         Argument("sigma", float, optional=False, doc=doc_sigma),
         Argument("E0", int, optional=False, doc=doc_E0),
-        Argument("intpfactor", int, optional=False, doc=doc_intpfactor)
+        Argument("intpfactor", int, optional=False, doc=doc_intpfactor),
+        Argument("E_fermi", [float, int, None], optional=True, doc=doc_E_fermi, default=None),
+        eig_solver(),
+        *kchunk_options()
+    ]
+
+def sparse_eig_solver():
+    doc_method = "The iterative solver: `shift-invert` (Lanczos on (H - sigma S)^-1 S), `lanczos` (the lowest bands by Lanczos) or `lobpcg`. Default: `shift-invert`"
+    doc_band_window = "[band_min, band_max], solve the bands with index band_min <= n < band_max, counted from the lowest band. All the bands below band_max are solved, use the energy_window for the bands deep in the spectrum."
+    doc_energy_window = "[emin, emax] in eV, solve the bands inside the energy window. The number of bands may differ between k-points, the missing ones are padded with NaN."
+    doc_sigma = "The shift in eV of the `shift-invert` solver for the energy window. Default: the center of the window."
+    doc_num_bands = "The number of bands solved in the first attempt for the energy window, doubled until the window is covered."
+    doc_tol = "The tolerance of the iterative solver, 0 for the machine precision."
+    doc_maxiter = "The maximum number of iterations of the iterative solver."
+    doc_warm_start = "If True, the k-points are solved in order as a path: each one by a Chebyshev filtered subspace iteration started from \
+        the eigenvectors of the previous one, which converges in a few iterations along the dense k-paths of the band structure. \
+        The first k-point of each path segment is solved from scratch by `method`. Only with the band_window. Default: False"
+
+    return [
+        Argument("method", str, optional=True, default="shift-invert", doc=doc_method),
+        Argument("band_window", [list, None], optional=True, default=None, doc=doc_band_window),
+        Argument("energy_window", [list, None], optional=True, default=None, doc=doc_energy_window),
+        Argument("sigma", [float, int, None], optional=True, default=None, doc=doc_sigma),
+        Argument("num_bands", int, optional=True, default=20, doc=doc_num_bands),
+        Argument("tol", [float, int], optional=True, default=0, doc=doc_tol),
+        Argument("maxiter", [int, None], optional=True, default=None, doc=doc_maxiter),
+        Argument("warm_start", bool, optional=True, default=False, doc=doc_warm_start)
+    ]
+
+def dense_eig_solver():
+    doc_driver = "The dense eigen solver backend: `torch` (torch.linalg.eigh, batched over k-points), `evr` (LAPACK MRRR), \
+        `evx` (LAPACK bisection) or `evd` (LAPACK divide-and-conquer). `auto` selects by the matrix size, the window and the need of eigenvectors. Default: `auto`"
+    doc_band_window = "[band_min, band_max], only solve the bands with index band_min <= n < band_max."
+    doc_energy_window = "[emin, emax] in eV, only solve the bands inside the energy window. The number of bands may differ between k-points, the missing ones are padded with NaN."
+
+    return [
+        Argument("driver", str, optional=True, default="auto", doc=doc_driver),
+        Argument("band_window", [list, None], optional=True, default=None, doc=doc_band_window),
+        Argument("energy_window", [list, None], optional=True, default=None, doc=doc_energy_window)
+    ]
+
+def eig_solver():
+    doc_eig_solver = "The eigen solver of the task. `dense` diagonalizes H(k) with a dense solver, `sparse` assembles H(k) and S(k) in CSR format \
+        and solves only the bands in a band or energy window with an iterative solver, for large supercells."
+    doc_type = "select type of the eigen solver, `dense` or `sparse`. Default: `dense`"
+
+    return Argument("eig_solver", dict, sub_fields=[], optional=True, default={}, sub_variants=[
+        Variant("type", [
+            Argument("dense", dict, dense_eig_solver()),
+            Argument("sparse", dict, sparse_eig_solver())
+        ], optional=True, default_tag="dense", doc=doc_type)
+    ], doc=doc_eig_solver)
+
+def kchunk_options():
+    doc_memory_budget = "The memory budget in GB of the H(k), S(k) and eigenvector stacks. The k-points are solved in chunks that fit \
+        into the budget and reduced chunk by chunk. Default: 4 GB"
+    doc_num_workers = "The number of processes solving the k-chunks in parallel, the H(R) is shared between them. Default: 1"
+    doc_num_threads = "The number of torch threads of each process. Default: the number of cores divided by num_workers"
+    doc_fft_hk = "If True, the H(k) and S(k) of the regular k-meshes (DOS, PDOS and 3D Fermi surface) are given by one FFT of the H(R) \
+        over the whole mesh instead of the phase sum at each k-point. The k-points off the mesh, and the meshes whose H(k) exceeds the \
+        memory budget, keep the phase sum. Default: True"
+
+    return [
+        Argument("memory_budget", [float, int, None], optional=True, default=None, doc=doc_memory_budget),
+        Argument("num_workers", int, optional=True, default=1, doc=doc_num_workers),
+        Argument("num_threads", [int, None], optional=True, default=None, doc=doc_num_threads),
+        Argument("fft_hk", bool, optional=True, default=True, doc=doc_fft_hk)
     ]
 
 
@@ -639,7 +803,8 @@ def ifermi():
         Argument("plot_fs_bands", bool, optional = True, default = False, doc = doc_plot_fs_bands),
         Argument("fs_plane", list, optional = True, default=[0,0,1], doc = doc_fs_plane),
         Argument("fs_distance", [int,float], optional = True, default=0, doc = doc_fs_distanc),
-        Argument("plot_options", dict, optional=True, sub_fields=plot_options, sub_variants=[], default={}, doc=doc_fs_plot_options)
+        Argument("plot_options", dict, optional=True, sub_fields=plot_options, sub_variants=[], default={}, doc=doc_fs_plot_options),
+        *kchunk_options()
     ]
 
 
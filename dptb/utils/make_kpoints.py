@@ -1,6 +1,9 @@
 import numpy as np
 import ase
+import spglib
 import logging
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 log = logging.getLogger(__name__)
 
 
@@ -139,6 +142,114 @@ def kmesh_sampling(meshgrid=[1,1,1], is_gamma_center=True):
     return kpoints
 
 
+def kmesh_irreducible(meshgrid=[1,1,1], is_gamma_center=True, structase=None, time_reversal=True, periodic=None, symprec=1e-5):
+    """ Generate the irreducible k-points of a mesh and their weights, using the point group of the structure and the
+    time reversal symmetry k = -k.
+
+    The mesh points are grouped into the stars of the symmetry operations that map the mesh onto itself, one k-point
+    of each star is kept and its weight is the number of mesh points in the star. The eigenvalues are the same at all
+    the points of a star, so a weighted sum over the irreducible k-points equals the sum over the full mesh.
+
+    Parameters
+    ----------
+    meshgrid : list. [N1, N2, N3]
+        A list of 3 integers, the number of k-points in each direction.
+    is_gamma_center : bool
+        If True the mesh is gamma centered, otherwise it is the Monkhorst-Pack mesh.
+    structase : ase.Atoms
+        The structure in ASE format, its point group is found by spglib. If None, only the time reversal is used.
+    time_reversal : bool
+        If True, k and -k are equivalent.
+    periodic : list. [p1, p2, p3]
+        A list of 3 bools, the directions without periodicity, e.g. the vacuum direction of a 2D slab, are collapsed to
+        one k-point. By default all the directions are periodic.
+    symprec : float
+        The tolerance of spglib to find the symmetry operations.
+
+    Returns
+    -------
+    kpoints : numpy.ndarray
+        The [nk, 3] irreducible k-points.
+    weights : numpy.ndarray
+        The [nk] integer weights, the number of mesh points each k-point stands for. They sum to the size of the mesh.
+    """
+    meshgrid = np.array(meshgrid, dtype=int)
+    if periodic is not None:
+        periodic = np.array(periodic, dtype=bool)
+        if (~periodic & (meshgrid > 1)).any():
+            log.info(f'The mesh along the non-periodic directions {np.where(~periodic)[0].tolist()} is collapsed to one k-point.')
+        meshgrid = np.where(periodic, meshgrid, 1)
+
+    if is_gamma_center:
+        kpoints = gamma_center(meshgrid)
+        shift = np.zeros(3)
+    else:
+        kpoints = monkhorst_pack(meshgrid)
+        shift = 0.5 - 0.5 * meshgrid
+
+    # the grid address of each point, the points of a symmetry related k outside of the mesh are not on the grid.
+    def grid_index(kpts):
+        address = kpts * meshgrid - shift
+        on_grid = np.all(np.abs(address - np.round(address)) < 1e-6, axis=1)
+        address = np.mod(np.round(address).astype(int), meshgrid)
+        return on_grid, np.ravel_multi_index(address.T, meshgrid)
+
+    rotations = [np.eye(3, dtype=int)]
+    if structase is not None:
+        cell = (np.array(structase.cell), structase.get_scaled_positions(), structase.get_atomic_numbers())
+        dataset = spglib.get_symmetry(cell, symprec=symprec)
+        if dataset is None:
+            log.warning('spglib can not find the symmetry of the structure, only the time reversal is used.')
+        else:
+            rotations = list(dataset['rotations'])
+    if time_reversal:
+        rotations = rotations + [-rot for rot in rotations]
+
+    # with x' = W x in fractional coordinates, k' = W^T k keeps the phases k.x, the row vectors transform as k W.
+    nk = len(kpoints)
+    row, col = [], []
+    for rot in rotations:
+        on_grid, index = grid_index(kpoints @ rot)
+        if not on_grid.all():
+            # the operation does not keep the mesh, e.g. a hexagonal mesh with N1 != N2.
+            continue
+        row.append(np.arange(nk))
+        col.append(index)
+    row, col = np.concatenate(row), np.concatenate(col)
+    graph = coo_matrix((np.ones(len(row)), (row, col)), shape=(nk, nk))
+    nstar, star = connected_components(graph, directed=False)
+
+    weights = np.bincount(star, minlength=nstar)
+    _, first = np.unique(star, return_index=True)
+    if nstar < nk:
+        log.info(f'The {nk} mesh k-points are reduced to {nstar} irreducible k-points.')
+
+    return kpoints[first], weights
+
+
+def periodic_directions(structase, all_bonds=None):
+    """ The periodic directions of the structure, given by the pbc of the structure and, if the bonds are given, by the
+    lattice vectors of the bonds. H(k) does not depend on k along a direction that no bond crosses, e.g. the vacuum
+    direction of a 2D slab.
+
+    Parameters
+    ----------
+    structase : ase.Atoms
+        The structure in ASE format.
+    all_bonds : numpy.ndarray
+        The [nbond, 7] bond list, with the lattice vector in the last 3 columns.
+
+    Returns
+    -------
+    periodic : numpy.ndarray
+        A list of 3 bools.
+    """
+    periodic = np.array(structase.pbc, dtype=bool)
+    if all_bonds is not None:
+        periodic = periodic & np.any(np.asarray(all_bonds)[:,4:7] != 0, axis=0)
+    return periodic
+
+
 def kgrid_spacing(structase,kspacing:float,sampling='MP'):
     """Generate k-points based on the given k-spacing and sampling method.
     